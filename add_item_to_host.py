@@ -15,22 +15,27 @@
 #   limitations under the License.
 #
 
-from extlib.zabbix_api import ZabbixAPI
 from extlib.zabbix_api import Already_Exists
 
 import argparse
+import csv
+import json
+from lib import client
 from lib import config
+from lib import metadata
+from lib import size_model
 import sys
+import time
 
 _name = 'Example: Used disk space on /var/log in %' 
 _key = 'vfs.fs.size[/var/log,free]'
 
 def add_item_to_host(server, username, password, log_level,
                      host, name, key, remove_duplicate=False):
-  zapi = ZabbixAPI(server=server, log_level=log_level)
-  zapi.login(username, password)
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
 
-  version = zapi.apiinfo.version({})
+  version = zapi.api_version()
 
   host_id = zapi.host.get({'filter': {'host': host}})[0]['hostid']
   duplicates = zapi.item.get({'filter': {'key_': key, 'host': host}})
@@ -104,18 +109,282 @@ def add_item_to_host(server, username, password, log_level,
   pass
 
 
+def _chunks(seq, size):
+  for i in range(0, len(seq), size):
+    yield seq[i:i + size]
+    pass
+  pass
+
+
+def read_manifest(filename):
+  '''
+  Reads (host, key, name, delay) entries from a JSON list of objects or
+  a CSV file with a "host,key,name,delay" header line.
+  '''
+  with open(filename) as f:
+    if filename.endswith('.json'):
+      entries = json.load(f)
+    else:
+      entries = list(csv.DictReader(f))
+      pass
+    pass
+  for entry in entries:
+    for field in ('host', 'key'):
+      if not entry.get(field):
+        raise ValueError('"{}" is missing in {}'.format(field, entry))
+      pass
+    entry.setdefault('name', entry['key'])
+    entry['delay'] = entry.get('delay') or 30
+    pass
+  return entries
+
+
+def _resolve(zapi, version, hostnames, keys, name_field, chunk_size):
+  '''
+  Returns ({host: hostid}, {hostid: (rank, interfaceid)},
+  {(hostid, key): item}) for the hosts and keys of a manifest.
+  '''
+  hostids = {}
+  for chunk in _chunks(hostnames, chunk_size):
+    for host in zapi.host.get({'filter': {'host': chunk},
+                               'output': ['hostid', 'host']}):
+      hostids[host['host']] = host['hostid']
+      pass
+    pass
+  ids = sorted(set(hostids.values()))
+  interfaceids = {}
+  if not version.startswith('1.'):
+    for chunk in _chunks(ids, chunk_size):
+      for interface in zapi.hostinterface.get(
+          {'hostids': chunk,
+           'output': ['interfaceid', 'hostid', 'main', 'type']}):
+        rank = _interface_rank(interface)
+        current = interfaceids.get(interface['hostid'])
+        if current is None or rank > current[0]:
+          interfaceids[interface['hostid']] = (rank, interface['interfaceid'])
+          pass
+        pass
+      pass
+    pass
+  existing = _existing_items(zapi, ids, keys, name_field, chunk_size)
+  return (hostids, interfaceids, existing)
+
+
+def _existing_items(zapi, hostids, keys, name_field, chunk_size):
+  '''Returns {(hostid, key): item} of items having one of keys.'''
+  existing = {}
+  for chunk in _chunks(hostids, chunk_size):
+    for item in zapi.item.get({'hostids': chunk,
+                               'filter': {'key_': keys},
+                               'output': ['itemid', 'hostid', 'key_',
+                                          name_field, 'delay']}):
+      existing[(item['hostid'], item['key_'])] = item
+      pass
+    pass
+  return existing
+
+
+def _same_delay(a, b):
+  '''
+  Whether two item delays are the same, e.g. 30 from a manifest and
+  "30s" as 3.4+ returns it. Flexible intervals after ";" must be equal.
+  '''
+  (base_a, _, rest_a) = str(a).partition(';')
+  (base_b, _, rest_b) = str(b).partition(';')
+  seconds = size_model.parse_interval(base_a)
+  if seconds < 0 or rest_a != rest_b:
+    return str(a) == str(b)
+  return seconds == size_model.parse_interval(base_b)
+
+
+def _interface_rank(interface):
+  # Prefer the main Zabbix agent interface.
+  return (interface['type'] == '1', interface['main'] == '1')
+
+
+def _resolve_from_cache(zapi, cache, hostnames, keys, chunk_size):
+  '''
+  Same as _resolve(), with hosts and interfaces from a
+  metadata.MetadataCache. Existing items still come from the server:
+  items created since the cache was refreshed (e.g. by a run without
+  it) would otherwise be created again.
+  '''
+  # Interfaces come with the host list; items of the cache are not used.
+  cache.refresh(zapi, hostids=[])
+  wanted = set(hostnames)
+  hostids = dict((h['host'], h['hostid']) for h in cache.hosts(hostnames)
+                 if h['host'] in wanted)
+  ids = sorted(set(hostids.values()))
+  interfaceids = {}
+  for hostid in ids:
+    for interface in cache.interfaces(hostid):
+      rank = _interface_rank(interface)
+      current = interfaceids.get(hostid)
+      if current is None or rank > current[0]:
+        interfaceids[hostid] = (rank, interface['interfaceid'])
+        pass
+      pass
+    pass
+  existing = _existing_items(zapi, ids, keys, 'name', chunk_size)
+  return (hostids, interfaceids, existing)
+
+
+def add_items_from_manifest(server, username, password, log_level,
+                            manifest, remove_duplicate=False,
+                            chunk_size=500, metadata_max_age=None):
+  '''
+  Creates every item of manifest that does not exist yet, with a few
+  batched lookups and chunked array-form item.create calls.
+
+  An item already having the key on the host is left alone when its
+  name and delay match; otherwise it is reported, or deleted and created
+  again with remove_duplicate. Only the first entry of a repeated host
+  and key is used.
+
+  With metadata_max_age, hosts, interfaces and existing items are read
+  from lib/metadata.py's cache, refreshed when older than that.
+  '''
+  timings = []
+  start = time.time()
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
+  version = zapi.api_version()
+  timings.append(('login', time.time() - start))
+
+  start = time.time()
+  hostnames = sorted(set(e['host'] for e in manifest))
+  keys = sorted(set(e['key'] for e in manifest))
+  name_field = 'description' if version.startswith('1.') else 'name'
+  cache = None
+  if metadata_max_age is not None and not version.startswith('1.'):
+    cache = metadata.MetadataCache(server, max_age=metadata_max_age,
+                                   chunk_size=chunk_size)
+    (hostids, interfaceids, existing) = _resolve_from_cache(
+      zapi, cache, hostnames, keys, chunk_size)
+  else:
+    (hostids, interfaceids, existing) = _resolve(
+      zapi, version, hostnames, keys, name_field, chunk_size)
+    pass
+  timings.append(('resolve', time.time() - start))
+
+  start = time.time()
+  to_create = []
+  to_delete = []
+  unchanged = 0
+  conflicts = []
+  missing_hosts = set()
+  seen = set()
+  for entry in manifest:
+    if (entry['host'], entry['key']) in seen:
+      print('"{}" is listed more than once for "{}". Skipping the repeat.'
+            .format(entry['key'], entry['host']))
+      continue
+    seen.add((entry['host'], entry['key']))
+    if entry['host'] not in hostids:
+      missing_hosts.add(entry['host'])
+      continue
+    host_id = hostids[entry['host']]
+    item = existing.get((host_id, entry['key']))
+    if item is not None:
+      if (item[name_field] == entry['name']
+          and _same_delay(item['delay'], entry['delay'])):
+        unchanged += 1
+        continue
+      if not remove_duplicate:
+        conflicts.append((entry['host'], entry['key'], item['itemid']))
+        continue
+      to_delete.append(item['itemid'])
+      pass
+    params = {name_field: entry['name'],
+              'key_': entry['key'],
+              'type': 0, # Zabbix agent
+              'value_type': 0, # numeric float
+              'hostid': host_id,
+              'delay': entry['delay'],
+              }
+    if name_field == 'name':
+      if host_id not in interfaceids:
+        print('No interface on "{}". Skipping "{}".'.format(entry['host'],
+                                                          entry['key']))
+        continue
+      params['interfaceid'] = interfaceids[host_id][1]
+      pass
+    to_create.append(params)
+    pass
+  timings.append(('diff', time.time() - start))
+
+  start = time.time()
+  deleted = 0
+  for chunk in _chunks(to_delete, chunk_size):
+    result = zapi.item.delete(chunk)['itemids']
+    if type(result) == dict:
+      # Seems a bug in 2.0.x, in which [{'itemids': {id: id}}] is returned.
+      result = list(result.keys())
+      pass
+    deleted += len(result)
+    pass
+  timings.append(('delete', time.time() - start))
+
+  start = time.time()
+  created = 0
+  for chunk in _chunks(to_create, chunk_size):
+    created += len(zapi.item.create(chunk)['itemids'])
+    pass
+  timings.append(('create', time.time() - start))
+  if cache is not None and (deleted or created):
+    deleted_ids = set(to_delete)
+    cache.invalidate(set(p['hostid'] for p in to_create)
+                     | set(item['hostid'] for item in existing.values()
+                           if item['itemid'] in deleted_ids))
+    pass
+
+  for host in sorted(missing_hosts):
+    print('No host "{}".'.format(host))
+    pass
+  for (host, key, itemid) in conflicts:
+    print('Key "{}" already exists on "{}" ({}) with another name or delay.'
+          ' Use --remove-duplicate to replace it.'.format(key, host, itemid))
+    pass
+  print('Created {}, deleted {}, unchanged {}, conflicts {}, '
+        'unknown hosts {}.'.format(created, deleted, unchanged,
+                                   len(conflicts), len(missing_hosts)))
+  print(', '.join('{}: {:.2f}s'.format(phase, seconds)
+                  for (phase, seconds) in timings))
+  pass
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description=('Add an example item to '
                                                 'a given host.'))
   config.add_argparse_configs(parser)
-  parser.add_argument('host', help='hostname for the example item')
+  parser.add_argument('host', nargs='?',
+                      help='hostname for the example item')
+  parser.add_argument('--manifest', '-m',
+                      help=('CSV (host,key,name,delay) or JSON file listing'
+                            ' items to add, instead of the example item'))
+  parser.add_argument('--chunk-size', type=int, default=500,
+                      help='Number of items sent in one item.create call')
   parser.add_argument('--remove-duplicate', '-r', action='store_true',
                       help=('Remove duplicates when found, '
                             'instead of letting this app exit itself.'))
+  metadata.add_argument(parser)
 
   args = parser.parse_args()
-  server = config.get_server_uri(args.server)
+  servers = config.get_server_uris(args.server, args.all_servers)
+  if len(servers) != 1:
+    parser.error('this script works on one server at a time')
+    pass
+  server = servers[0][1]
 
-  add_item_to_host(server, args.username, args.password, args.log_level,
-                   args.host, _name, _key, args.remove_duplicate)
+  if args.manifest:
+    add_items_from_manifest(server, args.username, args.password,
+                            args.log_level, read_manifest(args.manifest),
+                            args.remove_duplicate, args.chunk_size,
+                            args.metadata_max_age)
+  elif args.host:
+    add_item_to_host(server, args.username, args.password, args.log_level,
+                     args.host, _name, _key, args.remove_duplicate)
+  else:
+    parser.error('host or --manifest is required')
+    pass
   pass
@@ -21,48 +21,412 @@ Make sure your account have an access to Template group
 (read/write or read-only)
 '''
 
-import pyzabbix
+import numpy as np
+
+from lib import aio_client
+from lib import client
+from lib import config
+from lib import fleet
+from lib import metadata
+from lib import profiling
+from lib import records
+from lib import retry
+from lib import scheduler
+from lib import size_model
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 import getpass
+import sys
+import threading
+import time
 from logging import getLogger, StreamHandler
 from logging import DEBUG
 
 
 
-# See also:
-# https://www.zabbix.com/documentation/1.8/manual/installation/requirements
-# 
-# History: days*(items/refresh rate)*24*3600*bytes (bytes ~= 50)
-# Trends: days*(items/3600)*24*3600*bytes (bytes ~= 128)
+# Only fields the estimate actually reads are requested, so that the server
+# does not have to serialize whole host/item rows.
+_HOST_FIELDS = ['hostid', 'host']
+_ITEM_FIELDS = ['hostid', 'delay', 'history', 'trends']
+
+# Hosts are kept as slotted records and items as columns (see
+# lib/records.py), so that a scan of a million items fits in tens of MB.
+_Host = records.record_type('Host', _HOST_FIELDS + ['parentTemplates'])
+
+# Result of estimate() for one server.
+_Estimate = records.record_type('Estimate', ['hosts', 'subtotals', 'counts',
+                                             'observed_rows',
+                                             'observed_events'])
+
+
+# history.get can only count one value type per call: numeric (float),
+# character, log, numeric (unsigned) and text.
+_HISTORY_VALUE_TYPES = [0, 1, 2, 3, 4]
+
+# Upper bound for --jobs. Each job keeps one request in flight against the
+# frontend, so this is also the most PHP-FPM workers we can occupy at once.
+_MAX_JOBS = 8
+
+# Upper bound for --jobs with --aio. Requests are pipelined over a few
+# connections there, so more of them can be in flight.
+_MAX_AIO_JOBS = 32
+
+# Rows given to the size model at once by estimate_host_bytes().
+_MODEL_ROWS = 64 * 1024
+
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _parallel_map(zapi, func, args_list, jobs):
+    '''
+    Returns [func(api, arg) for arg in args_list], running at most
+    min(jobs, _MAX_JOBS) calls at once, each thread with its own clone
+    of zapi sharing its connections and token. The result order always
+    follows args_list.
+    '''
+    jobs = max(1, min(jobs, _MAX_JOBS))
+    if jobs == 1 or len(args_list) <= 1:
+        return [func(zapi, arg) for arg in args_list]
+
+    local = threading.local()
+
+    def call(arg):
+        if not hasattr(local, 'zapi'):
+            local.zapi = zapi.clone()
+        return func(local.zapi, arg)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(call, args_list))
+
+
+def _stream_chunk(zapi, hostids, params):
+    return zapi.stream('item.get', dict(params, hostids=hostids,
+                                        output=_ITEM_FIELDS))
+
+
+def _item_columns(rows):
+    items = records.Columns(_ITEM_FIELDS, int_fields=['hostid'])
+    items.extend(rows)
+    return items
+
+
+def _fetch_chunk(zapi, hostids, logger, params):
+    items = _item_columns(_stream_chunk(zapi, hostids, params))
+    logger.debug('Fetched {} items for {} hosts'
+                 .format(len(items), len(hostids)))
+    return items
+
+
+async def _fetch_chunks_async(zapi, chunks, logger, params, jobs):
+    async with aio_client.from_client(zapi) as azapi:
+        async def fetch(chunk):
+            items = _item_columns(await azapi.item.get(
+                hostids=chunk, output=_ITEM_FIELDS, **params))
+            logger.debug('Fetched {} items for {} hosts'
+                         .format(len(items), len(chunk)))
+            return items
+        return await aio_client.gather([fetch(c) for c in chunks],
+                                       limit=jobs)
+
+
+def _hosts_from_cache(zapi, cache, names, with_templates, logger):
+    '''Hosts (all of them, or those named) from a metadata.MetadataCache.'''
+    cache.refresh(zapi, hostids=[])
+    if names:
+        wanted = set(names)
+        hosts = [h for h in cache.hosts(names) if h['host'] in wanted]
+        for name in sorted(wanted - set(h['host'] for h in hosts)):
+            logger.error('No hostid for "{}"'.format(name))
+    else:
+        hosts = cache.hosts()
+    if with_templates:
+        for host in hosts:
+            host['parentTemplates'] = cache.templates(host['hostid'])
+    return [_Host.from_dict(h) for h in hosts]
+
+
+def fetch_items(zapi, hostids, chunk_size, logger, jobs=1, params=None,
+                aio=False):
+    '''
+    Fetches items for many hosts with one item.get per chunk of hostids,
+    instead of one item.get per host, into Columns of _ITEM_FIELDS.
+    params are extra item.get parameters (templated=False by default).
+
+    With jobs > 1 the chunks are fetched by a pool of at most _MAX_JOBS
+    threads, or with aio by up to _MAX_AIO_JOBS pipelined asyncio
+    requests. Rows are stored in chunk order regardless of which
+    request finishes first, so the outcome equals the serial one.
+    '''
+    if params is None:
+        params = {'templated': False}
+    jobs = max(1, min(jobs, _MAX_AIO_JOBS if aio else _MAX_JOBS))
+    chunk_size = max(1, chunk_size)
+    if jobs > 1:
+        # Make sure there are enough chunks to keep every worker busy.
+        chunk_size = min(chunk_size, max(1, -(-len(hostids) // jobs)))
+    chunks = list(_chunks(hostids, chunk_size))
+
+    if jobs == 1 and not aio:
+        # Rows are stored while each response is still downloading.
+        return _item_columns(row for chunk in chunks
+                             for row in _stream_chunk(zapi, chunk, params))
+
+    # Each chunk is made compact as soon as it arrives.
+    if aio:
+        results = asyncio.run(_fetch_chunks_async(zapi, chunks, logger,
+                                                  params, jobs))
+    else:
+        results = _parallel_map(
+            zapi,
+            lambda api, chunk: _fetch_chunk(api, chunk, logger, params),
+            chunks, jobs)
+    items = _item_columns([])
+    for chunk_items in results:
+        items.merge(chunk_items)
+    return items
+
+
+class _HostidScopes(object):
+    '''Macro scope of each item: its hostid, as MacroTable expects it.'''
+    def __init__(self, hostids):
+        self._hostids = hostids
+
+    def __getitem__(self, i):
+        return str(self._hostids[i])
+
+
+def estimate_host_bytes(hosts, items, macros, legacy_units, scopes=None):
+    '''
+    Runs the size model on items (Columns of _ITEM_FIELDS), _MODEL_ROWS
+    rows at a time so that its temporary arrays stay small. Returns
+    per-host (bytes, item count) arrays in the order of hosts, plus the
+    number of items that could not be parsed. Items of other hosts are
+    ignored. scopes overrides the macro scope of each item (its hostid by
+    default).
+    '''
+    position = dict((int(host['hostid']), i) for i, host in enumerate(hosts))
+    subtotals = np.zeros(len(hosts), dtype=np.float64)
+    counts = np.zeros(len(hosts), dtype=np.int64)
+    invalid = 0
+    for start in range(0, len(items), _MODEL_ROWS):
+        end = start + _MODEL_ROWS
+        hostids = items['hostid'][start:end]
+        host_index = np.fromiter((position.get(h, -1) for h in hostids),
+                                 dtype=np.int64, count=len(hostids))
+        if scopes is None:
+            block_scopes = _HostidScopes(hostids)
+        else:
+            block_scopes = scopes[start:end]
+
+        history_bytes, trend_bytes, block_invalid = size_model.estimate_bytes(
+            items['delay'][start:end], items['history'][start:end],
+            items['trends'][start:end], hostids=block_scopes, macros=macros,
+            legacy_units=legacy_units)
+        known = host_index >= 0
+        host_index = host_index[known]
+        subtotals += size_model.sum_by_index(
+            host_index, (history_bytes + trend_bytes)[known], len(hosts))
+        counts += np.bincount(host_index, minlength=len(hosts))
+        invalid += int(block_invalid[known].sum())
+    return subtotals, counts, invalid
+
+
+def estimate_by_template(zapi, hosts, args, logger, legacy_units):
+    '''
+    Same result as estimate_host_bytes(), but items inherited from
+    templates are fetched and costed once per template and multiplied
+    across linked hosts. Per host, only its own (non-templated) items are
+    fetched, plus a re-evaluation of template items whose delay, history
+    or trends use macros, so that host-level macro overrides are honored.
+
+    Direct edits of inherited items on a host and nested templates are
+    not seen here; run without --template for an exact figure.
+
+    hosts must carry "parentTemplates". Logs a per-template breakdown.
+    '''
+    hostids = [host['hostid'] for host in hosts]
+    templates = {}
+    linked_hosts = {}
+    for host in hosts:
+        for template in host['parentTemplates']:
+            templates[template['templateid']] = template
+            linked_hosts.setdefault(template['templateid'], []).append(
+                host['hostid'])
+    templateids = sorted(templates)
+    logger.debug('{} templates linked to {} hosts'
+                 .format(len(templateids), len(hosts)))
+
+    macros = size_model.MacroTable(zapi, hostids + templateids,
+                                   args.chunk_size)
+    template_items = fetch_items(zapi, templateids, args.chunk_size, logger,
+                                 jobs=args.jobs, params={}, aio=args.aio)
+    own_items = fetch_items(zapi, hostids, args.chunk_size, logger,
+                            jobs=args.jobs,
+                            params={'templated': False, 'inherited': False},
+                            aio=args.aio)
+
+    # Split template items into ones costing the same on every host and
+    # ones depending on macros, which have to be evaluated per host.
+    static_rows = []
+    dynamic_rows = dict((templateid, []) for templateid in templateids)
+    for i in range(len(template_items)):
+        if (size_model.has_macro(template_items['delay'][i])
+                or size_model.has_macro(template_items['history'][i])
+                or size_model.has_macro(template_items['trends'][i])):
+            dynamic_rows[str(template_items['hostid'][i])].append(i)
+        else:
+            static_rows.append(i)
+
+    template_hosts = [{'hostid': templateid} for templateid in templateids]
+    template_bytes, template_counts, invalid = estimate_host_bytes(
+        template_hosts, template_items.select(static_rows), macros,
+        legacy_units)
+
+    subtotals, counts, host_invalid = estimate_host_bytes(
+        hosts, own_items, macros, legacy_units)
+    invalid += host_invalid
+
+    # Macro-dependent template items of each host, resolved with a
+    # (hostid, templateid) macro scope.
+    dynamic_items = records.Columns(_ITEM_FIELDS, int_fields=['hostid'])
+    scopes = []
+    for host in hosts:
+        for template in host['parentTemplates']:
+            scope = (host['hostid'], template['templateid'])
+            for i in dynamic_rows[template['templateid']]:
+                row = template_items.row(i)
+                row['hostid'] = host['hostid']
+                dynamic_items.append(row)
+                scopes.append(scope)
+    if scopes:
+        dynamic_bytes, dynamic_counts, host_invalid = estimate_host_bytes(
+            hosts, dynamic_items, macros, legacy_units, scopes=scopes)
+        subtotals += dynamic_bytes
+        counts += dynamic_counts
+        invalid += host_invalid
+
+    template_index = dict((templateid, i)
+                          for i, templateid in enumerate(templateids))
+    for i, host in enumerate(hosts):
+        for template in host['parentTemplates']:
+            j = template_index[template['templateid']]
+            subtotals[i] += template_bytes[j]
+            counts[i] += template_counts[j]
+
+    for j, templateid in enumerate(templateids):
+        links = len(linked_hosts[templateid])
+        logger.info('Template {} (id: {}): {:.2f} MB per host'
+                    ' ({} items, {} more costed per host due to macros)'
+                    ' x {} hosts = {}'
+                    .format(templates[templateid]['host'], templateid,
+                            template_bytes[j] / 1024 / 1024,
+                            template_counts[j],
+                            len(dynamic_rows[templateid]), links,
+                            _format_bytes(template_bytes[j] * links)))
+    return subtotals, counts, invalid
+
+
+def observe_host(zapi, hostid, time_from, time_till):
+    '''
+    Counts history rows and events of one host between time_from and
+    time_till with countOutput, so that no rows are transferred.
+    Returns (history_rows, events).
+    '''
+    history_rows = 0
+    for value_type in _HISTORY_VALUE_TYPES:
+        history_rows += int(zapi.history.get(history=value_type,
+                                             hostids=[hostid],
+                                             time_from=time_from,
+                                             time_till=time_till,
+                                             countOutput=True))
+    events = int(zapi.event.get(hostids=[hostid],
+                                time_from=time_from,
+                                time_till=time_till,
+                                countOutput=True))
+    return history_rows, events
+
+
+def observe_hosts(zapi, hosts, hours, jobs):
+    '''
+    Runs observe_host() for every host in parallel over the last hours
+    and returns per-host (history rows/day, events/day) arrays.
+    '''
+    time_till = int(time.time())
+    time_from = time_till - int(hours * 3600)
+    results = _parallel_map(
+        zapi,
+        lambda api, host: observe_host(api, host['hostid'],
+                                       time_from, time_till),
+        hosts, jobs)
+    scale = 24.0 / hours
+    history_rows = np.array([r[0] for r in results], dtype=np.float64)
+    events = np.array([r[1] for r in results], dtype=np.float64)
+    return history_rows * scale, events * scale
+
+
+def _format_bytes(total_bytes):
+    if total_bytes > 1024 * 1024 * 1024:
+        return '{:.3f} GB'.format(total_bytes / (1024*1024*1024))
+    elif total_bytes > 1024 * 1024:
+        return '{:.3f} MB'.format(total_bytes / (1024*1024))
+    elif total_bytes > 1024:
+        return '{:.3f} KB'.format(total_bytes / 1024)
+    else:
+        return '{} B'.format(total_bytes)
+
+
+# See also lib/size_model.py for history and trends.
+#
 # Events: days*events*24*3600*bytes (bytes ~= 130)
 #
-def estimate_database_size(args, logger):
-    if not args.url.startswith('http'):
-        newurl = '{}{}{}'.format(args.prefix, args.url, args.suffix)
+_EVENT_ROW_BYTES = 130
+
+
+def _server_url(url, args, logger):
+    if not url.startswith('http'):
+        newurl = '{}{}{}'.format(args.prefix, url, args.suffix)
         logger.warning('URL (--url) does not start from "http".')
         logger.warning('Using "{}" for actual URL.'
                        .format(newurl))
-        args.url = newurl
+        return newurl
+    return url
+
 
+def estimate(args, url, password, logger):
+    '''
+    Estimates the database size of the server at url. Returns an
+    _Estimate, or None when the hosts asked for are ambiguous.
+    '''
     logger.debug('Connecting to "{}" with user "{}"'
-                 .format(args.url, args.username))
-    zapi = pyzabbix.ZabbixAPI(args.url)
-    logger.debug('Zabbix Server version: {}'
-                 .format(zapi.api_version()))
-    if not args.password:
-        args.password = getpass.getpass('Password for {}: '
-                                        .format(args.username))
-    zapi.login(args.username, args.password)
-
-    #if args.template:
-    #    logger.debug('Look for template instead of host')
-
-    if args.hosts:
+                 .format(url, args.username))
+    zapi = client.get_client(url, args.username, password,
+                             flavor='pyzabbix')
+    version = zapi.api_version()
+    logger.debug('Zabbix Server version: {}'.format(version))
+
+    if args.template:
+        host_params = {'selectParentTemplates': ['templateid', 'host']}
+    else:
+        host_params = {}
+
+    cache = None
+    if args.metadata_max_age is not None:
+        cache = metadata.MetadataCache(url, max_age=args.metadata_max_age,
+                                       chunk_size=args.chunk_size)
+        hosts = _hosts_from_cache(zapi, cache, args.hosts, args.template,
+                                  logger)
+    elif args.hosts:
         hosts = []
         for host in args.hosts:
-            result = zapi.host.get(output='extend', filter={'host': host})
+            result = [_Host.from_dict(h) for h in
+                      zapi.host.get(output=_HOST_FIELDS,
+                                    filter={'host': host}, **host_params)]
             if len(result) == 0:
                 logger.error('No hostid for "{}"'.format(result))
                 continue
@@ -72,55 +436,135 @@ def estimate_database_size(args, logger):
                 return
             hosts.extend(result)
     else:
-        hosts = zapi.host.get(output='extend')
-    logger.debug('hosts: {}'.format(hosts))
+        hosts = [_Host.from_dict(h) for h in
+                 zapi.stream('host.get', dict(host_params,
+                                              output=_HOST_FIELDS))]
+    logger.debug('{} hosts'.format(len(hosts)))
 
-    total_items = 0
-    total_bytes = 0
-    max_host_len = reduce(lambda x, host: max(x, len(host['host'])), hosts, 0)
-    for host in hosts:
-        items = zapi.item.get(filter={'hostid': host['hostid']},
-                              output='extend',
-                              templated=False)
-        logger.debug('host: {} ({} items)'.format(host['host'], len(items)))
-        total_items += len(items)
-        subtotal_bytes = 0
-        for item in items:
-            logger.debug('item: {}'.format(item))
-            refresh_rate = int(item['delay'])
-            history = int(item['history'])
-            trends = int(item['trends'])
-            subtotal_bytes += ((history * (24.0 * 3600)) / refresh_rate) * 50
-            subtotal_bytes += (24.0 * trends) * 128
-
-        host_tmpl = '{:<' + str(max_host_len) + '}'
-        logger.info((host_tmpl + '(id: {:3}): {:.2f} MB ({} items)')
-                    .format(host['host'], host['hostid'],
-                            subtotal_bytes / 1024 / 1024,
-                            len(items)))
-        total_bytes += subtotal_bytes
-
-    if total_bytes > 1024 * 1024 * 1024:
-        total_str = '{:.3f} GB'.format(total_bytes / (1024*1024*1024))
-    elif total_bytes > 1024 * 1024:
-        total_str = '{:.3f} MB'.format(total_bytes / (1024*1024))
-    elif total_bytes > 1024:
-        total_str = '{:.3f} KB'.format(total_bytes / 1024)
+    legacy_units = size_model.uses_legacy_units(version)
+    if args.template:
+        subtotals, counts, invalid = estimate_by_template(
+            zapi, hosts, args, logger, legacy_units)
     else:
-        total_str = '{} B'.format(total_bytes)
+        hostids = [host['hostid'] for host in hosts]
+        if cache is not None:
+            cache.refresh(zapi, hostids=hostids)
+            logger.debug('Refreshed {} items in the metadata cache'
+                         .format(cache.refreshed_items))
+            items = _item_columns(cache.items(hostids, _ITEM_FIELDS))
+        else:
+            items = fetch_items(zapi, hostids, args.chunk_size, logger,
+                                jobs=args.jobs, aio=args.aio)
+        macros = size_model.MacroTable(zapi, hostids, args.chunk_size)
+        subtotals, counts, invalid = estimate_host_bytes(
+            hosts, items, macros, legacy_units)
+    if invalid:
+        logger.warning('{} items have delay/history/trends that could not'
+                       ' be parsed and are counted as 0 bytes.'
+                       .format(invalid))
 
+    observed_rows = observed_events = None
+    if args.observe:
+        observed_rows, observed_events = observe_hosts(zapi, hosts,
+                                                       args.observe, args.jobs)
+    return _Estimate.from_dict({'hosts': hosts, 'subtotals': subtotals,
+                                'counts': counts,
+                                'observed_rows': observed_rows,
+                                'observed_events': observed_events})
+
+
+def print_estimate(args, result, logger):
+    hosts = result.hosts
+    subtotals = result.subtotals
+    counts = result.counts
+    observed_rows = result.observed_rows
+    observed_events = result.observed_events
+    max_host_len = reduce(lambda x, host: max(x, len(host['host'])), hosts, 0)
+    host_tmpl = '{:<' + str(max_host_len) + '}'
+    for i, host in enumerate(hosts):
+        line = ((host_tmpl + '(id: {:3}): {:.2f} MB ({} items)')
+                .format(host['host'], host['hostid'],
+                        subtotals[i] / 1024 / 1024,
+                        counts[i]))
+        if args.observe:
+            line += (' observed: {:.0f} history rows/day ({:.2f} MB/day),'
+                     ' {:.0f} events/day ({:.2f} MB/day)'
+                     .format(observed_rows[i],
+                             observed_rows[i] * size_model.HISTORY_ROW_BYTES
+                             / 1024 / 1024,
+                             observed_events[i],
+                             observed_events[i] * _EVENT_ROW_BYTES
+                             / 1024 / 1024))
+        logger.info(line)
+    total_bytes = float(subtotals.sum())
+    total_str = _format_bytes(total_bytes)
+
+    if args.observe:
+        print('Observed per day: {} history, {} events'
+              ' (sampled over the last {} hours)'
+              .format(_format_bytes(float(observed_rows.sum())
+                                    * size_model.HISTORY_ROW_BYTES),
+                      _format_bytes(float(observed_events.sum())
+                                    * _EVENT_ROW_BYTES),
+                      args.observe))
     print('Total: {} (Estimated Max. Not includes Event data!)'
           .format(total_str))
 
 
+def _describe_estimate(args, result):
+    text = '{} hosts, {} items, {}'.format(
+        len(result.hosts), int(result.counts.sum()),
+        _format_bytes(float(result.subtotals.sum())))
+    if args.observe:
+        text += ', observed {} history/day'.format(
+            _format_bytes(float(result.observed_rows.sum())
+                          * size_model.HISTORY_ROW_BYTES))
+    return text
+
+
+def estimate_database_size(args, logger):
+    servers = config.get_server_uris(args.url, args.all_servers)
+    password = args.password
+    if len(servers) == 1:
+        if not password:
+            password = lambda: getpass.getpass('Password for {}: '
+                                               .format(args.username))
+        result = estimate(args, _server_url(servers[0][1], args, logger),
+                          password, logger)
+        if result is not None:
+            print_estimate(args, result, logger)
+        return True
+
+    if not password:
+        # Asked once here rather than by every server's thread.
+        password = getpass.getpass('Password for {}: '.format(args.username))
+    urls = [(name, _server_url(url, args, logger)) for (name, url) in servers]
+    results = fleet.run(lambda url: estimate(args, url, password, logger),
+                        urls, args.server_timeout)
+    for result in results:
+        if result.error is None and result.value is None:
+            result.error = 'ambiguous host names'
+    for line in fleet.format_report(
+            results, lambda value: _describe_estimate(args, value)):
+        print(line)
+    total_bytes = sum(float(r.value.subtotals.sum()) for r in results
+                      if r.error is None)
+    print('Total: {} (Estimated Max. Not includes Event data!)'
+          .format(_format_bytes(total_bytes)))
+    return not fleet.failed(results)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('hosts',
                         help='Hosts in the Zabbix Server',
                         nargs='*')
-    parser.add_argument('--template', action='store_true')
+    parser.add_argument('--template', action='store_true',
+                        help=('Cost items inherited from templates once per'
+                              ' template instead of once per host.'))
     parser.add_argument('--url',
-                        help='Zabbix URL (e.g. http://localhost/zabbix)',
+                        help=('Zabbix URL (e.g. http://localhost/zabbix),'
+                              ' or several of them separated by commas'),
                         default='http://localhost/zabbix')
     parser.add_argument('--username', '-u',
                         help='username for your Zabbix server.',
@@ -129,20 +573,50 @@ def main():
                         help='password for your Zabbix server.')
     parser.add_argument('--prefix', default='http://')
     parser.add_argument('--suffix', default='/zabbix/')
+    parser.add_argument('--chunk-size', '-c', type=int, default=500,
+                        help=('Number of hosts whose items are fetched'
+                              ' with a single item.get call.'))
+    parser.add_argument('--jobs', '-j', type=int,
+                        help=('Number of concurrent API requests'
+                              ' (capped at {}). Default: 1, or the cap'
+                              ' with --adaptive.'.format(_MAX_JOBS)))
+    parser.add_argument('--aio', action='store_true',
+                        help=('Fetch items with pipelined asyncio requests;'
+                              ' --jobs is then capped at {}.'
+                              .format(_MAX_AIO_JOBS)))
+    parser.add_argument('--observe', type=float, metavar='HOURS',
+                        help=('Also count history rows and events of the'
+                              ' last HOURS on the server (countOutput only)'
+                              ' and report them per day next to the'
+                              ' estimate.'))
     parser.add_argument('--log', '-l', action='store', default='INFO')
     parser.add_argument('--enable-pyzabbix-log', '-e', action='store_true')
+    fleet.add_argument(parser)
+    metadata.add_argument(parser)
+    profiling.add_argument(parser)
+    retry.add_argument(parser)
+    scheduler.add_argument(parser)
     args = parser.parse_args()
+    if args.jobs is None:
+        # The scheduler decides how many of them are actually busy.
+        args.jobs = ((_MAX_AIO_JOBS if args.aio else _MAX_JOBS)
+                     if args.adaptive else 1)
     logger = getLogger(__name__)
     handler = StreamHandler()
     logger.setLevel(args.log.upper())
     handler.setLevel(args.log.upper())
     logger.addHandler(handler)
     if args.enable_pyzabbix_log:
-        pyzabbix.logger.addHandler(handler)
-        pyzabbix.logger.setLevel(args.log.upper())
+        client.logger.addHandler(handler)
+        client.logger.setLevel(args.log.upper())
 
     logger.debug('Start running')
-    estimate_database_size(args, logger)
+    ok = estimate_database_size(args, logger)
+    for (url, (limit, peak, decreases)) in scheduler.summary().items():
+        logger.debug('{}: limit {:.1f}, peak {} in flight, {} decreases'
+                     .format(url, limit, peak, decreases))
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
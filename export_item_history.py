@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+#
+#   Copyright 2013 Daisuke Miyakawa (d.miyakawa@gmail.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+'''
+Exports raw history (or hourly trends) of numeric items to compressed
+NumPy files, one per item and UTC day, for analysis outside Zabbix.
+
+> ./export_item_history.py (zabbix) --group 'Linux servers' \
+    --key 'system.cpu.util*' --key 'vfs.fs.size*' --from=-30d -o cpu
+
+Items are those of hosts in the --group(s) whose key matches one of the
+--key patterns ("*" is a wildcard). Each day is fetched with one
+history.get per --items-per-call items, --jobs of them at a time. See
+lib/history_export.py for the layout of the output directory.
+
+Progress is saved in the output directory as units (a day of some
+items) complete in order; --resume continues an interrupted export
+with the same items and range instead of starting over.
+'''
+
+from lib import checkpoint
+from lib import client
+from lib import config
+from lib import history
+from lib import history_export
+from lib import scheduler
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import threading
+import time
+
+
+_ITEM_OUTPUT = ['itemid', 'hostid', 'key_', 'value_type', 'delay']
+
+
+def find_items(zapi, groups, key_patterns):
+  '''
+  Returns numeric items of hosts in groups whose key matches one of
+  key_patterns, with a "host" field, ordered by host and key.
+  '''
+  found = zapi.hostgroup.get({'filter': {'name': groups},
+                              'output': ['groupid', 'name']})
+  missing = set(groups) - set(g['name'] for g in found)
+  if missing:
+    raise ValueError('No host group "{}"'.format('", "'.join(
+      sorted(missing))))
+  items = {}
+  for pattern in key_patterns:
+    for item in zapi.stream('item.get', {
+        'output': _ITEM_OUTPUT,
+        'groupids': [g['groupid'] for g in found],
+        'templated': False,
+        'filter': {'value_type': list(history_export.NUMERIC_TYPES)},
+        'search': {'key_': pattern},
+        'searchWildcardsEnabled': True,
+        'selectHosts': ['host']}):
+      item['host'] = item.pop('hosts')[0]['host']
+      items[item['itemid']] = item
+      pass
+    pass
+  return sorted(items.values(), key=lambda i: (i['host'], i['key_']))
+
+
+def _iter_units(zapi, directory, units, trends, jobs):
+  '''
+  Yields (unit, rows written) in the order of units while up to jobs
+  units are fetched and written at once, each thread with its own
+  clone of zapi. At most twice as many units are in flight.
+  '''
+  local = threading.local()
+
+  def export(unit):
+    if not hasattr(local, 'zapi'):
+      local.zapi = zapi.clone()
+      pass
+    result = history_export.fetch_unit(local.zapi, unit, trends)
+    return history_export.write_unit(directory, unit, result, trends)
+
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    pending = []
+    for unit in units:
+      pending.append((unit, executor.submit(export, unit)))
+      if len(pending) >= max(1, jobs) * 2:
+        (done, future) = pending.pop(0)
+        yield (done, future.result())
+        pass
+      pass
+    while pending:
+      (done, future) = pending.pop(0)
+      yield (done, future.result())
+      pass
+    pass
+  pass
+
+
+def export_history(server, username, password, log_level, directory,
+                   groups, key_patterns, time_from, time_till,
+                   trends=False, items_per_call=50, jobs=4, resume=False):
+  '''
+  Writes history of the matching items between time_from and time_till
+  under directory and returns the number of rows written.
+
+  With resume and a checkpoint left by an interrupted export of the same
+  groups, keys and method, the items and range of that export are used
+  and the units it finished are skipped.
+  '''
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
+  start_time = time.time()
+  progress = checkpoint.Checkpoint(os.path.join(directory, '.checkpoint'))
+  selection = {'groups': sorted(groups), 'keys': sorted(key_patterns),
+               'trends': trends, 'items_per_call': items_per_call}
+  state = progress.load() if resume else {}
+  if state and state.get('selection') != selection:
+    raise ValueError('{} was written for other items ({});'
+                     ' run without --resume to start over.'
+                     .format(directory, state.get('selection')))
+  if state:
+    (time_from, time_till) = (state['time_from'], state['time_till'])
+    items = history_export.read_items(directory)
+    sys.stderr.write('Resuming after {} units ({} rows written)\n'
+                     .format(state['units'], state['rows']))
+  else:
+    items = find_items(zapi, groups, key_patterns)
+    history_export.write_items(directory, items)
+    state = {'units': 0, 'rows': 0}
+    pass
+  units = history_export.make_units(items, time_from, time_till,
+                                    items_per_call)
+  sys.stderr.write('{} items, {} to {}, {} units\n'.format(
+    len(items), history_export.day_name(time_from),
+    history_export.day_name(time_till), len(units)))
+
+  done = state['units']
+  rows = state['rows']
+  for (unit, written) in _iter_units(zapi, directory, units[done:], trends,
+                                     jobs):
+    done += 1
+    rows += written
+    progress.save(selection=selection, time_from=time_from,
+                  time_till=time_till, units=done, rows=rows)
+    sys.stderr.write('{}/{} units, {} rows\r'.format(done, len(units), rows))
+    pass
+  progress.remove()
+  sys.stderr.write('\nExported {} rows of {} items in {:.1f}s\n'
+                   .format(rows, len(items), time.time() - start_time))
+  return rows
+
+
+if __name__ == '__main__':
+  parser = config.add_argparse_configs(argparse.ArgumentParser(
+    description='Export item history to NumPy files per item and day.'))
+  parser.add_argument('--group', dest='groups', action='append',
+                      required=True,
+                      help='Host group to export items of (repeatable)')
+  parser.add_argument('--key', dest='key_patterns', action='append',
+                      required=True,
+                      help=('Item key pattern, e.g. "vfs.fs.size*"'
+                            ' (repeatable)'))
+  parser.add_argument('--from', dest='time_from', type=history.parse_time,
+                      default='-1d',
+                      help=('Start of the range. "now", unix time, '
+                            '"-30d" or "2013-06-06 12:00". '
+                            'Default: 1 day ago'))
+  parser.add_argument('--till', dest='time_till', type=history.parse_time,
+                      default='now', help='End of the range. Default: now')
+  parser.add_argument('--trends', action='store_true',
+                      help='Export hourly trends instead of raw history')
+  parser.add_argument('--output-dir', '-o', required=True,
+                      help='Directory the files are written to')
+  parser.add_argument('--items-per-call', type=int, default=50,
+                      help='Items fetched by one history.get for one day')
+  parser.add_argument('--jobs', '-j', type=int,
+                      help=('Calls run at the same time. Default: 4,'
+                            ' or 16 with --adaptive'))
+  parser.add_argument('--resume', action='store_true',
+                      help='Continue an interrupted export into --output-dir')
+  scheduler.add_argument(parser)
+  args = parser.parse_args()
+  if args.jobs is None:
+    args.jobs = 16 if args.adaptive else 4
+    pass
+  servers = config.get_server_uris(args.server, args.all_servers)
+  if len(servers) != 1:
+    parser.error('this script works on one server at a time')
+    pass
+
+  export_history(servers[0][1], args.username, args.password,
+                 args.log_level, args.output_dir, args.groups,
+                 args.key_patterns, args.time_from, args.time_till,
+                 args.trends, max(1, args.items_per_call), args.jobs,
+                 args.resume)
+  pass
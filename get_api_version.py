@@ -15,21 +15,34 @@
 #   limitations under the License.
 #
 
-from extlib.zabbix_api import ZabbixAPI
+from lib import client
 from lib import config
+from lib import fleet
 
 import argparse
+import sys
 
 def get_version(server, username, password, log_level):
-  zapi = ZabbixAPI(server=server, log_level=log_level)
-  zapi.login(username, password)
-  return zapi.apiinfo.version({})
+  # The version is remembered per server, so usually no request is sent.
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level, login=False)
+  return zapi.api_version()
 
 
 if __name__ == '__main__':
   parser = config.add_argparse_configs(argparse.ArgumentParser())
   args = parser.parse_args()
-  server = config.get_server_uri(args.server)
+  servers = config.get_server_uris(args.server, args.all_servers)
 
-  print (get_version(server, args.username,
-                     args.password, args.log_level))
+  if len(servers) == 1:
+    print (get_version(servers[0][1], args.username,
+                       args.password, args.log_level))
+  else:
+    results = fleet.run(lambda server: get_version(server, args.username,
+                                                   args.password,
+                                                   args.log_level),
+                        servers, args.server_timeout)
+    for line in fleet.format_report(results):
+      print(line)
+      pass
+    sys.exit(1 if fleet.failed(results) else 0)
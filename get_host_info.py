@@ -15,20 +15,34 @@
 #   limitations under the License.
 #
 
-from extlib.zabbix_api import ZabbixAPI
+from lib import aio_client
+from lib import checkpoint
+from lib import client
 from lib import config
+from lib import fleet
+from lib import metadata
+from lib import scheduler
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
 import pprint
+import re
+import sys
+import threading
+import time
 
 def get_host_info(server, username, password, log_level):
-  zapi = ZabbixAPI(server=server, log_level=log_level)
-  zapi.login(username, password)
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
 
-  responses = zapi.host.get({'output': 'extend'})
-  
-  hostid = responses[0]['hostid']
-  items = zapi.item.get({'hostids': hostid, 'output': 'extend'})
+  # Only the first host is needed; the rest is not downloaded.
+  hosts = zapi.stream('host.get', {'output': 'extend'})
+  hostid = next(hosts)['hostid']
+  hosts.close()
+  items = zapi.stream('item.get', {'hostids': hostid, 'output': 'extend'})
   for item in items:
     if 'name' in item: # 2.0
       print('"{}" (id: {}):'.format(item['name'], item['itemid']))
@@ -39,10 +53,309 @@ def get_host_info(server, username, password, log_level):
     pass
   pass
 
+
+def _hostids(zapi, pattern=None, group=None):
+  '''Returns ids of the hosts to export, in ascending order.'''
+  params = {'output': ['hostid']}
+  if pattern:
+    params['search'] = {'host': pattern}
+    params['searchWildcardsEnabled'] = True
+    pass
+  if group:
+    groups = zapi.hostgroup.get({'filter': {'name': [group]},
+                                 'output': ['groupid']})
+    if not groups:
+      raise ValueError('No host group "{}"'.format(group))
+    params['groupids'] = [g['groupid'] for g in groups]
+    pass
+  return sorted(int(h['hostid']) for h in zapi.stream('host.get', params))
+
+
+def _search_matches(value, pattern):
+  '''
+  Matches like host.get's search with searchWildcardsEnabled: ignoring
+  case, "*" as the only wildcard and, without one, anywhere in value.
+  '''
+  if '*' not in pattern:
+    return pattern.lower() in value.lower()
+  regex = '.*'.join(re.escape(part) for part in pattern.split('*'))
+  return re.match(regex + r'\Z', value, re.IGNORECASE | re.DOTALL) is not None
+
+
+def _hostids_from_cache(zapi, cache, pattern=None, group=None):
+  '''Same as _hostids(), from a metadata.MetadataCache.'''
+  cache.refresh(zapi, hostids=[])
+  if group:
+    if not cache.groups([group]):
+      raise ValueError('No host group "{}"'.format(group))
+    hosts = cache.hosts_in_groups([group])
+  else:
+    hosts = cache.hosts()
+    pass
+  if pattern:
+    hosts = [h for h in hosts if _search_matches(h['host'], pattern)]
+    pass
+  return sorted(int(h['hostid']) for h in hosts)
+
+
+_PAGE_HOSTS = {'output': 'extend',
+               'selectInterfaces': 'extend',
+               'selectGroups': ['groupid', 'name'],
+               'selectParentTemplates': ['templateid', 'host'],
+               'sortfield': 'hostid'}
+_PAGE_ITEMS = {'output': 'extend',
+               'sortfield': 'itemid'}
+
+
+def _page(hosts, items):
+  by_id = {}
+  for host in hosts:
+    host['items'] = []
+    by_id[host['hostid']] = host
+    pass
+  for item in items:
+    if item['hostid'] in by_id:
+      by_id[item['hostid']]['items'].append(item)
+      pass
+    pass
+  return sorted(hosts, key=lambda h: int(h['hostid']))
+
+
+def fetch_page(zapi, hostids):
+  '''
+  Returns hosts of hostids (ascending), each with its interfaces,
+  groups, templates and an "items" list ordered by itemid.
+  '''
+  hosts = zapi.host.get(dict(_PAGE_HOSTS, hostids=hostids))
+  return _page(hosts, zapi.stream('item.get',
+                                  dict(_PAGE_ITEMS, hostids=hostids)))
+
+
+async def fetch_page_async(azapi, hostids):
+  '''fetch_page() with an aio_client.AsyncZabbixClient.'''
+  (hosts, items) = await asyncio.gather(
+    azapi.host.get(dict(_PAGE_HOSTS, hostids=hostids)),
+    azapi.item.get(dict(_PAGE_ITEMS, hostids=hostids)))
+  return _page(hosts, items)
+
+
+def _iter_pages(zapi, pages, jobs):
+  '''
+  Yields (page, hosts) in page order while up to jobs pages are fetched
+  at once, each thread with its own clone of zapi.
+  '''
+  local = threading.local()
+
+  def fetch(page):
+    if not hasattr(local, 'zapi'):
+      local.zapi = zapi.clone()
+      pass
+    return fetch_page(local.zapi, page)
+
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    pending = []
+    for page in pages:
+      pending.append((page, executor.submit(fetch, page)))
+      if len(pending) >= max(1, jobs) * 2:
+        (done, future) = pending.pop(0)
+        yield (done, future.result())
+        pass
+      pass
+    while pending:
+      (done, future) = pending.pop(0)
+      yield (done, future.result())
+      pass
+    pass
+  pass
+
+
+def _iter_pages_aio(zapi, pages, jobs):
+  '''
+  Same as _iter_pages(), with the requests of up to jobs pages
+  pipelined over the connections of one aio_client client instead of
+  threads. Pages are fetched 2 * jobs at a time.
+  '''
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  azapi = aio_client.from_client(zapi)
+  try:
+    window = max(1, jobs) * 2
+    for i in range(0, len(pages), window):
+      batch = pages[i:i + window]
+      results = loop.run_until_complete(aio_client.gather(
+        [fetch_page_async(azapi, page) for page in batch], limit=jobs))
+      for (page, hosts) in zip(batch, results):
+        yield (page, hosts)
+        pass
+      pass
+  finally:
+    loop.run_until_complete(azapi.close())
+    asyncio.set_event_loop(None)
+    loop.close()
+    pass
+  pass
+
+
+def export_hosts(server, username, password, log_level, output,
+                 pattern=None, group=None, page_size=500, jobs=4,
+                 resume=False, metadata_max_age=None, quiet=False,
+                 aio=False):
+  '''
+  Writes every host (or those matching pattern / in group) with its
+  items to output as NDJSON, one host per line in hostid order.
+
+  Hosts are fetched page_size at a time by hostid, jobs pages at once.
+  After each page the position is saved to output + ".checkpoint";
+  with resume an interrupted export continues after the last saved page
+  instead of starting over. output "-" writes to stdout (no resume).
+  With metadata_max_age, the hosts to export are selected from
+  lib/metadata.py's cache. With aio, pages are fetched with pipelined
+  asyncio requests (lib/aio_client.py) instead of threads. Returns the
+  number of hosts written; quiet leaves out the progress on stderr.
+  '''
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
+  start_time = time.time()
+  if metadata_max_age is not None:
+    cache = metadata.MetadataCache(server, max_age=metadata_max_age)
+    hostids = _hostids_from_cache(zapi, cache, pattern, group)
+  else:
+    hostids = _hostids(zapi, pattern, group)
+    pass
+  page_size = max(1, page_size)
+
+  if output == '-':
+    progress = None
+    state = {}
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+  else:
+    progress = checkpoint.Checkpoint(output + '.checkpoint')
+    state = progress.load() if resume else {}
+    if state and (state.get('pattern'), state.get('group')) != (pattern,
+                                                               group):
+      raise ValueError('{} was written for other hosts ({}, {});'
+                       ' run without --resume to start over.'
+                       .format(output, state.get('pattern'),
+                               state.get('group')))
+    if state and os.path.exists(output):
+      out = open(output, 'r+b')
+      # Drop whatever was written after the last checkpoint.
+      out.truncate(state['output_bytes'])
+      out.seek(state['output_bytes'])
+    else:
+      state = {}
+      out = open(output, 'wb')
+      pass
+    pass
+
+  last_hostid = state.get('last_hostid', 0)
+  written = state.get('hosts', 0)
+  remaining = [h for h in hostids if h > last_hostid]
+  if state and not quiet:
+    sys.stderr.write('Resuming after hostid {} ({} hosts written)\n'
+                     .format(last_hostid, written))
+    pass
+  done = len(hostids) - len(remaining)
+  pages = [remaining[i:i + page_size]
+           for i in range(0, len(remaining), page_size)]
+  try:
+    iter_pages = _iter_pages_aio if aio else _iter_pages
+    for (page, hosts) in iter_pages(zapi, pages, jobs):
+      for host in hosts:
+        out.write((json.dumps(host, sort_keys=True) + '\n').encode('utf-8'))
+        pass
+      written += len(hosts)
+      out.flush()
+      if progress is not None:
+        os.fsync(out.fileno())
+        progress.save(last_hostid=page[-1], hosts=written,
+                      output_bytes=out.tell(), pattern=pattern,
+                      group=group)
+        pass
+      done += len(page)
+      if not quiet:
+        sys.stderr.write('{}/{} hosts\r'.format(done, len(hostids)))
+        pass
+      pass
+  finally:
+    if out is not getattr(sys.stdout, 'buffer', sys.stdout):
+      out.close()
+      pass
+    pass
+  if progress is not None:
+    progress.remove()
+    pass
+  if not quiet:
+    sys.stderr.write('\nExported {} hosts in {:.1f}s\n'
+                     .format(written, time.time() - start_time))
+    pass
+  return written
+
+
+def fleet_output(output, name):
+  '''Returns the file one server of several is exported to.'''
+  (root, ext) = os.path.splitext(output)
+  return '{}.{}{}'.format(root, re.sub(r'[^\w.-]+', '_', name).strip('_'),
+                          ext)
+
+
 if __name__ == '__main__':
   parser = config.add_argparse_configs(argparse.ArgumentParser())
+  parser.add_argument('--export', metavar='FILE',
+                      help=('Write all hosts with their items to FILE as'
+                            ' NDJSON ("-" for stdout) instead of showing'
+                            ' the items of the first host'))
+  parser.add_argument('--host-pattern',
+                      help='Only export hosts matching this glob (e.g. "web*")')
+  parser.add_argument('--group', help='Only export hosts in this host group')
+  parser.add_argument('--page-size', type=int, default=500,
+                      help='Hosts fetched with one host.get/item.get pair')
+  parser.add_argument('--jobs', '-j', type=int,
+                      help=('Pages fetched at the same time. Default: 4,'
+                            ' or 16 with --adaptive'))
+  parser.add_argument('--resume', action='store_true',
+                      help='Continue an interrupted --export')
+  parser.add_argument('--aio', action='store_true',
+                      help=('Fetch --export pages with pipelined asyncio'
+                            ' requests instead of threads'))
+  metadata.add_argument(parser)
+  scheduler.add_argument(parser)
   args = parser.parse_args()
-  server = config.get_server_uri(args.server)
+  if args.jobs is None:
+    args.jobs = 16 if args.adaptive else 4
+    pass
+  servers = config.get_server_uris(args.server, args.all_servers)
 
-  get_host_info(server, args.username,
-                args.password, args.log_level)
+  if len(servers) > 1:
+    if not args.export or args.export == '-':
+      parser.error('several servers need --export FILE')
+      pass
+    outputs = dict((uri, fleet_output(args.export, name))
+                   for (name, uri) in servers)
+    def export(server):
+      output = outputs[server]
+      return (export_hosts(server, args.username, args.password,
+                           args.log_level, output, args.host_pattern,
+                           args.group, args.page_size, args.jobs,
+                           args.resume, args.metadata_max_age, quiet=True,
+                           aio=args.aio),
+              output)
+    results = fleet.run(export, servers, args.server_timeout)
+    for line in fleet.format_report(
+        results, lambda value: '{} hosts to {}'.format(*value)):
+      print(line)
+      pass
+    print('Total: {} hosts'.format(sum(r.value[0] for r in results
+                                       if r.error is None)))
+    sys.exit(1 if fleet.failed(results) else 0)
+  server = servers[0][1]
+
+  if args.export:
+    export_hosts(server, args.username, args.password, args.log_level,
+                 args.export, args.host_pattern, args.group, args.page_size,
+                 args.jobs, args.resume, args.metadata_max_age,
+                 aio=args.aio)
+  else:
+    get_host_info(server, args.username,
+                  args.password, args.log_level)
+    pass
@@ -0,0 +1,416 @@
+'''
+asyncio version of lib/client.py.
+
+  zapi = await aio_client.get_client(server, username, password)
+  hosts = await zapi.host.get(output=['hostid'])
+  items = await aio_client.gather(
+    [zapi.item.get(hostids=[h['hostid']]) for h in hosts], limit=32)
+  await zapi.close()
+
+Requests go over a few keep-alive HTTP/1.1 connections and are
+pipelined: several requests are written to one connection before the
+first response comes back, and responses are matched in order. Only
+the standard library is used, so it works against any server speaking
+plain HTTP/1.1, including a local stand-in server.
+
+Auth tokens and versions are shared with lib/client.py through its
+SessionStore.
+'''
+
+import asyncio
+import itertools
+import json
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from lib import client
+from lib import retry
+from lib import scheduler
+from lib.client import APIError
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_PIPELINE = 8
+
+
+def _is_overload(error):
+  # Timeouts of wait_for() are no OSError before Python 3.11.
+  return (client.is_overload(error)
+          or isinstance(error, asyncio.TimeoutError))
+
+
+class _Connection(object):
+  '''
+  One HTTP/1.1 connection. Requests are written right away; a reader
+  task resolves their futures in the order responses arrive.
+  '''
+  def __init__(self, host, port, use_ssl, timeout):
+    self._host = host
+    self._port = port
+    self._ssl = ssl.create_default_context() if use_ssl else None
+    self._timeout = timeout
+    self._reader = None
+    self._writer = None
+    self._waiters = []
+    self._reader_task = None
+    self.closed = False
+    pass
+
+  @property
+  def in_flight(self):
+    return len(self._waiters)
+
+  async def open(self):
+    (self._reader, self._writer) = await asyncio.wait_for(
+      asyncio.open_connection(self._host, self._port, ssl=self._ssl),
+      self._timeout)
+    self._reader_task = asyncio.ensure_future(self._read_responses())
+    pass
+
+  async def request(self, request_bytes):
+    future = asyncio.get_event_loop().create_future()
+    self._waiters.append(future)
+    self._writer.write(request_bytes)
+    await self._writer.drain()
+    return await asyncio.wait_for(future, self._timeout)
+
+  async def _read_response(self):
+    status_line = await self._reader.readline()
+    if not status_line:
+      raise ConnectionError('Connection closed by server')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+      line = await self._reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      (name, _, value) = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+      pass
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await self._reader.readline()).split(b';')[0], 16)
+        if size == 0:
+          await self._reader.readline()
+          break
+        chunks.append(await self._reader.readexactly(size))
+        await self._reader.readexactly(2)
+        pass
+      body = b''.join(chunks)
+    else:
+      body = await self._reader.readexactly(
+        int(headers.get('content-length', 0)))
+      pass
+    if headers.get('connection', '').lower() == 'close':
+      self.closed = True
+      pass
+    return (status, body)
+
+  async def _read_responses(self):
+    error = ConnectionError('Connection closed by server')
+    try:
+      while not self.closed:
+        (status, body) = await self._read_response()
+        future = self._waiters.pop(0)
+        if future.done():
+          continue
+        if status != 200:
+          future.set_exception(APIError('HTTP {}'.format(status), status))
+        else:
+          future.set_result(body)
+          pass
+        pass
+    except (ConnectionError, asyncio.IncompleteReadError, OSError,
+            ValueError, IndexError) as e:
+      error = ConnectionError(str(e))
+      pass
+    finally:
+      # Requests pipelined behind a failure or a "Connection: close"
+      # will never be answered on this connection.
+      self.closed = True
+      for future in self._waiters:
+        if not future.done():
+          future.set_exception(error)
+          pass
+        pass
+      self._waiters = []
+      pass
+    pass
+
+  def close(self):
+    self.closed = True
+    if self._writer is not None:
+      self._writer.close()
+      pass
+    if self._reader_task is not None:
+      self._reader_task.cancel()
+      pass
+    pass
+  pass
+
+
+class ConnectionPool(object):
+  '''
+  Up to connections keep-alive connections with up to pipeline requests
+  in flight on each.
+  '''
+  def __init__(self, url, connections=DEFAULT_CONNECTIONS,
+               pipeline=DEFAULT_PIPELINE, timeout=30):
+    parts = urlsplit(url)
+    self._use_ssl = parts.scheme == 'https'
+    self._host = parts.hostname
+    self._port = parts.port or (443 if self._use_ssl else 80)
+    self._path = parts.path or '/'
+    self._netloc = parts.netloc
+    self._max_connections = max(1, connections)
+    self._pipeline = max(1, pipeline)
+    self._timeout = timeout
+    self._connections = []
+    self._available = asyncio.Condition()
+    pass
+
+  async def _connection(self):
+    async with self._available:
+      while True:
+        self._connections = [c for c in self._connections if not c.closed]
+        idle = [c for c in self._connections if c.in_flight == 0]
+        if idle:
+          return idle[0]
+        if len(self._connections) < self._max_connections:
+          conn = _Connection(self._host, self._port, self._use_ssl,
+                             self._timeout)
+          await conn.open()
+          self._connections.append(conn)
+          return conn
+        conn = min(self._connections, key=lambda c: c.in_flight)
+        if conn.in_flight < self._pipeline:
+          return conn
+        await self._available.wait()
+        pass
+      pass
+    pass
+
+  async def post(self, body):
+    request = ('POST {} HTTP/1.1\r\n'
+               'Host: {}\r\n'
+               'Content-Type: application/json-rpc\r\n'
+               'Content-Length: {}\r\n'
+               '\r\n').format(self._path, self._netloc, len(body))
+    conn = await self._connection()
+    try:
+      return await conn.request(request.encode('latin-1') + body)
+    finally:
+      async with self._available:
+        self._available.notify_all()
+        pass
+      pass
+    pass
+
+  def close(self):
+    for conn in self._connections:
+      conn.close()
+      pass
+    self._connections = []
+    pass
+  pass
+
+
+class _APIObject(object):
+  def __init__(self, client, name):
+    self._client = client
+    self._name = name
+    pass
+
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+    name = '{}.{}'.format(self._name, method)
+
+    async def call(*args, **kwargs):
+      if args and kwargs:
+        raise TypeError('Use either one positional argument or keywords')
+      if len(args) == 1 and isinstance(args[0], (dict, list)):
+        params = args[0]
+      else:
+        params = list(args) if args else kwargs
+        pass
+      return await self._client.call(name, params)
+    return call
+  pass
+
+
+class AsyncZabbixClient(object):
+  def __init__(self, server, username=None, password=None, store=None,
+               ttl=client.DEFAULT_TOKEN_TTL, connections=DEFAULT_CONNECTIONS,
+               pipeline=DEFAULT_PIPELINE, timeout=30):
+    self.server = server.rstrip('/')
+    self.url = self.server + '/api_jsonrpc.php'
+    self.username = username
+    self._password = password
+    self.store = store
+    self.ttl = ttl
+    self.pool = ConnectionPool(self.url, connections, pipeline, timeout)
+    self.auth = None
+    self._ids = itertools.count(1)
+    pass
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return _APIObject(self, name)
+
+  async def _send(self, method, send):
+    policy = retry.get()
+    if policy is None:
+      return await send()
+    return await policy.run_async(self.url, method, send, _is_overload)
+
+  async def do_request(self, method, params=None):
+    request = {'jsonrpc': '2.0',
+               'method': method,
+               'params': params if params is not None else {},
+               'id': next(self._ids),
+               }
+    if self.auth and method not in client._ANONYMOUS_METHODS:
+      request['auth'] = self.auth
+      pass
+    body = json.dumps(request)
+    client.logger.debug('Sending: {}'.format(body))
+    body = body.encode('utf-8')
+    start = time.time()
+    data = None
+    decode_seconds = 0.0
+    try:
+      async with scheduler.async_slot(self.url, method, params,
+                                      _is_overload) as call:
+        data = await self._send(method, lambda: self.pool.post(body))
+        call.answered()
+        pass
+      decode_start = time.time()
+      response = json.loads(data.decode('utf-8'))
+      decode_seconds = time.time() - decode_start
+    except Exception:
+      if client._hooks:
+        client._run_hooks(method, start, len(body),
+                          len(data) if data else 0, decode_seconds, True)
+        pass
+      raise
+    if client._hooks:
+      client._run_hooks(method, start, len(body), len(data), decode_seconds,
+                        'error' in response)
+      pass
+    client.logger.debug('Response: {}'.format(response))
+    if 'error' in response:
+      raise client._response_error(response['error'])
+    return response
+
+  async def call(self, method, params=None):
+    try:
+      return (await self.do_request(method, params))['result']
+    except APIError as e:
+      if (self._password is None or method in client._ANONYMOUS_METHODS
+          or not client._is_auth_error(e.message)):
+        raise
+      client.logger.debug('Token rejected ({}). Logging in again.'
+                          .format(e.message))
+      await self.login()
+      return (await self.do_request(method, params))['result']
+    pass
+
+  async def login(self, username=None, password=None):
+    if username is not None:
+      self.username = username
+      pass
+    if password is not None:
+      self._password = password
+      pass
+    if callable(self._password):
+      self._password = self._password()
+      pass
+    self.auth = None
+    self.auth = await self.call('user.login', {'user': self.username,
+                                               'password': self._password})
+    if self.store is not None:
+      self.store.update(self.server, self.username, auth=self.auth,
+                        login_time=time.time())
+      pass
+    return self.auth
+
+  async def ensure_login(self):
+    if self.store is not None:
+      entry = self.store.get(self.server, self.username)
+      if (entry.get('auth')
+          and time.time() - entry['login_time'] < self.ttl):
+        self.auth = entry['auth']
+        return self.auth
+      pass
+    return await self.login()
+
+  async def api_version(self):
+    if self.store is not None:
+      entry = self.store.get(self.server, self.username)
+      if (entry.get('version') and time.time() - entry['version_time']
+          < client.DEFAULT_VERSION_TTL):
+        return entry['version']
+      pass
+    version = await self.call('apiinfo.version', {})
+    if self.store is not None:
+      self.store.update(self.server, self.username, version=version,
+                        version_time=time.time())
+      pass
+    return version
+
+  async def close(self):
+    self.pool.close()
+    pass
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+    pass
+  pass
+
+
+async def get_client(server, username, password, store=None, login=True,
+                     **kwargs):
+  '''
+  Same as lib.client.get_client(), for asyncio. kwargs go to
+  AsyncZabbixClient (connections, pipeline, timeout, ttl).
+  '''
+  if store is None:
+    store = client.SessionStore()
+    pass
+  zapi = AsyncZabbixClient(server, username, password, store, **kwargs)
+  if login:
+    await zapi.ensure_login()
+    pass
+  return zapi
+
+
+async def gather(coros, limit=DEFAULT_CONNECTIONS * DEFAULT_PIPELINE):
+  '''
+  Like asyncio.gather(), but runs at most limit of coros at a time.
+  Results keep the order of coros.
+  '''
+  semaphore = asyncio.Semaphore(max(1, limit))
+
+  async def run(coro):
+    async with semaphore:
+      return await coro
+
+  return await asyncio.gather(*[run(c) for c in coros])
+
+
+def from_client(sync_client, **kwargs):
+  '''
+  Returns an AsyncZabbixClient reusing the server, credentials, session
+  store and token of a lib.client.ZabbixClient.
+  '''
+  zapi = AsyncZabbixClient(sync_client.server, sync_client.username,
+                           sync_client._password, sync_client.store,
+                           sync_client.ttl, **kwargs)
+  zapi.auth = sync_client.auth
+  return zapi
@@ -0,0 +1,44 @@
+'''
+Progress of a long export, kept next to its output so that an
+interrupted run can continue where it stopped.
+
+The state is a small JSON object, replaced atomically after each unit
+of work has been flushed to the output, so it never claims more than
+what is on disk.
+'''
+
+import json
+import os
+
+
+class Checkpoint(object):
+  def __init__(self, path):
+    self.path = path
+    pass
+
+  def load(self):
+    '''Returns the saved state, or {} when there is none.'''
+    try:
+      with open(self.path) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    pass
+
+  def save(self, **state):
+    tmp = '{}.{}'.format(self.path, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(state, f, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+      pass
+    os.rename(tmp, self.path)
+    pass
+
+  def remove(self):
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    pass
+  pass
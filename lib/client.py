@@ -0,0 +1,710 @@
+'''
+One Zabbix API client for every script in this repository.
+
+Scripts written against extlib.zabbix_api call methods with one dict
+(zapi.host.get({'output': 'extend'})), the ones written against pyzabbix
+with keyword arguments (zapi.host.get(output='extend')). ZabbixClient
+accepts both, and raises the exception classes of the library the
+script was written for (flavor "extlib" or "pyzabbix").
+
+On top of that it
+ - keeps HTTP connections alive and shares them between clients of the
+   same server (one connection per thread),
+ - remembers the auth token per server and user in a file, so that the
+   next run does not log in again until the token is older than ttl
+   or is rejected by the server (then it logs in again transparently),
+ - remembers apiinfo.version the same way.
+
+ZabbixClient.stream() decodes the result array of a large get while it
+is still downloading and yields its elements one by one.
+
+Use get_client() to build one.
+'''
+
+import codecs
+import contextlib
+import errno
+import fcntl
+import hashlib
+import http.client
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from lib import retry
+from lib import scheduler
+
+logger = logging.getLogger('zabbix_client')
+
+# Zabbix ends idle sessions after 30 minutes by default.
+DEFAULT_TOKEN_TTL = 15*60
+DEFAULT_VERSION_TTL = 24*60*60
+
+_HEADERS = {'Content-Type': 'application/json-rpc'}
+
+# Methods which must be called without "auth".
+_ANONYMOUS_METHODS = ('user.login', 'apiinfo.version')
+
+
+# Called after every request as hook(method, seconds, request_bytes,
+# response_bytes, decode_seconds, error); see lib/profiling.py.
+_hooks = []
+
+
+def add_hook(hook):
+  _hooks.append(hook)
+  pass
+
+
+def remove_hook(hook):
+  _hooks.remove(hook)
+  pass
+
+
+def _run_hooks(method, start, request_bytes, response_bytes, decode_seconds,
+               error):
+  seconds = time.time() - start
+  for hook in _hooks:
+    hook(method, seconds, request_bytes, response_bytes, decode_seconds,
+         error)
+    pass
+  pass
+
+
+class APIError(Exception):
+  def __init__(self, message, code=None, data=None):
+    Exception.__init__(self, message, code)
+    self.message = message
+    self.code = code
+    self.data = data
+    pass
+  pass
+
+
+def _is_auth_error(message):
+  message = message.lower()
+  return ('session terminated' in message or 're-login' in message
+          or 'not authori' in message)
+
+
+def _make_error(flavor, message, code):
+  '''Returns an exception of the library the calling script expects.'''
+  try:
+    if flavor == 'extlib':
+      from extlib.zabbix_api import ZabbixAPIException, Already_Exists
+      if 'already exist' in message.lower():
+        return Already_Exists(message, code)
+      return ZabbixAPIException(message, code)
+    elif flavor == 'pyzabbix':
+      from pyzabbix import ZabbixAPIException
+      return ZabbixAPIException(message, code)
+  except ImportError:
+    pass
+  return APIError(message, code)
+
+
+def is_overload(error):
+  '''
+  Whether a failed request tells more about the load of the server than
+  about the request: transport errors and HTTP 429/5xx, not API errors
+  nor calls refused by the circuit breaker of lib/retry.py.
+  '''
+  if isinstance(error, retry.CircuitOpenError):
+    return False
+  if isinstance(error, APIError):
+    return error.code in (429, 500, 502, 503, 504)
+  return isinstance(error, (socket.error, http.client.HTTPException))
+
+
+def _response_error(error):
+  message = '{} {}'.format(error.get('message', ''),
+                           error.get('data', '')).strip()
+  return APIError(message, error.get('code'), error.get('data'))
+
+
+class _JSONStream(object):
+  '''
+  Reads a JSON-RPC response from fp chunk by chunk. result() yields the
+  elements of its "result" array as soon as each one is complete; the
+  other members (e.g. "error") end up in members.
+  '''
+  def __init__(self, fp, chunk_size=64*1024):
+    self._fp = fp
+    self._chunk_size = chunk_size
+    self._text = codecs.getincrementaldecoder('utf-8')()
+    self._decoder = json.JSONDecoder()
+    self._buf = ''
+    self._pos = 0
+    self._eof = False
+    self.members = {}
+    self.bytes = 0
+    self.decode_seconds = 0.0
+    pass
+
+  def _fill(self):
+    data = self._fp.read(self._chunk_size)
+    if not data:
+      self._eof = True
+      return False
+    self.bytes += len(data)
+    self._buf = self._buf[self._pos:] + self._text.decode(data)
+    self._pos = 0
+    return True
+
+  def _peek(self):
+    '''Skips whitespace and returns the next character ('' at the end).'''
+    while True:
+      while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+        self._pos += 1
+        pass
+      if self._pos < len(self._buf):
+        return self._buf[self._pos]
+      if not self._fill():
+        return ''
+      pass
+    pass
+
+  def _expect(self, c):
+    if self._peek() != c:
+      raise ValueError('Expected "{}" at {} of the response'
+                       .format(c, self.bytes))
+    self._pos += 1
+    pass
+
+  def _value(self):
+    self._peek()
+    while True:
+      start = time.time()
+      try:
+        (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+        # A number at the end of the buffer may continue in the next chunk.
+        if end < len(self._buf) or self._eof:
+          self.decode_seconds += time.time() - start
+          self._pos = end
+          return value
+      except ValueError:
+        if self._eof:
+          raise
+        pass
+      self.decode_seconds += time.time() - start
+      self._fill()
+      pass
+    pass
+
+  def result(self):
+    self._expect('{')
+    while True:
+      c = self._peek()
+      if c == '}':
+        self._pos += 1
+        return
+      if c == ',':
+        self._pos += 1
+        continue
+      key = self._value()
+      self._expect(':')
+      if key == 'result' and self._peek() == '[':
+        self._pos += 1
+        while True:
+          c = self._peek()
+          if c == ']':
+            self._pos += 1
+            break
+          if c == ',':
+            self._pos += 1
+            continue
+          if c == '':
+            raise ValueError('Truncated response')
+          yield self._value()
+          pass
+        pass
+      else:
+        self.members[key] = self._value()
+        pass
+      pass
+    pass
+  pass
+
+
+def _is_stale(error):
+  '''
+  Whether error means the server had already closed a kept-alive
+  connection (no status line, reset, broken pipe), as opposed to a
+  timeout or an error after it may have handled the request.
+  '''
+  if isinstance(error, socket.timeout):
+    return False
+  if isinstance(error, http.client.BadStatusLine):
+    return True
+  return getattr(error, 'errno', None) in (errno.EPIPE, errno.ECONNRESET,
+                                           errno.ECONNABORTED)
+
+
+class ConnectionPool(object):
+  '''
+  Keep-alive connections to one API URL, one per thread.
+  '''
+  def __init__(self, url, timeout=30):
+    parts = urlsplit(url)
+    if parts.scheme == 'https':
+      self._connection_class = http.client.HTTPSConnection
+    else:
+      self._connection_class = http.client.HTTPConnection
+      pass
+    self._netloc = parts.netloc
+    self._path = parts.path or '/'
+    if parts.query:
+      self._path += '?' + parts.query
+      pass
+    self.timeout = timeout
+    self._local = threading.local()
+    pass
+
+  def _connection(self, fresh=False):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None or fresh:
+      if conn is not None:
+        conn.close()
+        pass
+      conn = self._connection_class(self._netloc, timeout=self.timeout)
+      self._local.conn = conn
+      pass
+    return conn
+
+  def _discard(self, conn):
+    '''Closes conn, which is in no state to be used again.'''
+    conn.close()
+    if getattr(self._local, 'conn', None) is conn:
+      self._local.conn = None
+      pass
+    pass
+
+  def post(self, body, headers, idempotent=True):
+    '''
+    Returns the body of the response to a POST of body. Only an
+    idempotent request is sent again, once, when the server turns out
+    to have closed the kept-alive connection; any other request gets a
+    fresh connection so that it is never sent twice.
+    '''
+    reused = getattr(self._local, 'conn', None) is not None
+    conn = self._connection(fresh=reused and not idempotent)
+    try:
+      try:
+        conn.request('POST', self._path, body, headers)
+        response = conn.getresponse()
+      except (http.client.HTTPException, socket.error) as e:
+        if not (reused and idempotent and _is_stale(e)):
+          raise
+        # The server closed an idle keep-alive connection; try once more.
+        conn = self._connection(fresh=True)
+        conn.request('POST', self._path, body, headers)
+        response = conn.getresponse()
+        pass
+      data = response.read()
+    except BaseException:
+      # E.g. after a timeout the connection is still waiting for an
+      # answer; the next call needs a new one.
+      self._discard(conn)
+      raise
+    if response.status != 200:
+      raise APIError('HTTP {} {}'.format(response.status, response.reason),
+                     response.status)
+    return data
+
+  def open(self, body, headers, idempotent=True):
+    '''
+    Like post(), but returns (connection, response) with the response
+    unread. The connection is taken out of the pool of this thread
+    meanwhile, so that other calls can be made while reading; give it
+    back with finishing().
+    '''
+    conn = getattr(self._local, 'conn', None)
+    self._local.conn = None
+    reused = conn is not None
+    if conn is not None and not idempotent:
+      conn.close()
+      conn = None
+      pass
+    if conn is None:
+      conn = self._connection_class(self._netloc, timeout=self.timeout)
+      pass
+    try:
+      try:
+        conn.request('POST', self._path, body, headers)
+        response = conn.getresponse()
+      except (http.client.HTTPException, socket.error) as e:
+        if not (reused and idempotent and _is_stale(e)):
+          raise
+        conn.close()
+        conn = self._connection_class(self._netloc, timeout=self.timeout)
+        conn.request('POST', self._path, body, headers)
+        response = conn.getresponse()
+        pass
+      if response.status != 200:
+        raise APIError('HTTP {} {}'.format(response.status, response.reason),
+                       response.status)
+    except BaseException:
+      conn.close()
+      raise
+    return (conn, response)
+
+  @contextlib.contextmanager
+  def finishing(self, conn, response):
+    '''
+    Gives response of open() to the block, then puts conn back in the
+    pool if the response was read to the end, or closes it.
+    '''
+    try:
+      yield response
+    except BaseException:
+      conn.close()
+      raise
+    if response.isclosed() and getattr(self._local, 'conn', None) is None:
+      self._local.conn = conn
+    else:
+      conn.close()
+      pass
+    pass
+
+  @contextlib.contextmanager
+  def response(self, body, headers):
+    '''open() and finishing() in one.'''
+    (conn, response) = self.open(body, headers)
+    with self.finishing(conn, response):
+      yield response
+      pass
+    pass
+  pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(url, timeout=30):
+  '''Returns the ConnectionPool shared by every client of url.'''
+  with _pools_lock:
+    if url not in _pools:
+      _pools[url] = ConnectionPool(url, timeout)
+      pass
+    return _pools[url]
+
+
+def default_store_path():
+  base = os.environ.get('XDG_CACHE_HOME',
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(base, 'zabbix_api_examples', 'sessions.json')
+
+
+class SessionStore(object):
+  '''
+  Auth tokens and API versions per server and user, in a JSON file only
+  readable by its owner.
+  '''
+  def __init__(self, path=None):
+    self.path = path or default_store_path()
+    pass
+
+  def _key(self, server, username):
+    return hashlib.sha1('{}\0{}'.format(server, username)
+                        .encode('utf-8')).hexdigest()
+
+  def _load(self):
+    try:
+      with open(self.path) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    pass
+
+  def get(self, server, username):
+    return self._load().get(self._key(server, username), {})
+
+  def update(self, server, username, **values):
+    directory = os.path.dirname(self.path)
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      pass
+    with open(self.path + '.lock', 'a') as lock:
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+      sessions = self._load()
+      key = self._key(server, username)
+      entry = sessions.get(key, {})
+      entry.update(values)
+      sessions[key] = entry
+      tmp = '{}.{}'.format(self.path, os.getpid())
+      fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'w') as f:
+        json.dump(sessions, f)
+        pass
+      os.rename(tmp, self.path)
+      pass
+    pass
+  pass
+
+
+class _APIObject(object):
+  def __init__(self, client, name):
+    self._client = client
+    self._name = name
+    pass
+
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+    name = '{}.{}'.format(self._name, method)
+
+    def call(*args, **kwargs):
+      if args and kwargs:
+        raise TypeError('Use either one positional argument or keywords')
+      if len(args) == 1 and isinstance(args[0], (dict, list)):
+        params = args[0]
+      elif args:
+        # pyzabbix sends positional arguments as an array,
+        # e.g. zapi.maintenance.delete(maintenanceid).
+        params = list(args)
+      else:
+        params = kwargs
+        pass
+      return self._client.call(name, params)
+    return call
+  pass
+
+
+class ZabbixClient(object):
+  def __init__(self, server, username=None, password=None, flavor=None,
+               store=None, ttl=DEFAULT_TOKEN_TTL, timeout=30):
+    self.server = server.rstrip('/')
+    self.url = self.server + '/api_jsonrpc.php'
+    self.username = username
+    self._password = password
+    self.flavor = flavor
+    self.store = store
+    self.ttl = ttl
+    self.pool = get_pool(self.url, timeout)
+    self.auth = None
+    self._ids = itertools.count(1)
+    pass
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return _APIObject(self, name)
+
+  def _encode(self, method, params):
+    request = {'jsonrpc': '2.0',
+               'method': method,
+               'params': params if params is not None else {},
+               'id': next(self._ids),
+               }
+    if self.auth and method not in _ANONYMOUS_METHODS:
+      request['auth'] = self.auth
+      pass
+    body = json.dumps(request)
+    logger.debug('Sending: {}'.format(body))
+    return body.encode('utf-8')
+
+  def _send(self, method, send, cleanup=None):
+    policy = retry.get()
+    if policy is None:
+      return send()
+    return policy.run(self.url, method, send, is_overload, cleanup)
+
+  def do_request(self, method, params=None):
+    '''Sends one JSON-RPC request and returns the whole response.'''
+    body = self._encode(method, params)
+    start = time.time()
+    data = None
+    decode_seconds = 0.0
+    try:
+      with scheduler.slot(self.url, method, params, is_overload) as call:
+        data = self._send(method, lambda: self.pool.post(
+          body, _HEADERS, retry.is_read_only(method)))
+        call.answered()
+        pass
+      decode_start = time.time()
+      response = json.loads(data.decode('utf-8'))
+      decode_seconds = time.time() - decode_start
+    except Exception:
+      if _hooks:
+        _run_hooks(method, start, len(body), len(data) if data else 0,
+                   decode_seconds, True)
+        pass
+      raise
+    if _hooks:
+      _run_hooks(method, start, len(body), len(data), decode_seconds,
+                 'error' in response)
+      pass
+    logger.debug('Response: {}'.format(response))
+    if 'error' in response:
+      raise _response_error(response['error'])
+    return response
+
+  def call(self, method, params=None):
+    '''
+    Calls method and returns its "result". When the server rejects the
+    remembered token, logs in again and retries once.
+    '''
+    try:
+      try:
+        return self.do_request(method, params)['result']
+      except APIError as e:
+        if (self._password is None or method in _ANONYMOUS_METHODS
+            or not _is_auth_error(e.message)):
+          raise
+        logger.debug('Token rejected ({}). Logging in again.'
+                     .format(e.message))
+        self.login()
+        return self.do_request(method, params)['result']
+    except APIError as e:
+      if self.flavor is None:
+        raise
+      raise _make_error(self.flavor, e.message, e.code)
+    pass
+
+  def _stream_request(self, method, params):
+    body = self._encode(method, params)
+    start = time.time()
+    with scheduler.slot(self.url, method, params, is_overload) as call:
+      (conn, response) = self._send(
+        method, lambda: self.pool.open(body, _HEADERS,
+                                       retry.is_read_only(method)),
+        lambda opened: opened[0].close())
+      call.answered()
+      with self.pool.finishing(conn, response):
+        stream = _JSONStream(response)
+        error = True
+        try:
+          for record in stream.result():
+            yield record
+            pass
+          error = 'error' in stream.members
+        finally:
+          if _hooks:
+            _run_hooks(method, start, len(body), stream.bytes,
+                       stream.decode_seconds, error)
+            pass
+          pass
+        pass
+      pass
+    if 'error' in stream.members:
+      raise _response_error(stream.members['error'])
+    pass
+
+  def stream(self, method, params=None):
+    '''
+    Like call() for methods returning an array (e.g. host.get), but
+    yields its elements while the response is still downloading, so that
+    memory stays flat however large the result is. Stopping early closes
+    the connection instead of reading the rest.
+    '''
+    try:
+      try:
+        for record in self._stream_request(method, params):
+          yield record
+          pass
+      except APIError as e:
+        # Errors come without a result, so nothing was yielded yet.
+        if (self._password is None or method in _ANONYMOUS_METHODS
+            or not _is_auth_error(e.message)):
+          raise
+        logger.debug('Token rejected ({}). Logging in again.'
+                     .format(e.message))
+        self.login()
+        for record in self._stream_request(method, params):
+          yield record
+          pass
+        pass
+    except APIError as e:
+      if self.flavor is None:
+        raise
+      raise _make_error(self.flavor, e.message, e.code)
+    pass
+
+  def login(self, username=None, password=None):
+    if username is not None:
+      self.username = username
+      pass
+    if password is not None:
+      self._password = password
+      pass
+    password = self._password
+    if callable(password):
+      # e.g. getpass; only asked for when a login is really needed.
+      password = self._password = password()
+      pass
+    self.auth = None
+    self.auth = self.call('user.login', {'user': self.username,
+                                         'password': password})
+    if self.store is not None:
+      self.store.update(self.server, self.username, auth=self.auth,
+                        login_time=time.time())
+      pass
+    return self.auth
+
+  def ensure_login(self):
+    '''Reuses a remembered token younger than ttl, or logs in.'''
+    if self.store is not None:
+      entry = self.store.get(self.server, self.username)
+      if entry.get('auth') and time.time() - entry['login_time'] < self.ttl:
+        self.auth = entry['auth']
+        return self.auth
+      pass
+    return self.login()
+
+  def api_version(self):
+    if self.store is not None:
+      entry = self.store.get(self.server, self.username)
+      if (entry.get('version')
+          and time.time() - entry['version_time'] < DEFAULT_VERSION_TTL):
+        return entry['version']
+      pass
+    version = self.call('apiinfo.version', {})
+    if self.store is not None:
+      self.store.update(self.server, self.username, version=version,
+                        version_time=time.time())
+      pass
+    return version
+
+  def clone(self):
+    '''
+    Returns another client sharing the connections and the token of this
+    one, e.g. for another thread.
+    '''
+    clone = ZabbixClient(self.server, self.username, self._password,
+                         self.flavor, self.store, self.ttl,
+                         self.pool.timeout)
+    clone.auth = self.auth
+    return clone
+  pass
+
+
+def get_client(server, username, password, flavor=None, log_level=0,
+               ttl=DEFAULT_TOKEN_TTL, store=None, login=True):
+  '''
+  Returns a ZabbixClient for server, logged in with a remembered token
+  when possible. password may be a callable (e.g. asking with getpass),
+  called only if a login is actually needed.
+  '''
+  if log_level:
+    logger.setLevel(log_level)
+    if not logger.handlers:
+      logger.addHandler(logging.StreamHandler())
+      pass
+    pass
+  if store is None:
+    store = SessionStore()
+    pass
+  client = ZabbixClient(server, username, password, flavor, store, ttl)
+  if login:
+    client.ensure_login()
+    pass
+  return client
@@ -3,6 +3,9 @@ Secret config file.
 '''
 
 from lib import defaults
+from lib import fleet
+from lib import profiling
+from lib import retry
 
 _servers = defaults._servers
 server = defaults._default_server
@@ -13,9 +16,11 @@ log_level = defaults._log_level
 def add_argparse_configs(parser, require_server=True):
   server_help = ('Specify full server URI '
                  '(e.g. "http://www.example.com/zabbix"), or '
-                 'a shortcut name specified in your config file.')
+                 'a shortcut name specified in your config file. '
+                 'Several of them may be separated by commas.')
   if require_server:
-    parser.add_argument('server', help=server_help, default=server)
+    parser.add_argument('server', help=server_help, default=server,
+                        nargs='?')
   else:
     parser.add_argument('--server', '-s', help=server_help, default=server)
     pass
@@ -29,6 +34,9 @@ def add_argparse_configs(parser, require_server=True):
   parser.add_argument('--log-level', '-l', type=int,
                       help='Set the log level for Zabbix API.',
                       default=log_level)
+  fleet.add_argument(parser)
+  profiling.add_argument(parser)
+  retry.add_argument(parser)
   return parser
 
 
@@ -38,3 +46,13 @@ def get_server_uri(name):
   else:
     return name
 
+
+def get_server_uris(spec, all_servers=False):
+  '''
+  Returns [(name, uri)] of the comma-separated servers in spec, or of
+  every server in your config file with all_servers.
+  '''
+  if all_servers:
+    return sorted(_servers.items())
+  names = [name.strip() for name in (spec or '').split(',') if name.strip()]
+  return [(name, get_server_uri(name)) for name in names]
@@ -0,0 +1,326 @@
+'''
+A local server running the scripts of this repository in forked
+children of one long-lived process (see "zbx daemon").
+
+The daemon imports the heavy modules (NumPy, the API clients, ...) once.
+For each invocation, zbx sends its argv, working directory and
+environment over a Unix socket together with its stdin/stdout/stderr
+file descriptors; a forked child adopts them, runs the script and
+sends back the exit status. Interpreter start-up and imports are then
+paid once instead of on every run, and auth tokens come from
+lib/client.py's session store as usual.
+
+Only the standard library is imported here, so that zbx stays cheap
+to start when it just forwards a command.
+'''
+
+import array
+import atexit
+import importlib
+import json
+import os
+import runpy
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# Imported by the daemon before it accepts connections.
+PRELOAD = ['argparse', 'asyncio', 'concurrent.futures', 'csv', 'getpass',
+           'logging', 'lib.client', 'lib.aio_client', 'lib.profiling',
+           'lib.records', 'lib.checkpoint', 'lib.metadata', 'lib.fleet',
+           'lib.retry', 'lib.scheduler', 'lib.size_model',
+           'lib.resolution', 'lib.history', 'lib.history_cache',
+           'lib.history_export', 'lib.render', 'lib.config']
+
+_MAX_HEADER = 1024 * 1024
+
+# Seconds a child is given to unwind after its caller went away.
+_INTERRUPT_GRACE = 5
+
+# Held by the thread ending a child, see _exit.
+_exiting = threading.Lock()
+
+
+def socket_path():
+  base = os.environ.get('XDG_CACHE_HOME',
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(base, 'zabbix_api_examples', 'zbx.sock')
+
+
+def _send(conn, message, fds=()):
+  data = (json.dumps(message) + '\n').encode('utf-8')
+  if fds:
+    conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           array.array('i', fds))])
+  else:
+    conn.sendall(data)
+    pass
+  pass
+
+
+def _receive(conn):
+  '''Returns (message, fds) of one line sent by _send().'''
+  fds = array.array('i')
+  (data, ancdata, _, _) = conn.recvmsg(
+    65536, socket.CMSG_SPACE(3 * fds.itemsize))
+  for (level, kind, payload) in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+      pass
+    pass
+  while data and not data.endswith(b'\n') and len(data) < _MAX_HEADER:
+    more = conn.recv(65536)
+    if not more:
+      break
+    data += more
+    pass
+  if not data:
+    return (None, list(fds))
+  return (json.loads(data.decode('utf-8')), list(fds))
+
+
+def run_remote(script, argv):
+  '''
+  Runs script with argv in the daemon and returns its exit status, or
+  None when no daemon is listening.
+  '''
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(socket_path())
+  except (IOError, OSError):
+    conn.close()
+    return None
+  try:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _send(conn, {'script': script, 'argv': argv, 'cwd': os.getcwd(),
+                 'env': dict(os.environ)}, fds=[0, 1, 2])
+    (reply, _) = _receive(conn)
+  except KeyboardInterrupt:
+    # Closing conn below interrupts the child too (see _watch_caller()).
+    return 130
+  finally:
+    conn.close()
+    pass
+  if reply is None:
+    sys.stderr.write('zbx daemon went away\n')
+    return 1
+  return reply['status']
+
+
+def run_script(script, argv):
+  '''Runs script as __main__ with argv; returns its exit status.'''
+  sys.argv = [script] + list(argv)
+  sys.path[0] = os.path.dirname(os.path.abspath(script))
+  try:
+    runpy.run_path(script, run_name='__main__')
+  except SystemExit as e:
+    if e.code is None:
+      return 0
+    if isinstance(e.code, int):
+      return e.code
+    sys.stderr.write('{}\n'.format(e.code))
+    return 1
+  except KeyboardInterrupt:
+    return 130
+  except Exception:
+    traceback.print_exc()
+    return 1
+  return 0
+
+
+def _watch_caller(conn):
+  '''
+  Interrupts this child once its caller closes conn, i.e. when zbx was
+  stopped with Ctrl-C or a signal, so that the script stops calling the
+  API and writing to the caller's terminal. A script which does not
+  unwind within _INTERRUPT_GRACE seconds is ended.
+  '''
+  try:
+    data = conn.recv(1)
+  except (IOError, OSError):
+    data = b''
+    pass
+  if data:
+    # The caller sends nothing after the request; ignore it.
+    return
+  os.kill(os.getpid(), signal.SIGINT)
+  time.sleep(_INTERRUPT_GRACE)
+  _exit(130)
+  pass
+
+
+def _exit(status, conn=None):
+  '''
+  Ends this process like a normal exit would, which os._exit alone does
+  not: atexit handlers run (e.g. the --profile report of
+  lib/profiling.py) and stdout/stderr are flushed. The status is then
+  sent on conn, if any. Only the first thread to get here does so.
+  '''
+  _exiting.acquire()
+  # The caller closes conn once it has the status; that is no
+  # interruption.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  try:
+    atexit._run_exitfuncs()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    except (IOError, OSError):
+      pass
+    if conn is not None:
+      try:
+        _send(conn, {'status': status})
+      except (IOError, OSError):
+        pass
+      pass
+    os._exit(status)
+    pass
+  pass
+
+
+def _child(conn, request, fds):
+  for (target, fd) in enumerate(fds[:3]):
+    os.dup2(fd, target)
+    pass
+  for fd in fds:
+    if fd > 2:
+      os.close(fd)
+      pass
+    pass
+  signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.default_int_handler)
+  watcher = threading.Thread(target=_watch_caller, args=(conn,),
+                             name='zbx-caller')
+  watcher.daemon = True
+  watcher.start()
+  for stream in (sys.stdout, sys.stderr):
+    if hasattr(stream, 'reconfigure'):
+      # The daemon's own stdout was not a terminal; the caller's may be.
+      stream.reconfigure(line_buffering=stream.isatty())
+      pass
+    pass
+  os.chdir(request['cwd'])
+  os.environ.clear()
+  os.environ.update(request['env'])
+  status = 1
+  try:
+    status = run_script(request['script'], request['argv'])
+  finally:
+    _exit(status, conn)
+    pass
+  pass
+
+
+def serve(path=None, preload=PRELOAD):
+  '''Accepts invocations on the Unix socket path until "stop".'''
+  path = path or socket_path()
+  for name in preload:
+    try:
+      importlib.import_module(name)
+    except ImportError:
+      pass
+    pass
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+    pass
+  if os.path.exists(path):
+    os.remove(path)
+    pass
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0o077)
+  try:
+    server.bind(path)
+  finally:
+    os.umask(old_umask)
+    pass
+  server.listen(64)
+  # Children are reaped automatically.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    while True:
+      (conn, _) = server.accept()
+      try:
+        (request, fds) = _receive(conn)
+      except (IOError, OSError, ValueError):
+        conn.close()
+        continue
+      if request is None:
+        conn.close()
+        continue
+      if request.get('command') == 'stop':
+        _send(conn, {'status': 0})
+        conn.close()
+        break
+      if request.get('command') == 'status':
+        _send(conn, {'status': 0, 'pid': os.getpid()})
+        conn.close()
+        continue
+      if os.fork() == 0:
+        server.close()
+        _child(conn, request, fds)
+        pass
+      for fd in fds:
+        os.close(fd)
+        pass
+      conn.close()
+      pass
+  finally:
+    server.close()
+    if os.path.exists(path):
+      os.remove(path)
+      pass
+    pass
+  pass
+
+
+def command(name):
+  '''Sends "stop" or "status" to the daemon; returns its reply or None.'''
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(socket_path())
+    _send(conn, {'command': name})
+    return _receive(conn)[0]
+  except (IOError, OSError):
+    return None
+  finally:
+    conn.close()
+    pass
+  pass
+
+
+def start(foreground=False):
+  '''Starts serve() detached from the terminal, unless foreground.'''
+  if foreground:
+    serve()
+    return
+  pid = os.fork()
+  if pid != 0:
+    os.waitpid(pid, 0)
+    # Returns once the daemon answers, so that the next zbx uses it.
+    deadline = time.time() + 10
+    while command('status') is None and time.time() < deadline:
+      time.sleep(0.05)
+      pass
+    return
+  os.setsid()
+  if os.fork() != 0:
+    # Only forked to detach; the handlers are zbx's, which runs them.
+    os._exit(0)
+    pass
+  devnull = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1, 2):
+    os.dup2(devnull, fd)
+    pass
+  try:
+    serve()
+  finally:
+    _exit(0)
+    pass
+  pass
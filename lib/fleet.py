@@ -0,0 +1,115 @@
+'''
+Running one operation against several Zabbix servers at once.
+
+  servers = config.get_server_uris('ad,centos64')  # or all_servers=True
+  results = fleet.run(lambda uri: get_version(uri, ...), servers,
+                      timeout=30)
+  for line in fleet.format_report(results):
+    print(line)
+
+Every server is handled in a thread of its own and all of them share one
+deadline: a server still busy when it passes is reported as timed out,
+without delaying the others. Those threads are daemons, so a hung server
+does not keep the process alive either.
+'''
+
+import threading
+import time
+
+from lib import records
+
+DEFAULT_TIMEOUT = 120
+
+Result = records.record_type('Result', ['name', 'server', 'value', 'error',
+                                        'seconds'])
+
+
+def add_argument(parser):
+  parser.add_argument('--all-servers', action='store_true',
+                      help=('Run against every server of the config file'
+                            ' at once (a comma-separated server list does'
+                            ' the same for those servers).'))
+  parser.add_argument('--server-timeout', type=float, metavar='SECONDS',
+                      default=DEFAULT_TIMEOUT,
+                      help=('With several servers, give up on a server'
+                            ' after SECONDS (default: %(default)s).'))
+  return parser
+
+
+def run(func, servers, timeout=DEFAULT_TIMEOUT):
+  '''
+  Calls func(uri) for every (name, uri) of servers concurrently and
+  returns a Result per server, in the same order. An exception raised by
+  func, or not finishing within timeout seconds, becomes Result.error.
+  '''
+  lock = threading.Lock()
+  results = []
+  for (name, server) in servers:
+    results.append(Result.from_dict({'name': name, 'server': server}))
+    pass
+  finished = [threading.Event() for _ in results]
+  start = time.time()
+
+  def target(i):
+    try:
+      value = func(results[i].server)
+      error = None
+    except Exception as e:
+      value = None
+      error = '{}: {}'.format(type(e).__name__, e)
+      pass
+    with lock:
+      if not finished[i].is_set():
+        results[i].value = value
+        results[i].error = error
+        results[i].seconds = time.time() - start
+        finished[i].set()
+        pass
+      pass
+    pass
+
+  for i in range(len(results)):
+    thread = threading.Thread(target=target, args=(i,),
+                              name='fleet-{}'.format(results[i].name))
+    thread.daemon = True
+    thread.start()
+    pass
+  deadline = start + timeout
+  for (i, event) in enumerate(finished):
+    event.wait(max(0, deadline - time.time()))
+    with lock:
+      if not event.is_set():
+        results[i].error = 'timed out after {:g}s'.format(timeout)
+        results[i].seconds = time.time() - start
+        event.set()
+        pass
+      pass
+    pass
+  return results
+
+
+def format_report(results, describe=str):
+  '''
+  Returns lines of a table with one row per server: its name, how long
+  it took and describe(value), or the error.
+  '''
+  width = max([len('server')] + [len(r.name) for r in results])
+  row = '{:<' + str(width) + '} {:>8}  {}'
+  lines = [row.format('server', 'seconds', 'result')]
+  for result in results:
+    if result.error is None:
+      text = describe(result.value)
+    else:
+      text = 'ERROR ' + result.error
+      pass
+    lines.append(row.format(result.name, '{:.2f}'.format(result.seconds),
+                            text))
+    pass
+  failed = sum(1 for r in results if r.error is not None)
+  lines.append('{} servers, {} ok, {} failed'
+               .format(len(results), len(results) - failed, failed))
+  return lines
+
+
+def failed(results):
+  return [r for r in results if r.error is not None]
@@ -0,0 +1,139 @@
+'''
+Helpers to fetch long ranges of item history without asking the
+Zabbix server for everything at once.
+
+A range is split into time shards, each fetched with its own
+history.get. Up to max_workers shards are in flight at the same time,
+and rows are handed back shard by shard in time order, so callers can
+write them out while later shards are still downloading.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import re
+import threading
+import time
+
+# -30d, -6h, -90m, ...
+r_relative = re.compile(r'^-(\d+)([smhdw])$')
+_units = {'s': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60, 'w': 7*24*60*60}
+_time_formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def parse_time(value, now=None):
+  '''
+  Accepts "now", a unix time, a relative time like "-30d" or "-6h",
+  or a local date like "2013-06-06" / "2013-06-06 12:00".
+  '''
+  if now is None:
+    now = int(time.time())
+    pass
+  value = value.strip()
+  if value == 'now':
+    return now
+  if value.isdigit():
+    return int(value)
+  m = r_relative.match(value)
+  if m:
+    return now - int(m.group(1)) * _units[m.group(2)]
+  for time_format in _time_formats:
+    try:
+      return int(time.mktime(datetime.strptime(value, time_format)
+                             .timetuple()))
+    except ValueError:
+      pass
+    pass
+  raise ValueError('Unknown time format: "{}"'.format(value))
+
+
+def shard_range(time_from, time_till, shard_seconds):
+  '''
+  Splits [time_from, time_till] into non-overlapping inclusive ranges,
+  matching the inclusive time_from/time_till of history.get.
+  '''
+  shards = []
+  start = time_from
+  while start <= time_till:
+    end = min(start + shard_seconds - 1, time_till)
+    shards.append((start, end))
+    start = end + 1
+    pass
+  return shards
+
+
+class ShardedHistoryFetcher(object):
+  '''
+  Fetches history of one item shard by shard.
+
+  make_api is called once per worker thread and must return a logged-in
+  API object (e.g. ZabbixClient.clone of lib/client.py).
+  '''
+  def __init__(self, make_api, itemid, value_type=0,
+               shard_seconds=6*60*60, max_workers=4,
+               method='history', output=None):
+    self._make_api = make_api
+    self._local = threading.local()
+    self.itemid = itemid
+    self.value_type = int(value_type)
+    self.shard_seconds = max(1, int(shard_seconds))
+    self.max_workers = max(1, int(max_workers))
+    self.method = method
+    self.output = output or ['clock', 'value']
+    pass
+
+  def _api(self):
+    if not hasattr(self._local, 'zapi'):
+      self._local.zapi = self._make_api()
+      pass
+    return self._local.zapi
+
+  def fetch_shard(self, shard):
+    (time_from, time_till) = shard
+    # See: https://www.zabbix.com/documentation/2.0/manual/appendix/api/history/get
+    params = {'itemids': [self.itemid],
+              'output': self.output,
+              'time_from': time_from,
+              'time_till': time_till,
+              }
+    if self.method == 'history':
+      params['history'] = self.value_type
+      params['sortfield'] = 'clock'
+      params['sortorder'] = 'ASC'
+      pass
+    rows = getattr(self._api(), self.method).get(params)
+    if self.method != 'history':
+      # Only history.get sorts; trend.get rejects sortfield.
+      rows.sort(key=lambda row: int(row['clock']))
+      pass
+    return rows
+
+  def iter_shards(self, time_from, time_till):
+    '''
+    Yields the rows of each shard as a list, in time order. At most
+    max_workers requests run at once, and at most twice that many
+    shards are held in memory.
+    '''
+    shards = shard_range(time_from, time_till, self.shard_seconds)
+    window = self.max_workers * 2
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      pending = []
+      for shard in shards:
+        pending.append(executor.submit(self.fetch_shard, shard))
+        if len(pending) >= window:
+          yield pending.pop(0).result()
+          pass
+        pass
+      while pending:
+        yield pending.pop(0).result()
+        pass
+      pass
+    pass
+
+  def iter_rows(self, time_from, time_till):
+    for rows in self.iter_shards(time_from, time_till):
+      for row in rows:
+        yield row
+        pass
+      pass
+    pass
+  pass
@@ -0,0 +1,234 @@
+'''
+On-disk cache of numeric item history, so that plotting the same item
+again only downloads what is newer than the last run.
+
+Each item has three files in a per-server directory:
+
+  <itemid>.clock  int64 clocks, append-only
+  <itemid>.value  float64 values, append-only
+  <itemid>.meta   JSON with the covered time range and the row count
+
+The .clock/.value files are plain little-endian arrays which are read
+back with numpy.memmap. Rows are appended before .meta is rewritten,
+so rows past the count in .meta (left by a crashed writer) are simply
+ignored and truncated by the next writer.
+
+An exclusive flock() on <itemid>.lock serializes writers; readers take
+a shared lock. Eviction removes least recently used items once the
+whole cache grows past max_bytes.
+'''
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+_CLOCK_DTYPE = np.dtype('<i8')
+_VALUE_DTYPE = np.dtype('<f8')
+
+# Values may arrive late (e.g. through proxies), so the newest minutes
+# are always fetched from the server and never cached.
+_SETTLE_SECONDS = 5*60
+
+
+def default_cache_dir():
+  base = os.environ.get('XDG_CACHE_HOME',
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(base, 'zabbix_api_examples', 'history')
+
+
+class _Lock(object):
+  def __init__(self, path, exclusive):
+    self._path = path
+    self._exclusive = exclusive
+    self._f = None
+    pass
+
+  def __enter__(self):
+    self._f = open(self._path, 'a')
+    fcntl.flock(self._f.fileno(),
+                fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH)
+    return self
+
+  def __exit__(self, *exc):
+    fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+    self._f.close()
+    pass
+  pass
+
+
+class HistoryCache(object):
+  def __init__(self, server, cache_dir=None, max_bytes=512*1024*1024):
+    if cache_dir is None:
+      cache_dir = default_cache_dir()
+      pass
+    digest = hashlib.sha1(server.encode('utf-8')).hexdigest()[:16]
+    self.directory = os.path.join(cache_dir, digest)
+    self.max_bytes = max_bytes
+    try:
+      os.makedirs(self.directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      pass
+    pass
+
+  def _path(self, itemid, suffix):
+    return os.path.join(self.directory, '{}.{}'.format(itemid, suffix))
+
+  def _read_meta(self, itemid):
+    try:
+      with open(self._path(itemid, 'meta')) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    pass
+
+  def _write_meta(self, itemid, meta):
+    path = self._path(itemid, 'meta')
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(meta, f)
+      pass
+    os.rename(tmp, path)
+    pass
+
+  def _append(self, itemid, meta, clocks, values, covered_till):
+    count = meta['count']
+    for (suffix, array, dtype) in (('clock', clocks, _CLOCK_DTYPE),
+                                   ('value', values, _VALUE_DTYPE)):
+      with open(self._path(itemid, suffix), 'ab') as f:
+        # Drop rows left behind by a writer that died before its .meta.
+        f.truncate(count * dtype.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(np.asarray(array, dtype=dtype).tobytes())
+        pass
+      pass
+    meta = dict(meta, count=count + len(clocks), covered_till=covered_till)
+    self._write_meta(itemid, meta)
+    return meta
+
+  def _reset(self, itemid, covered_from):
+    for suffix in ('clock', 'value'):
+      with open(self._path(itemid, suffix), 'wb'):
+        pass
+      pass
+    meta = {'covered_from': covered_from, 'covered_till': covered_from - 1,
+            'count': 0}
+    self._write_meta(itemid, meta)
+    return meta
+
+  def _update(self, itemid, fetch, time_from, stable_till):
+    '''Makes the cache of itemid cover [time_from, stable_till].'''
+    with _Lock(self._path(itemid, 'lock'), exclusive=True):
+      meta = self._read_meta(itemid)
+      if meta is None or time_from < meta['covered_from']:
+        # Older data than cached is asked for; files are append-only.
+        meta = self._reset(itemid, time_from)
+      elif (time_from - (meta['covered_till'] + 1)
+            > stable_till - time_from + 1):
+        # Filling the gap since the cached range would cost more than
+        # the range asked for (e.g. the last hour of an item cached
+        # months ago); start over from time_from instead.
+        meta = self._reset(itemid, time_from)
+        pass
+      if stable_till > meta['covered_till']:
+        (clocks, values) = fetch(meta['covered_till'] + 1, stable_till)
+        meta = self._append(itemid, meta, clocks, values, stable_till)
+        pass
+      pass
+    pass
+
+  def _read(self, itemid, time_from, time_till):
+    with _Lock(self._path(itemid, 'lock'), exclusive=False):
+      meta = self._read_meta(itemid)
+      count = meta['count'] if meta else 0
+      if count == 0:
+        return (np.zeros(0, dtype=_CLOCK_DTYPE),
+                np.zeros(0, dtype=_VALUE_DTYPE))
+      clocks = np.memmap(self._path(itemid, 'clock'), dtype=_CLOCK_DTYPE,
+                         mode='r', shape=(count,))
+      values = np.memmap(self._path(itemid, 'value'), dtype=_VALUE_DTYPE,
+                         mode='r', shape=(count,))
+      start = np.searchsorted(clocks, time_from, side='left')
+      end = np.searchsorted(clocks, time_till, side='right')
+      return (np.array(clocks[start:end]), np.array(values[start:end]))
+    pass
+
+  def get(self, itemid, fetch, time_from, time_till, now=None):
+    '''
+    Returns (clocks, values) of itemid between time_from and time_till.
+
+    fetch(time_from, time_till) must return (clocks, values) sorted by
+    clock for the given inclusive range, and is only called for what is
+    not cached yet plus the last few unsettled minutes.
+    '''
+    if now is None:
+      now = int(time.time())
+      pass
+    stable_till = min(time_till, now - _SETTLE_SECONDS)
+    if stable_till >= time_from:
+      self._update(itemid, fetch, time_from, stable_till)
+      (clocks, values) = self._read(itemid, time_from, stable_till)
+      try:
+        # Reads count as use for eviction.
+        os.utime(self._path(itemid, 'meta'), None)
+      except OSError:
+        pass
+    else:
+      stable_till = time_from - 1
+      clocks = np.zeros(0, dtype=_CLOCK_DTYPE)
+      values = np.zeros(0, dtype=_VALUE_DTYPE)
+      pass
+    if time_till > stable_till:
+      (tail_clocks, tail_values) = fetch(stable_till + 1, time_till)
+      clocks = np.concatenate([clocks, np.asarray(tail_clocks,
+                                                  dtype=_CLOCK_DTYPE)])
+      values = np.concatenate([values, np.asarray(tail_values,
+                                                  dtype=_VALUE_DTYPE)])
+      pass
+    self.evict(keep=itemid)
+    return (clocks, values)
+
+  def evict(self, keep=None):
+    '''
+    Removes least recently used items until the cache fits in
+    max_bytes. keep is never removed.
+    '''
+    sizes = {}
+    used = {}
+    for name in os.listdir(self.directory):
+      (itemid, _, suffix) = name.partition('.')
+      if suffix not in ('clock', 'value', 'meta'):
+        continue
+      try:
+        st = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      sizes[itemid] = sizes.get(itemid, 0) + st.st_size
+      if suffix == 'meta':
+        used[itemid] = st.st_mtime
+        pass
+      pass
+    total = sum(sizes.values())
+    for itemid in sorted(sizes, key=lambda i: used.get(i, 0)):
+      if total <= self.max_bytes:
+        break
+      if itemid == keep:
+        continue
+      with _Lock(self._path(itemid, 'lock'), exclusive=True):
+        for suffix in ('clock', 'value', 'meta'):
+          try:
+            os.unlink(self._path(itemid, suffix))
+          except OSError:
+            pass
+          pass
+        pass
+      total -= sizes[itemid]
+      pass
+    pass
+  pass
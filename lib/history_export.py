@@ -0,0 +1,192 @@
+'''
+Raw history (or trends) of many items written as compressed NumPy
+files, one per item and day:
+
+  <directory>/items.json                  the exported items
+  <directory>/<itemid>/<YYYY-MM-DD>.npz   columns of that UTC day
+
+A history file holds int64 "clock" and "ns" and a "value" column
+(float64 for numeric float items, uint64 for numeric unsigned ones);
+a trend file holds "clock", "num", "value_min", "value_avg" and
+"value_max". Read one back with numpy.load().
+
+Work is split into units of one day and up to items_per_call items of
+one value type, each fetched with a single streamed history.get (or
+trend.get). Rows are packed into typed arrays as they arrive and a
+unit's files are written as soon as it is complete, so memory holds a
+few units at most.
+'''
+
+import array
+import json
+import os
+import time
+
+import numpy as np
+
+DAY_SECONDS = 24*60*60
+
+# Numeric float and numeric unsigned; the only types trends exist for.
+NUMERIC_TYPES = ('0', '3')
+
+_HISTORY_FIELDS = ['clock', 'ns', 'value']
+_TREND_FIELDS = ['clock', 'num', 'value_min', 'value_avg', 'value_max']
+
+
+def day_range(time_from, time_till):
+  '''
+  Splits [time_from, time_till] at UTC midnights into inclusive
+  (time_from, time_till) ranges.
+  '''
+  days = []
+  start = time_from
+  while start <= time_till:
+    end = min(start - start % DAY_SECONDS + DAY_SECONDS - 1, time_till)
+    days.append((start, end))
+    start = end + 1
+    pass
+  return days
+
+
+def day_name(clock):
+  return time.strftime('%Y-%m-%d', time.gmtime(clock))
+
+
+class Unit(object):
+  '''One day of up to items_per_call items of one value type.'''
+  __slots__ = ['time_from', 'time_till', 'value_type', 'itemids']
+
+  def __init__(self, time_from, time_till, value_type, itemids):
+    self.time_from = time_from
+    self.time_till = time_till
+    self.value_type = value_type
+    self.itemids = itemids
+    pass
+
+  def __repr__(self):
+    return 'Unit({}, {} items)'.format(day_name(self.time_from),
+                                       len(self.itemids))
+  pass
+
+
+def make_units(items, time_from, time_till, items_per_call):
+  '''
+  Returns the Units covering items (dicts with itemid and value_type)
+  over the range, day by day so that an export completes in time order.
+  '''
+  by_type = {}
+  for item in items:
+    by_type.setdefault(str(item['value_type']), []).append(item['itemid'])
+    pass
+  units = []
+  for (day_from, day_till) in day_range(time_from, time_till):
+    for value_type in sorted(by_type):
+      itemids = by_type[value_type]
+      for i in range(0, len(itemids), items_per_call):
+        units.append(Unit(day_from, day_till, value_type,
+                          itemids[i:i + items_per_call]))
+        pass
+      pass
+    pass
+  return units
+
+
+def _new_columns(trends, value_type):
+  if trends:
+    return [array.array('q'), array.array('q'), array.array('d'),
+            array.array('d'), array.array('d')]
+  return [array.array('q'), array.array('q'),
+          array.array('Q' if value_type == '3' else 'd')]
+
+
+def fetch_unit(zapi, unit, trends=False):
+  '''
+  Returns {itemid: columns} of unit, columns being typed arrays in the
+  order of the fields of the file. Items without rows are left out.
+  '''
+  fields = _TREND_FIELDS if trends else _HISTORY_FIELDS
+  params = {'itemids': unit.itemids,
+            'output': ['itemid'] + fields,
+            'time_from': unit.time_from,
+            'time_till': unit.time_till,
+            }
+  if trends:
+    method = 'trend.get'
+  else:
+    # Only history.get sorts; trends are sorted when written.
+    method = 'history.get'
+    params['history'] = int(unit.value_type)
+    params['sortfield'] = 'clock'
+    params['sortorder'] = 'ASC'
+    pass
+  integer = not trends and unit.value_type == '3'
+  result = {}
+  for row in zapi.stream(method, params):
+    columns = result.get(row['itemid'])
+    if columns is None:
+      columns = result[row['itemid']] = _new_columns(trends, unit.value_type)
+      pass
+    columns[0].append(int(row['clock']))
+    if trends:
+      columns[1].append(int(row['num']))
+      columns[2].append(float(row['value_min']))
+      columns[3].append(float(row['value_avg']))
+      columns[4].append(float(row['value_max']))
+    else:
+      # Servers before 2.0 have no "ns".
+      columns[1].append(int(row.get('ns', 0)))
+      columns[2].append(int(row['value']) if integer
+                        else float(row['value']))
+      pass
+    pass
+  return result
+
+
+def partition_path(directory, itemid, clock):
+  return os.path.join(directory, str(itemid),
+                      '{}.npz'.format(day_name(clock)))
+
+
+def write_unit(directory, unit, result, trends=False):
+  '''
+  Writes one file per item of result for the day of unit and returns
+  the number of rows written. A file is renamed into place once
+  complete, so writing a unit again (e.g. on resume) just replaces it.
+  '''
+  fields = _TREND_FIELDS if trends else _HISTORY_FIELDS
+  rows = 0
+  for (itemid, columns) in result.items():
+    arrays = [np.frombuffer(c, dtype=c.typecode) for c in columns]
+    if trends:
+      order = np.argsort(arrays[0], kind='stable')
+      arrays = [a[order] for a in arrays]
+      pass
+    path = partition_path(directory, itemid, unit.time_from)
+    # Other threads may be writing other days of the same item.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+      np.savez_compressed(f, **dict(zip(fields, arrays)))
+      pass
+    os.rename(tmp, path)
+    rows += len(arrays[0])
+    pass
+  return rows
+
+
+def write_items(directory, items):
+  '''Writes items.json, describing what each <itemid> directory holds.'''
+  os.makedirs(directory, exist_ok=True)
+  path = os.path.join(directory, 'items.json')
+  tmp = '{}.{}'.format(path, os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(items, f, indent=1, sort_keys=True)
+    pass
+  os.rename(tmp, path)
+  pass
+
+
+def read_items(directory):
+  with open(os.path.join(directory, 'items.json')) as f:
+    return json.load(f)
+  pass
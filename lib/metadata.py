@@ -0,0 +1,312 @@
+'''
+Hosts, interfaces, groups, templates and items of one server, kept in a
+local SQLite file so that lookups like "hostid of this host" or "itemid
+of host + key" do not need an API call on every run.
+
+  cache = metadata.MetadataCache(server, max_age=3600)
+  cache.refresh(zapi)                     # only what is older than max_age
+  hostid = cache.hostid('web01')
+  itemid = cache.itemid('web01', 'system.cpu.load[,avg1]')
+
+Refreshes are incremental: the host list (with groups, templates and
+interfaces) is fetched again when it is older than max_age, and items
+only for hosts whose items are older than max_age or which are new.
+Scripts changing items call invalidate() for the hosts they touched.
+'''
+
+import hashlib
+import os
+import sqlite3
+import time
+
+DEFAULT_MAX_AGE = 60*60
+
+ITEM_FIELDS = ['itemid', 'hostid', 'key_', 'name', 'value_type', 'delay',
+               'history', 'trends', 'templateid', 'status']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hosts (
+  hostid INTEGER PRIMARY KEY, host TEXT, name TEXT, status INTEGER,
+  items_fetched REAL);
+CREATE INDEX IF NOT EXISTS hosts_host ON hosts(host);
+CREATE INDEX IF NOT EXISTS hosts_name ON hosts(name);
+CREATE TABLE IF NOT EXISTS interfaces (
+  interfaceid INTEGER PRIMARY KEY, hostid INTEGER, main INTEGER,
+  type INTEGER, useip INTEGER, ip TEXT, dns TEXT, port TEXT);
+CREATE INDEX IF NOT EXISTS interfaces_hostid ON interfaces(hostid);
+CREATE TABLE IF NOT EXISTS groups (groupid INTEGER PRIMARY KEY, name TEXT);
+CREATE INDEX IF NOT EXISTS groups_name ON groups(name);
+CREATE TABLE IF NOT EXISTS host_groups (
+  hostid INTEGER, groupid INTEGER, PRIMARY KEY (hostid, groupid));
+CREATE INDEX IF NOT EXISTS host_groups_groupid ON host_groups(groupid);
+CREATE TABLE IF NOT EXISTS templates (
+  templateid INTEGER PRIMARY KEY, host TEXT);
+CREATE TABLE IF NOT EXISTS host_templates (
+  hostid INTEGER, templateid INTEGER, PRIMARY KEY (hostid, templateid));
+CREATE TABLE IF NOT EXISTS items (
+  itemid INTEGER PRIMARY KEY, hostid INTEGER, key_ TEXT, name TEXT,
+  value_type INTEGER, delay TEXT, history TEXT, trends TEXT,
+  templateid INTEGER, status INTEGER);
+CREATE INDEX IF NOT EXISTS items_host_key ON items(hostid, key_);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+'''
+
+
+def default_path(server):
+  base = os.environ.get('XDG_CACHE_HOME',
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+  digest = hashlib.sha1(server.rstrip('/').encode('utf-8')).hexdigest()[:16]
+  return os.path.join(base, 'zabbix_api_examples',
+                      'metadata-{}.sqlite'.format(digest))
+
+
+def _chunks(seq, size):
+  for i in range(0, len(seq), size):
+    yield seq[i:i + size]
+    pass
+  pass
+
+
+class MetadataCache(object):
+  def __init__(self, server, path=None, max_age=DEFAULT_MAX_AGE,
+               chunk_size=500):
+    self.server = server
+    self.path = path or default_path(server)
+    self.max_age = max_age
+    self.chunk_size = max(1, chunk_size)
+    if not os.path.isdir(os.path.dirname(self.path)):
+      os.makedirs(os.path.dirname(self.path))
+      pass
+    self.db = sqlite3.connect(self.path)
+    self.db.row_factory = sqlite3.Row
+    self.db.executescript(_SCHEMA)
+    # Counters of the last refresh(), for logging.
+    self.refreshed_hosts = 0
+    self.refreshed_items = 0
+    pass
+
+  def close(self):
+    self.db.close()
+    pass
+
+  def _state(self, key, default=None):
+    row = self.db.execute('SELECT value FROM state WHERE key = ?',
+                          (key,)).fetchone()
+    return default if row is None else row[0]
+
+  def _set_state(self, key, value):
+    self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                    (key, value))
+    pass
+
+  def hosts_fresh(self, now=None):
+    now = time.time() if now is None else now
+    return now - self._state('hosts_fetched', 0) <= self.max_age
+
+  def refresh(self, zapi, hostids=None, now=None):
+    '''
+    Fetches what is missing or older than max_age: the host list, then
+    items of stale hosts (of hostids only, when given).
+    '''
+    now = time.time() if now is None else now
+    self.refreshed_hosts = 0
+    self.refreshed_items = 0
+    if not self.hosts_fresh(now):
+      self._refresh_hosts(zapi, now)
+      pass
+    query = ('SELECT hostid FROM hosts WHERE items_fetched IS NULL'
+             ' OR items_fetched < ?')
+    stale = [row[0] for row in self.db.execute(query, (now - self.max_age,))]
+    if hostids is not None:
+      wanted = set(int(h) for h in hostids)
+      stale = [h for h in stale if h in wanted]
+      pass
+    for chunk in _chunks(stale, self.chunk_size):
+      self._refresh_items(zapi, chunk, now)
+      pass
+    pass
+
+  def _refresh_hosts(self, zapi, now):
+    hosts = zapi.stream('host.get', {
+      'output': ['hostid', 'host', 'name', 'status'],
+      'selectGroups': ['groupid', 'name'],
+      'selectParentTemplates': ['templateid', 'host'],
+      'selectInterfaces': ['interfaceid', 'main', 'type', 'useip', 'ip',
+                           'dns', 'port']})
+    # Rows are collected before writing, so that the database is only
+    # locked for the writes, not while the host list downloads.
+    host_rows = []
+    groups = {}
+    host_groups = set()
+    templates = {}
+    host_templates = set()
+    interfaces = []
+    for host in hosts:
+      hostid = int(host['hostid'])
+      host_rows.append((hostid, host['host'], host.get('name', host['host']),
+                        int(host.get('status', 0))))
+      for group in host.get('groups', []):
+        groups[int(group['groupid'])] = group['name']
+        host_groups.add((hostid, int(group['groupid'])))
+        pass
+      for template in host.get('parentTemplates', []):
+        templates[int(template['templateid'])] = template['host']
+        host_templates.add((hostid, int(template['templateid'])))
+        pass
+      for interface in host.get('interfaces', []):
+        interfaces.append(
+          (int(interface['interfaceid']), hostid,
+           int(interface.get('main', 0)), int(interface.get('type', 0)),
+           int(interface.get('useip', 1)), interface.get('ip'),
+           interface.get('dns'), interface.get('port')))
+        pass
+      pass
+    with self.db:
+      old = dict(self.db.execute('SELECT hostid, items_fetched FROM hosts'))
+      for table in ('host_groups', 'host_templates', 'interfaces', 'groups',
+                    'templates'):
+        self.db.execute('DELETE FROM {}'.format(table))
+        pass
+      self.db.executemany(
+        'INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?)',
+        [row + (old.get(row[0]),) for row in host_rows])
+      self.db.executemany('INSERT OR REPLACE INTO groups VALUES (?, ?)',
+                          groups.items())
+      self.db.executemany('INSERT OR IGNORE INTO host_groups VALUES (?, ?)',
+                          host_groups)
+      self.db.executemany('INSERT OR REPLACE INTO templates VALUES (?, ?)',
+                          templates.items())
+      self.db.executemany('INSERT OR IGNORE INTO host_templates VALUES (?, ?)',
+                          host_templates)
+      self.db.executemany(
+        'INSERT OR REPLACE INTO interfaces VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        interfaces)
+      seen = set(row[0] for row in host_rows)
+      gone = [(h,) for h in old if h not in seen]
+      self.db.executemany('DELETE FROM hosts WHERE hostid = ?', gone)
+      self.db.executemany('DELETE FROM items WHERE hostid = ?', gone)
+      self._set_state('hosts_fetched', now)
+      pass
+    self.refreshed_hosts = len(seen)
+    pass
+
+  def _refresh_items(self, zapi, hostids, now):
+    items = zapi.stream('item.get', {'hostids': hostids,
+                                     'output': ITEM_FIELDS})
+    # Downloaded in full before the write transaction begins.
+    rows = [(int(i['itemid']), int(i['hostid']), i['key_'], i.get('name'),
+             int(i.get('value_type', 0)), i.get('delay'), i.get('history'),
+             i.get('trends'), int(i.get('templateid') or 0),
+             int(i.get('status', 0)))
+            for i in items]
+    with self.db:
+      self.db.executemany('DELETE FROM items WHERE hostid = ?',
+                          [(h,) for h in hostids])
+      cursor = self.db.executemany(
+        'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows)
+      self.refreshed_items += max(0, cursor.rowcount)
+      self.db.executemany('UPDATE hosts SET items_fetched = ? WHERE hostid = ?',
+                          [(now, h) for h in hostids])
+      pass
+    pass
+
+  def invalidate(self, hostids=None):
+    '''Makes items of hostids (or the whole cache) stale.'''
+    with self.db:
+      if hostids is None:
+        self.db.execute('UPDATE hosts SET items_fetched = NULL')
+        self._set_state('hosts_fetched', 0)
+      else:
+        self.db.executemany(
+          'UPDATE hosts SET items_fetched = NULL WHERE hostid = ?',
+          [(int(h),) for h in hostids])
+        pass
+      pass
+    pass
+
+  # Lookups. Ids are returned as strings, like the API does.
+
+  def _hosts(self, where='', args=()):
+    query = 'SELECT hostid, host, name, status FROM hosts {} ORDER BY hostid'
+    return [{'hostid': str(row['hostid']), 'host': row['host'],
+             'name': row['name'], 'status': str(row['status'])}
+            for row in self.db.execute(query.format(where), args)]
+
+  def hosts(self, names=None):
+    '''All hosts, or those whose host or visible name is in names.'''
+    if names is None:
+      return self._hosts()
+    names = list(names)
+    result = []
+    for chunk in _chunks(names, 500):
+      marks = ', '.join('?' * len(chunk))
+      result.extend(self._hosts(
+        'WHERE host IN ({0}) OR name IN ({0})'.format(marks), chunk + chunk))
+      pass
+    return result
+
+  def hostid(self, name):
+    hosts = self.hosts([name])
+    return hosts[0]['hostid'] if hosts else None
+
+  def hosts_in_groups(self, groups):
+    marks = ', '.join('?' * len(groups))
+    return self._hosts(
+      'WHERE hostid IN (SELECT hostid FROM host_groups JOIN groups'
+      ' USING (groupid) WHERE groups.name IN ({}))'.format(marks),
+      list(groups))
+
+  def groups(self, names=None):
+    query = 'SELECT groupid, name FROM groups'
+    args = ()
+    if names is not None:
+      query += ' WHERE name IN ({})'.format(', '.join('?' * len(names)))
+      args = list(names)
+      pass
+    return [{'groupid': str(row[0]), 'name': row[1]}
+            for row in self.db.execute(query, args)]
+
+  def templates(self, hostid):
+    return [{'templateid': str(row[0]), 'host': row[1]}
+            for row in self.db.execute(
+                'SELECT templateid, host FROM host_templates'
+                ' JOIN templates USING (templateid) WHERE hostid = ?',
+                (int(hostid),))]
+
+  def interfaces(self, hostid):
+    return [dict((k, str(row[k]) if row[k] is not None else None)
+                 for k in row.keys())
+            for row in self.db.execute(
+                'SELECT * FROM interfaces WHERE hostid = ?', (int(hostid),))]
+
+  def items(self, hostids, fields=ITEM_FIELDS):
+    '''Yields items of hostids as dicts of fields, by itemid.'''
+    for chunk in _chunks([int(h) for h in hostids], 500):
+      query = ('SELECT {} FROM items WHERE hostid IN ({}) ORDER BY itemid'
+               .format(', '.join(fields), ', '.join('?' * len(chunk))))
+      for row in self.db.execute(query, chunk):
+        yield dict((f, row[f] if isinstance(row[f], str) or row[f] is None
+                    else str(row[f]))
+                   for f in fields)
+        pass
+      pass
+    pass
+
+  def itemid(self, host, key):
+    hostid = self.hostid(host)
+    if hostid is None:
+      return None
+    row = self.db.execute('SELECT itemid FROM items'
+                          ' WHERE hostid = ? AND key_ = ?',
+                          (int(hostid), key)).fetchone()
+    return None if row is None else str(row[0])
+  pass
+
+
+def add_argument(parser):
+  parser.add_argument('--metadata-max-age', type=float, metavar='SECONDS',
+                      help=('Look hosts and items up in the local metadata'
+                            ' cache, refreshing only what is older than'
+                            ' SECONDS, instead of asking the server.'))
+  return parser
@@ -0,0 +1,131 @@
+'''
+Per-method statistics of API calls made through lib/client.py and
+lib/aio_client.py.
+
+  parser = argparse.ArgumentParser()
+  profiling.add_argument(parser)   # config.add_argparse_configs() does this
+
+With --profile (or --profile=json) every call is recorded, and at exit
+call counts, latency percentiles, request/response sizes and JSON
+decode time per method are written to stderr.
+'''
+
+import atexit
+import argparse
+import json
+import math
+import sys
+import threading
+
+from lib import client
+
+
+def percentile(sorted_values, p):
+  '''Nearest-rank percentile of an already sorted list.'''
+  if not sorted_values:
+    return 0.0
+  rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+  return sorted_values[max(0, rank - 1)]
+
+
+class Profiler(object):
+  '''A client hook (see client.add_hook) collecting per-method stats.'''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._methods = {}
+    pass
+
+  def __call__(self, method, seconds, request_bytes, response_bytes,
+               decode_seconds, error):
+    with self._lock:
+      entry = self._methods.setdefault(method, {'latencies': [],
+                                                'request_bytes': 0,
+                                                'response_bytes': 0,
+                                                'decode_seconds': 0.0,
+                                                'errors': 0})
+      entry['latencies'].append(seconds)
+      entry['request_bytes'] += request_bytes
+      entry['response_bytes'] += response_bytes
+      entry['decode_seconds'] += decode_seconds
+      entry['errors'] += 1 if error else 0
+      pass
+    pass
+
+  def summary(self):
+    '''Returns {method: stats}, times in milliseconds.'''
+    result = {}
+    with self._lock:
+      for (method, entry) in self._methods.items():
+        latencies = sorted(entry['latencies'])
+        result[method] = {
+          'calls': len(latencies),
+          'errors': entry['errors'],
+          'total_ms': round(sum(latencies) * 1000, 3),
+          'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+          'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+          'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+          'request_bytes': entry['request_bytes'],
+          'response_bytes': entry['response_bytes'],
+          'decode_ms': round(entry['decode_seconds'] * 1000, 3),
+          }
+        pass
+      pass
+    return result
+
+  def format_table(self):
+    summary = self.summary()
+    lines = ['{:<24} {:>6} {:>4} {:>10} {:>9} {:>9} {:>9} {:>11} {:>12}'
+             ' {:>10}'.format('method', 'calls', 'err', 'total(ms)',
+                              'p50(ms)', 'p95(ms)', 'p99(ms)', 'sent(B)',
+                              'recv(B)', 'decode(ms)')]
+    for method in sorted(summary, key=lambda m: -summary[m]['total_ms']):
+      s = summary[method]
+      lines.append('{:<24} {:>6} {:>4} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}'
+                   ' {:>11} {:>12} {:>10.1f}'
+                   .format(method, s['calls'], s['errors'], s['total_ms'],
+                           s['p50_ms'], s['p95_ms'], s['p99_ms'],
+                           s['request_bytes'], s['response_bytes'],
+                           s['decode_ms']))
+      pass
+    return '\n'.join(lines)
+
+  def dump(self, fmt='table', stream=None):
+    stream = stream or sys.stderr
+    if fmt == 'json':
+      stream.write(json.dumps(self.summary(), sort_keys=True) + '\n')
+    else:
+      stream.write(self.format_table() + '\n')
+      pass
+    stream.flush()
+    pass
+  pass
+
+
+_profiler = None
+
+
+def enable(fmt='table'):
+  '''Starts recording every API call and dumps the stats at exit.'''
+  global _profiler
+  if _profiler is None:
+    _profiler = Profiler()
+    client.add_hook(_profiler)
+    atexit.register(lambda: _profiler.dump(fmt))
+    pass
+  return _profiler
+
+
+class _ProfileAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    setattr(namespace, self.dest, values)
+    enable(values)
+    pass
+  pass
+
+
+def add_argument(parser):
+  parser.add_argument('--profile', nargs='?', const='table',
+                      choices=['table', 'json'], action=_ProfileAction,
+                      help=('Print per-method API call statistics to'
+                            ' stderr at exit (as a table or JSON).'))
+  return parser
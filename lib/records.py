@@ -0,0 +1,127 @@
+'''
+Compact in-memory forms of API results, for scripts holding many hosts
+or items at once.
+
+A dict per item costs hundreds of bytes even with a few fields, and
+every item keeps its own copy of strings like "1m" or "90d".
+
+ - record_type() makes a class with __slots__ for the fields a script
+   reads. Records still answer record['hostid'] like the dicts.
+ - Columns keeps many rows column by column: integer fields in
+   array('q') (8 bytes per row, readable by NumPy without a copy) and
+   other fields as lists of interned strings, so a repeated value is
+   stored once.
+
+Ask the API only for those fields as well (output=[...]), so that the
+server does not have to send the rest.
+'''
+
+from array import array
+from sys import intern
+
+
+class Record(object):
+  __slots__ = ()
+
+  @classmethod
+  def from_dict(cls, values):
+    record = cls.__new__(cls)
+    for field in cls.__slots__:
+      setattr(record, field, values.get(field))
+      pass
+    return record
+
+  def __getitem__(self, field):
+    try:
+      return getattr(self, field)
+    except AttributeError:
+      raise KeyError(field)
+    pass
+
+  def __contains__(self, field):
+    return field in self.__slots__
+
+  def get(self, field, default=None):
+    return getattr(self, field, default)
+
+  def as_dict(self):
+    return dict((field, getattr(self, field)) for field in self.__slots__)
+
+  def __eq__(self, other):
+    return (type(self) is type(other)
+            and self.as_dict() == other.as_dict())
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return '{}({})'.format(type(self).__name__,
+                           ', '.join('{}={!r}'.format(f, getattr(self, f))
+                                     for f in self.__slots__))
+  pass
+
+
+def record_type(name, fields):
+  '''Returns a Record subclass holding exactly fields.'''
+  return type(name, (Record,), {'__slots__': tuple(fields)})
+
+
+class Columns(object):
+  '''
+  Rows of the same fields, stored column by column. Fields in
+  int_fields must hold integers (e.g. ids) and become array('q');
+  columns[field] returns the whole column.
+  '''
+  def __init__(self, fields, int_fields=()):
+    self.fields = tuple(fields)
+    self.int_fields = frozenset(int_fields)
+    self._columns = dict((f, array('q') if f in self.int_fields else [])
+                         for f in self.fields)
+    pass
+
+  def append(self, row):
+    for field in self.fields:
+      value = row[field]
+      if field in self.int_fields:
+        self._columns[field].append(int(value))
+      else:
+        self._columns[field].append(intern(str(value)))
+        pass
+      pass
+    pass
+
+  def extend(self, rows):
+    for row in rows:
+      self.append(row)
+      pass
+    pass
+
+  def merge(self, other):
+    '''Appends the rows of other, which must have the same fields.'''
+    for field in self.fields:
+      self._columns[field].extend(other._columns[field])
+      pass
+    pass
+
+  def __len__(self):
+    return len(self._columns[self.fields[0]]) if self.fields else 0
+
+  def __getitem__(self, field):
+    return self._columns[field]
+
+  def row(self, i):
+    return dict((f, self._columns[f][i]) for f in self.fields)
+
+  def select(self, indices):
+    '''Returns new Columns with the rows at indices.'''
+    selected = Columns(self.fields, self.int_fields)
+    for field in self.fields:
+      column = self._columns[field]
+      if field in self.int_fields:
+        selected._columns[field] = array('q', (column[i] for i in indices))
+      else:
+        selected._columns[field] = [column[i] for i in indices]
+        pass
+      pass
+    return selected
+  pass
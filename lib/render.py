@@ -0,0 +1,65 @@
+'''
+Headless rendering of time series to PNG/SVG files with the gnuplot
+binary, meant to be run in worker processes (see render_all()).
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import subprocess
+import tempfile
+import time
+
+_terminals = {'png': 'pngcairo size 1024,480',
+              'svg': 'svg size 1024,480'}
+
+
+def _quote(s):
+  return '"{}"'.format(str(s).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def render(output, title, clocks, values, fmt='png', gnuplot='gnuplot'):
+  '''
+  Writes one graph to output and returns the seconds it took.
+  NaN values are left as gaps.
+  '''
+  start = time.time()
+  (fd, filename) = tempfile.mkstemp(text=1)
+  try:
+    with os.fdopen(fd, 'w') as f:
+      for (clock, value) in zip(clocks, values):
+        f.write('{:d} {:.10g}\n'.format(int(clock), value))
+        pass
+      pass
+    script = '\n'.join([
+      'set terminal {}'.format(_terminals[fmt]),
+      'set output {}'.format(_quote(output)),
+      'set title {} noenhanced'.format(_quote(title)),
+      'set xdata time',
+      'set timefmt "%s"',
+      'set format x "%m/%d\\n%H:%M"',
+      'set datafile missing "nan"',
+      'plot {} using 1:2 with lines notitle'.format(_quote(filename)),
+      ''])
+    proc = subprocess.Popen([gnuplot], stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (_, err) = proc.communicate(script.encode('utf-8'))
+    if proc.returncode != 0:
+      raise RuntimeError('gnuplot failed for {}: {}'
+                         .format(output, err.decode('utf-8', 'replace')))
+  finally:
+    os.unlink(filename)
+    pass
+  return time.time() - start
+
+
+def _render_job(job):
+  return render(*job)
+
+
+def render_all(jobs, max_workers=None):
+  '''
+  Renders each job (arguments of render()) in a pool of processes and
+  returns the render seconds of each, in the order of jobs.
+  '''
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(_render_job, jobs))
@@ -0,0 +1,164 @@
+'''
+Chooses between raw history and hourly trends for a plot, and reduces
+series to a number of points a screen can actually show.
+
+The downsampler is largest-triangle-three-buckets (LTTB), from
+Sveinn Steinarsson, "Downsampling Time Series for Visual
+Representation" (2013).
+'''
+
+import numpy as np
+
+from lib import size_model
+
+# Trends are stored per hour.
+TREND_SECONDS = 60*60
+
+# Used when an item has no usable delay (e.g. trappers, macros).
+_FALLBACK_DELAY = 60
+
+HISTORY_OUTPUT = ['clock', 'value']
+TREND_OUTPUT = ['clock', 'value_avg', 'value_min', 'value_max']
+
+
+class Plan(object):
+  '''
+  What to fetch: method is "history" or "trend", output the fields
+  requested (and the columns of the resulting series).
+  '''
+  def __init__(self, method, output, expected_points):
+    self.method = method
+    self.output = output
+    self.expected_points = expected_points
+    pass
+
+  def __repr__(self):
+    return 'Plan({}, ~{} points)'.format(self.method, self.expected_points)
+  pass
+
+
+def trends_supported(version, value_type):
+  '''trend.get exists from Zabbix 3.0, for numeric items only.'''
+  try:
+    major_minor = tuple(int(v) for v in str(version).split('.')[:2])
+  except ValueError:
+    return False
+  return major_minor >= (3, 0) and int(value_type) in (0, 3)
+
+
+def plan(item, version, time_from, time_till, max_raw_points=50000,
+         now=None):
+  '''
+  Returns a Plan for plotting item between time_from and time_till.
+
+  Raw history is used unless it would exceed max_raw_points or the
+  range starts before the history retention of the item, in which case
+  hourly trends (min/avg/max) are used when the server has them.
+  '''
+  if now is None:
+    now = time_till
+    pass
+  legacy = size_model.uses_legacy_units(version)
+  delay = size_model.parse_interval(item.get('delay', 0))
+  if delay <= 0:
+    delay = _FALLBACK_DELAY
+    pass
+  retention = size_model.parse_interval(item.get('history', -1),
+                                        24*60*60 if legacy else 1)
+  span = max(0, time_till - time_from)
+  raw_points = span // delay + 1
+
+  beyond_history = retention >= 0 and time_from < now - retention
+  if ((raw_points > max_raw_points or beyond_history)
+      and trends_supported(version, item.get('value_type', 0))):
+    return Plan('trend', TREND_OUTPUT, span // TREND_SECONDS + 1)
+  return Plan('history', HISTORY_OUTPUT, raw_points)
+
+
+def rows_to_columns(shards, fields):
+  '''
+  Converts rows (dicts) of each shard into float64 arrays, one per
+  field, without keeping the dicts of more than one shard around.
+  '''
+  columns = [[] for _ in fields]
+  for rows in shards:
+    for (i, field) in enumerate(fields):
+      columns[i].append(np.array([row[field] for row in rows],
+                                 dtype=np.float64))
+      pass
+    pass
+  return [np.concatenate(c) if c else np.zeros(0) for c in columns]
+
+
+def lttb(x, y, threshold):
+  '''
+  Returns indices of at most threshold points of (x, y) chosen with
+  largest-triangle-three-buckets. The first and last points are kept.
+  Bucket averages are computed for all buckets at once; only the choice
+  of each bucket's point, which depends on the previous choice, loops.
+  '''
+  n = len(x)
+  if threshold >= n or threshold < 3:
+    return np.arange(n)
+
+  # threshold - 2 buckets over the points between the first and the last.
+  edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+  counts = np.diff(edges)
+  sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+  sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+  # Average of the next bucket; the last bucket looks at the last point.
+  next_x = np.append(sums_x[1:] / counts[1:], x[n - 1])
+  next_y = np.append(sums_y[1:] / counts[1:], y[n - 1])
+
+  selected = np.empty(threshold, dtype=np.int64)
+  selected[0] = 0
+  selected[-1] = n - 1
+  a = 0
+  for i in range(threshold - 2):
+    start = edges[i]
+    end = edges[i + 1]
+    bx = x[start:end]
+    by = y[start:end]
+    area = np.abs((x[a] - next_x[i]) * (by - y[a])
+                  - (x[a] - bx) * (next_y[i] - y[a]))
+    a = start + int(np.argmax(area))
+    selected[i + 1] = a
+    pass
+  return selected
+
+
+def downsample(columns, target_points):
+  '''
+  Downsamples columns ([clock, value, ...]) to target_points with LTTB
+  on the first value column, keeping the same rows of the others.
+  '''
+  if len(columns[0]) <= target_points:
+    return columns
+  index = lttb(columns[0], columns[1], target_points)
+  return [c[index] for c in columns]
+
+
+def make_grid(time_from, time_till, points):
+  '''Returns the left edges of points equal time bins over the range.'''
+  step = max(1, int(np.ceil((time_till - time_from + 1) / float(points))))
+  return np.arange(time_from, time_till + 1, step, dtype=np.int64)
+
+
+def to_grid(grid, clocks, values):
+  '''
+  Averages (clocks, values) into the bins starting at grid, so that
+  several series can share one timestamp column. Empty bins are NaN.
+  '''
+  if len(grid) > 1:
+    step = grid[1] - grid[0]
+  else:
+    step = 1
+    pass
+  index = ((np.asarray(clocks, dtype=np.int64) - grid[0]) // step)
+  inside = (index >= 0) & (index < len(grid))
+  index = index[inside]
+  values = np.asarray(values, dtype=np.float64)[inside]
+  sums = np.bincount(index, weights=values, minlength=len(grid))
+  counts = np.bincount(index, minlength=len(grid))
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.where(counts > 0, sums / counts, np.nan)
@@ -0,0 +1,382 @@
+'''
+Retries, hedging and a circuit breaker for API calls which can safely
+be sent twice: "*.get" and apiinfo.version (see is_read_only()).
+
+  retry.enable()                  # or --retry, see add_argument()
+
+With it, lib/client.py and lib/aio_client.py
+ - retry a read-only call failing with a transient error (transport
+   error, HTTP 429/5xx) up to attempts times in all, after exponential
+   backoff with full jitter,
+ - hedge it: when no answer came within the p95 latency of the method
+   on that server so far, send the same request again on another
+   connection and take whichever answer comes first. At most
+   hedge_ratio of the calls are hedged, so that a server slow for
+   everybody does not get twice the load,
+ - stop calling a server at all (CircuitOpenError) for cooldown seconds
+   after threshold transient failures in a row, then let one call
+   through to see whether it is back.
+
+Write methods (item.create, maintenance.create, ...) are never retried
+nor hedged; they only go through the circuit breaker. A stream() is
+hedged and retried until its response starts coming, not midway.
+'''
+
+import argparse
+import asyncio
+import collections
+from concurrent import futures
+import queue
+import random
+import threading
+import time
+
+
+def is_read_only(method):
+  return method.endswith('.get') or method == 'apiinfo.version'
+
+
+class CircuitOpenError(IOError):
+  '''Raised instead of calling a server which has been failing.'''
+  pass
+
+
+class _Breaker(object):
+  def __init__(self, url, threshold, cooldown):
+    self.url = url
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.opened = None
+    self._lock = threading.Lock()
+    pass
+
+  def check(self):
+    with self._lock:
+      if self.opened is None:
+        return
+      if time.time() - self.opened < self.cooldown:
+        raise CircuitOpenError('{} failed {} times in a row; not calling it'
+                               ' for {:g}s'.format(self.url, self.failures,
+                                                   self.cooldown))
+      # Half open: this call decides, one more failure opens it again.
+      self.opened = None
+      self.failures = self.threshold - 1
+      pass
+    pass
+
+  def success(self):
+    with self._lock:
+      self.failures = 0
+      pass
+    pass
+
+  def failure(self):
+    with self._lock:
+      self.failures += 1
+      if self.failures >= self.threshold:
+        self.opened = time.time()
+        pass
+      pass
+    pass
+  pass
+
+
+class _Latencies(object):
+  '''Recent latencies of one method on one server, and hedges sent.'''
+  def __init__(self, window, min_samples):
+    self.samples = collections.deque(maxlen=window)
+    self.min_samples = min_samples
+    self.calls = 0
+    self.hedges = 0
+    pass
+
+  def p95(self):
+    if len(self.samples) < self.min_samples:
+      return None
+    ordered = sorted(self.samples)
+    return ordered[int(0.95 * (len(ordered) - 1))]
+  pass
+
+
+class _Workers(object):
+  '''
+  Daemon threads sending hedged requests. They are kept, so each keeps
+  its keep-alive connection, and never hold the process at exit.
+  '''
+  def __init__(self):
+    self._queue = queue.Queue()
+    self._idle = 0
+    self._lock = threading.Lock()
+    pass
+
+  def submit(self, func):
+    future = futures.Future()
+    with self._lock:
+      if self._idle:
+        self._idle -= 1
+      else:
+        thread = threading.Thread(target=self._work, name='retry-worker')
+        thread.daemon = True
+        thread.start()
+        pass
+      self._queue.put((func, future))
+      pass
+    return future
+
+  def _work(self):
+    while True:
+      (func, future) = self._queue.get()
+      if future.set_running_or_notify_cancel():
+        try:
+          future.set_result(func())
+        except BaseException as e:
+          future.set_exception(e)
+          pass
+        pass
+      with self._lock:
+        self._idle += 1
+        pass
+      pass
+    pass
+  pass
+
+
+def _discard(future, cleanup):
+  '''Hands the answer of a request which lost a race to cleanup.'''
+  def done(f):
+    if cleanup is not None and not f.cancelled() and f.exception() is None:
+      cleanup(f.result())
+      pass
+    pass
+  future.add_done_callback(done)
+  pass
+
+
+class Policy(object):
+  def __init__(self, attempts=3, backoff=0.2, max_backoff=5.0,
+               hedge_ratio=0.1, min_samples=5, window=200, threshold=5,
+               cooldown=30.0):
+    self.attempts = max(1, attempts)
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.hedge_ratio = hedge_ratio
+    self.min_samples = min_samples
+    self.window = window
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.retries = 0
+    self._breakers = {}
+    self._latencies = {}
+    self._lock = threading.Lock()
+    self._workers = _Workers()
+    pass
+
+  def breaker(self, url):
+    with self._lock:
+      if url not in self._breakers:
+        self._breakers[url] = _Breaker(url, self.threshold, self.cooldown)
+        pass
+      return self._breakers[url]
+
+  def _method_latencies(self, url, method):
+    with self._lock:
+      key = (url, method)
+      if key not in self._latencies:
+        self._latencies[key] = _Latencies(self.window, self.min_samples)
+        pass
+      return self._latencies[key]
+
+  def delay(self, attempt):
+    '''Backoff before retry number attempt + 1: "full jitter".'''
+    return random.uniform(0, min(self.max_backoff,
+                                 self.backoff * 2 ** attempt))
+
+  def _hedge_after(self, latencies):
+    '''Seconds to wait before hedging, or None not to hedge this call.'''
+    with self._lock:
+      latencies.calls += 1
+      p95 = latencies.p95()
+      if (p95 is None
+          or latencies.hedges >= 1 + self.hedge_ratio * latencies.calls):
+        return None
+      return p95
+
+  def _hedged(self, latencies, send, cleanup):
+    after = self._hedge_after(latencies)
+    if after is None:
+      return send()
+    first = self._workers.submit(send)
+    (done, _) = futures.wait([first], after)
+    if done:
+      return first.result()
+    with self._lock:
+      latencies.hedges += 1
+      pass
+    pending = set([first, self._workers.submit(send)])
+    error = None
+    while pending:
+      (done, pending) = futures.wait(pending,
+                                     return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        if future.exception() is None:
+          for other in (done | pending) - set([future]):
+            _discard(other, cleanup)
+            pass
+          return future.result()
+        error = future.exception()
+        pass
+      pass
+    raise error
+
+  def run(self, url, method, send, is_transient, cleanup=None):
+    '''
+    Returns send(), guarded by the circuit breaker of url and, for a
+    read-only method, retried and hedged. send may then run in another
+    thread, and more than once at a time; cleanup(result) gets results
+    which lost to a hedged duplicate.
+    '''
+    breaker = self.breaker(url)
+    breaker.check()
+    if not is_read_only(method):
+      try:
+        result = send()
+      except Exception as e:
+        if is_transient(e):
+          breaker.failure()
+          pass
+        raise
+      breaker.success()
+      return result
+    latencies = self._method_latencies(url, method)
+    attempt = 0
+    while True:
+      start = time.time()
+      try:
+        result = self._hedged(latencies, send, cleanup)
+      except Exception as e:
+        if not is_transient(e):
+          raise
+        breaker.failure()
+        attempt += 1
+        if attempt >= self.attempts:
+          raise
+        time.sleep(self.delay(attempt - 1))
+        breaker.check()
+        with self._lock:
+          self.retries += 1
+          pass
+        continue
+      breaker.success()
+      with self._lock:
+        latencies.samples.append(time.time() - start)
+        pass
+      return result
+    pass
+
+  async def run_async(self, url, method, send, is_transient):
+    '''run() for asyncio; send() returns a new coroutine each time.'''
+    breaker = self.breaker(url)
+    breaker.check()
+    if not is_read_only(method):
+      try:
+        result = await send()
+      except Exception as e:
+        if is_transient(e):
+          breaker.failure()
+          pass
+        raise
+      breaker.success()
+      return result
+    latencies = self._method_latencies(url, method)
+    attempt = 0
+    while True:
+      start = time.time()
+      try:
+        result = await self._hedged_async(latencies, send)
+      except Exception as e:
+        if not is_transient(e):
+          raise
+        breaker.failure()
+        attempt += 1
+        if attempt >= self.attempts:
+          raise
+        await asyncio.sleep(self.delay(attempt - 1))
+        breaker.check()
+        with self._lock:
+          self.retries += 1
+          pass
+        continue
+      breaker.success()
+      with self._lock:
+        latencies.samples.append(time.time() - start)
+        pass
+      return result
+    pass
+
+  async def _hedged_async(self, latencies, send):
+    after = self._hedge_after(latencies)
+    if after is None:
+      return await send()
+    first = asyncio.ensure_future(send())
+    (done, _) = await asyncio.wait([first], timeout=after)
+    if done:
+      return first.result()
+    with self._lock:
+      latencies.hedges += 1
+      pass
+    pending = set([first, asyncio.ensure_future(send())])
+    error = None
+    while pending:
+      (done, pending) = await asyncio.wait(
+        pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        if task.exception() is None:
+          for other in pending:
+            other.cancel()
+            pass
+          return task.result()
+        error = task.exception()
+        pass
+      pass
+    raise error
+
+  def summary(self):
+    '''Returns {(url, method): (calls, hedges)} and the retry count.'''
+    with self._lock:
+      return (dict((key, (l.calls, l.hedges))
+                   for (key, l) in self._latencies.items()), self.retries)
+  pass
+
+
+_policy = None
+
+
+def enable(**options):
+  '''Makes clients retry and hedge with a Policy(**options).'''
+  global _policy
+  _policy = Policy(**options)
+  return _policy
+
+
+def get():
+  '''Returns the Policy in use, or None unless enable() was called.'''
+  return _policy
+
+
+class _RetryAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    setattr(namespace, self.dest, True)
+    enable()
+    pass
+  pass
+
+
+def add_argument(parser):
+  parser.add_argument('--retry', nargs=0, default=False, action=_RetryAction,
+                      help=('Try read-only API calls up to 3 times in all'
+                            ' (2 retries) on transient errors,'
+                            ' send a second copy of ones slower than usual'
+                            ' and stop calling a failing server for a'
+                            ' while.'))
+  return parser
@@ -0,0 +1,289 @@
+'''
+An adaptive limit on API calls in flight to one server, shared by every
+client of it (lib/client.py and lib/aio_client.py, in any thread).
+
+  scheduler.enable()              # or --adaptive, see add_argument()
+  ... run jobs as usual; calls wait here when the server is busy ...
+
+The limit follows AIMD (additive increase, multiplicative decrease):
+each call answered in time raises it by weight/limit, i.e. by about one
+per round of calls, and a call answered much slower than usual for its
+method (or failing at the transport or HTTP level) cuts it to 70%, at
+most once per round trip. Calls take weight(method, params) units of the
+limit, so that one history.get leaves room for fewer other calls than
+a host.get. Parallel scripts can then be given plenty of jobs and run
+as fast as the server keeps up with.
+'''
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+
+from lib import retry
+
+# Units of the limit one call takes. item.get with output "extend" is
+# weighted separately in weight().
+WEIGHTS = {'history.get': 4,
+           'trend.get': 3,
+           'event.get': 2,
+           'item.get': 1,
+           'host.get': 1,
+           }
+EXTEND_ITEM_WEIGHT = 3
+
+
+def weight(method, params=None):
+  if (method == 'item.get' and isinstance(params, dict)
+      and params.get('output') == 'extend'):
+    return EXTEND_ITEM_WEIGHT
+  return WEIGHTS.get(method, 1)
+
+
+class Limiter(object):
+  '''
+  AIMD limit for one server. A call larger than the whole limit is let
+  through when nothing else is in flight, and calls made by a thread
+  already holding a slot (e.g. inside a stream()) never wait.
+  '''
+  def __init__(self, initial=8, minimum=1, maximum=64, tolerance=2.0,
+               slack=0.02, backoff=0.7, window=100):
+    self.limit = float(initial)
+    self.minimum = minimum
+    self.maximum = maximum
+    # A call is "slow" above tolerance times the usual latency of its
+    # method (the fastest of its last window calls), and at least slack
+    # seconds above it.
+    self.tolerance = tolerance
+    self.window = window
+    self.slack = slack
+    self.backoff = backoff
+    self.in_flight = 0
+    self.peak = 0
+    self.decreases = 0
+    self._latencies = {}
+    self._last_decrease = 0.0
+    self._cond = threading.Condition()
+    self._local = threading.local()
+    self._async_waiters = []
+    pass
+
+  def _admit(self, units):
+    if self.in_flight == 0 or self.in_flight + units <= self.limit:
+      self.in_flight += units
+      self.peak = max(self.peak, self.in_flight)
+      return True
+    return False
+
+  def _wake(self):
+    self._cond.notify_all()
+    for (loop, future) in self._async_waiters:
+      loop.call_soon_threadsafe(_resolve, future)
+      pass
+    self._async_waiters = []
+    pass
+
+  def acquire(self, units):
+    held = getattr(self._local, 'held', 0)
+    with self._cond:
+      if held:
+        self.in_flight += units
+      else:
+        while not self._admit(units):
+          self._cond.wait()
+          pass
+        pass
+      pass
+    self._local.held = held + 1
+    pass
+
+  async def acquire_async(self, units):
+    loop = asyncio.get_event_loop()
+    while True:
+      with self._cond:
+        if self._admit(units):
+          return
+        future = loop.create_future()
+        self._async_waiters.append((loop, future))
+        pass
+      await future
+      pass
+    pass
+
+  def release(self, units, from_thread=True):
+    if from_thread:
+      self._local.held = max(0, getattr(self._local, 'held', 0) - 1)
+      pass
+    with self._cond:
+      self.in_flight -= units
+      self._wake()
+      pass
+    pass
+
+  def observe(self, method, units, start, seconds, overloaded=False):
+    '''Adjusts the limit after a call of method sent at start.'''
+    with self._cond:
+      latencies = self._latencies.get(method)
+      if latencies is None:
+        latencies = self._latencies[method] = collections.deque(
+          maxlen=self.window)
+        pass
+      latencies.append(seconds)
+      # After a decrease some calls run with little queueing; their
+      # latency is what the server needs, and follows it getting slower.
+      baseline = min(latencies)
+      if overloaded or seconds > max(baseline * self.tolerance,
+                                     baseline + self.slack):
+        # Calls sent before the last decrease saw the load it reacted to.
+        if start > self._last_decrease:
+          self.limit = max(self.minimum, self.limit * self.backoff)
+          self._last_decrease = time.time()
+          self.decreases += 1
+          pass
+      else:
+        self.limit = min(self.maximum, self.limit + float(units) / self.limit)
+        self._wake()
+        pass
+      pass
+    pass
+  pass
+
+
+def _resolve(future):
+  if not future.done():
+    future.set_result(None)
+    pass
+  pass
+
+
+class _Call(object):
+  '''Timing of one call; answered() marks when its response came.'''
+  __slots__ = ['start', 'seconds']
+
+  def __init__(self):
+    self.start = time.time()
+    self.seconds = None
+    pass
+
+  def answered(self):
+    if self.seconds is None:
+      self.seconds = time.time() - self.start
+      pass
+    pass
+  pass
+
+
+def _finish(limiter, method, units, call, error, is_overload):
+  if isinstance(error, retry.CircuitOpenError):
+    # Never sent; neither its latency nor the error says anything
+    # about the load of the server.
+    return
+  call.answered()
+  limiter.observe(method, units, call.start, call.seconds,
+                  error is not None and is_overload(error))
+  pass
+
+
+@contextlib.contextmanager
+def slot(url, method, params, is_overload):
+  '''
+  Holds room for one call of method to url while the block runs, when
+  enabled. The block calls answered() on what it gets once the response
+  starts coming; is_overload(exception) tells whether an exception
+  means the server is overloaded.
+  '''
+  limiter = get(url)
+  if limiter is None:
+    yield _Call()
+    return
+  units = weight(method, params)
+  limiter.acquire(units)
+  call = _Call()
+  error = None
+  try:
+    yield call
+  except Exception as e:
+    error = e
+    raise
+  finally:
+    limiter.release(units)
+    _finish(limiter, method, units, call, error, is_overload)
+    pass
+  pass
+
+
+@contextlib.asynccontextmanager
+async def async_slot(url, method, params, is_overload):
+  '''slot() for asyncio.'''
+  limiter = get(url)
+  if limiter is None:
+    yield _Call()
+    return
+  units = weight(method, params)
+  await limiter.acquire_async(units)
+  call = _Call()
+  error = None
+  try:
+    yield call
+  except Exception as e:
+    error = e
+    raise
+  finally:
+    limiter.release(units, from_thread=False)
+    _finish(limiter, method, units, call, error, is_overload)
+    pass
+  pass
+
+
+_options = None
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def enable(**options):
+  '''Makes clients share a Limiter(**options) per server from now on.'''
+  global _options
+  _options = options
+  pass
+
+
+def enabled():
+  return _options is not None
+
+
+def get(url):
+  '''Returns the Limiter of url, or None unless enable() was called.'''
+  if _options is None:
+    return None
+  limiter = _limiters.get(url)
+  if limiter is None:
+    with _limiters_lock:
+      limiter = _limiters.setdefault(url, Limiter(**_options))
+      pass
+    pass
+  return limiter
+
+
+def summary():
+  '''Returns {url: (limit, peak in flight, decreases)}.'''
+  return dict((url, (l.limit, l.peak, l.decreases))
+              for (url, l) in _limiters.items())
+
+
+class _AdaptiveAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    setattr(namespace, self.dest, True)
+    enable()
+    pass
+  pass
+
+
+def add_argument(parser):
+  parser.add_argument('--adaptive', nargs=0, default=False,
+                      action=_AdaptiveAction,
+                      help=('Let the number of calls in flight follow how'
+                            ' fast the server answers (AIMD) instead of'
+                            ' keeping --jobs of them busy.'))
+  return parser
@@ -0,0 +1,196 @@
+'''
+Storage size model used by estimate_database_size.py.
+
+Item columns (delay, history, trends) are parsed once per distinct value
+and the byte counts are computed on whole NumPy arrays, so estimating
+a million items does not cost a million rounds of Python arithmetic.
+
+See also:
+https://www.zabbix.com/documentation/1.8/manual/installation/requirements
+
+History: days*(items/refresh rate)*24*3600*bytes (bytes ~= 50)
+Trends: days*(items/3600)*24*3600*bytes (bytes ~= 128)
+'''
+
+import re
+
+import numpy as np
+
+HISTORY_ROW_BYTES = 50
+TREND_ROW_BYTES = 128
+
+_SECONDS_PER_DAY = 24 * 3600
+
+_units = {'': 1, 's': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60,
+          'w': 7*24*60*60}
+
+# 30, 30s, 1m, 90d, ...
+r_interval = re.compile(r'^\s*(\d+)([smhdw]?)\s*$')
+# {$MACRO} or {$MACRO:"context"}
+r_macro = re.compile(r'\{\$[^}]+\}')
+
+
+def parse_interval(value, default_unit=1):
+  '''
+  Converts one delay/history/trends value into seconds.
+
+  Plain numbers are multiplied by default_unit (history and trends
+  were stored in days before Zabbix 3.4). Flexible and scheduling
+  intervals after ";" are ignored and only the base delay is used.
+  Returns -1 when the value cannot be understood (e.g. an unresolved
+  macro).
+  '''
+  value = str(value).split(';', 1)[0]
+  m = r_interval.match(value)
+  if not m:
+    return -1
+  if m.group(2):
+    return int(m.group(1)) * _units[m.group(2)]
+  else:
+    return int(m.group(1)) * default_unit
+  pass
+
+
+def uses_legacy_units(version):
+  '''
+  Returns True when history/trends are plain numbers of days,
+  i.e. for servers older than 3.4.
+  '''
+  try:
+    major_minor = tuple(int(v) for v in str(version).split('.')[:2])
+  except ValueError:
+    return False
+  return major_minor < (3, 4)
+
+
+class MacroTable(object):
+  '''
+  User macros needed to resolve "{$MACRO}" values.
+
+  Global macros and host macros are fetched lazily with a handful of
+  usermacro.get calls the first time a macro is looked up, and every
+  resolved (scope, value) pair is remembered afterwards. Template macros
+  are only seen when the template ids are part of hostids and items are
+  resolved with a (hostid, templateid) scope.
+  '''
+  def __init__(self, zapi, hostids, chunk_size=500):
+    self._zapi = zapi
+    self._hostids = list(hostids)
+    self._chunk_size = max(1, chunk_size)
+    self._global_macros = None
+    self._host_macros = None
+    self._resolved = {}
+    pass
+
+  def _load(self):
+    self._global_macros = {}
+    for macro in self._zapi.usermacro.get(globalmacro=True,
+                                          output=['macro', 'value']):
+      self._global_macros[macro['macro']] = macro['value']
+      pass
+    self._host_macros = {}
+    for i in range(0, len(self._hostids), self._chunk_size):
+      chunk = self._hostids[i:i + self._chunk_size]
+      for macro in self._zapi.usermacro.get(
+          hostids=chunk, output=['hostid', 'macro', 'value']):
+        self._host_macros[(macro['hostid'], macro['macro'])] = macro['value']
+        pass
+      pass
+    pass
+
+  def lookup(self, scope, macro):
+    '''
+    scope is a hostid, or a tuple of ids searched in order before global
+    macros (e.g. (hostid, templateid) for an item inherited from a
+    template, so that a host macro overrides the template one).
+    '''
+    if self._global_macros is None:
+      self._load()
+      pass
+    if not isinstance(scope, tuple):
+      scope = (scope,)
+      pass
+    for name in (macro, re.sub(r':.*\}$', '}', macro)):
+      for hostid in scope:
+        if (hostid, name) in self._host_macros:
+          return self._host_macros[(hostid, name)]
+        pass
+      if name in self._global_macros:
+        return self._global_macros[name]
+      pass
+    return None
+
+  def resolve(self, scope, value):
+    key = (scope, value)
+    if key not in self._resolved:
+      def replace(m):
+        resolved = self.lookup(scope, m.group(0))
+        return m.group(0) if resolved is None else resolved
+      self._resolved[key] = r_macro.sub(replace, value)
+      pass
+    return self._resolved[key]
+  pass
+
+
+def has_macro(value):
+  return '{$' in str(value)
+
+
+def parse_column(values, default_unit=1, hostids=None, macros=None):
+  '''
+  Parses a whole column into a float64 array of seconds.
+
+  Each distinct string is parsed only once. Values containing macros
+  are resolved per host through macros (a MacroTable) when given;
+  hostids holds the scope passed to MacroTable.resolve() for each item.
+  '''
+  if len(values) == 0:
+    return np.zeros(0, dtype=np.float64)
+  # Codes through a dict rather than np.unique(), which would first copy
+  # every string into a fixed-width array.
+  codes = {}
+  inverse = np.fromiter((codes.setdefault(str(v), len(codes))
+                         for v in values),
+                        dtype=np.int64, count=len(values))
+  uniques = sorted(codes, key=codes.get)
+  parsed = np.array([parse_interval(v, default_unit) for v in uniques],
+                    dtype=np.float64)
+  result = parsed[inverse]
+
+  if macros is not None and hostids is not None:
+    macro_mask = np.array([has_macro(v) for v in uniques], dtype=bool)
+    if macro_mask.any():
+      for i in np.flatnonzero(macro_mask[inverse]):
+        resolved = macros.resolve(hostids[i], uniques[inverse[i]])
+        result[i] = parse_interval(resolved, default_unit)
+        pass
+      pass
+    pass
+  return result
+
+
+def estimate_bytes(delays, histories, trends,
+                   hostids=None, macros=None, legacy_units=False):
+  '''
+  Returns (history_bytes, trend_bytes, invalid) arrays, one element per
+  item. invalid marks items whose columns could not be parsed; they are
+  counted as 0 bytes. Items without a regular delay (trappers, or
+  scheduling-only intervals) contribute no history rows.
+  '''
+  history_unit = _SECONDS_PER_DAY if legacy_units else 1
+  delay_s = parse_column(delays, 1, hostids, macros)
+  history_s = parse_column(histories, history_unit, hostids, macros)
+  trend_s = parse_column(trends, history_unit, hostids, macros)
+
+  invalid = (delay_s < 0) | (history_s < 0) | (trend_s < 0)
+  polled = (delay_s > 0) & ~invalid
+  history_bytes = np.zeros(len(delay_s), dtype=np.float64)
+  history_bytes[polled] = (history_s[polled] / delay_s[polled]
+                           * HISTORY_ROW_BYTES)
+  trend_bytes = np.where(invalid, 0.0, trend_s / 3600.0 * TREND_ROW_BYTES)
+  return history_bytes, trend_bytes, invalid
+
+
+def sum_by_index(index, weights, size):
+  '''Sums weights into size buckets, e.g. item bytes into hosts.'''
+  return np.bincount(index, weights=weights, minlength=size)
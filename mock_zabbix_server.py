@@ -0,0 +1,685 @@
+#!/usr/bin/python3
+#
+#   Copyright 2013 Daisuke Miyakawa (d.miyakawa@gmail.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+'''
+A stand-in Zabbix frontend serving a synthetic fleet over JSON-RPC,
+so that the scripts here can be tried and measured without a real
+server.
+
+E.g.
+> ./mock_zabbix_server.py --port 8080 --hosts 10000 --items-per-host 100
+> ./get_api_version.py http://localhost:8080/zabbix
+
+Hosts, items, history and trends are generated on the fly from their
+ids, so a fleet of 1M items costs almost no memory. Covered methods:
+user.login, apiinfo.version, host.get, hostgroup.get, hostinterface.get,
+item.get/create/delete, usermacro.get, history.get, trend.get,
+event.get and maintenance.get/create/update/delete.
+
+Two extra methods help benchmarks: "mock.stats" returns per-method call
+counts and bytes received/sent, "mock.reset" clears them.
+'''
+
+import argparse
+import fnmatch
+import itertools
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+_HOST_BASE = 10000
+_TEMPLATE_BASE = 90000
+# itemid = hostid * _ITEM_SPACE + index
+_ITEM_SPACE = 10000
+
+_value_types = [0, 0, 0, 3, 0, 0, 3, 0, 0, 1]
+
+
+class APIError(Exception):
+  def __init__(self, code, message, data):
+    Exception.__init__(self, message)
+    self.code = code
+    self.message = message
+    self.data = data
+    pass
+  pass
+
+
+def _as_list(value):
+  if value is None:
+    return None
+  if isinstance(value, (list, tuple)):
+    return [str(v) for v in value]
+  return [str(value)]
+
+
+def _project(objs, params):
+  if params.get('countOutput'):
+    return str(len(objs))
+  output = params.get('output', 'extend')
+  if output == 'extend':
+    result = objs
+  elif output in ('shorten', 'refer'):
+    result = [dict((k, v) for (k, v) in o.items() if k.endswith('id'))
+              for o in objs]
+  else:
+    result = [dict((k, o[k]) for k in output if k in o) for o in objs]
+    pass
+  limit = params.get('limit')
+  if limit:
+    result = result[:int(limit)]
+    pass
+  return result
+
+
+def _matches(obj, params):
+  for (field, wanted) in (params.get('filter') or {}).items():
+    if field not in obj:
+      continue
+    if str(obj[field]) not in _as_list(wanted):
+      return False
+    pass
+  for (field, pattern) in (params.get('search') or {}).items():
+    if field not in obj or pattern in (None, ''):
+      continue
+    value = str(obj[field]).lower()
+    pattern = str(pattern).lower()
+    if params.get('searchWildcardsEnabled') and '*' in pattern:
+      if not fnmatch.fnmatchcase(value, pattern):
+        return False
+    elif params.get('startSearch'):
+      if not value.startswith(pattern):
+        return False
+    elif pattern not in value:
+      return False
+    pass
+  return True
+
+
+class Fleet(object):
+  '''Synthetic hosts, templates, items and their history.'''
+  def __init__(self, hosts=1000, items_per_host=100, templates=10,
+               template_items=80, groups=10, version='4.0.0'):
+    self.version = version
+    self.modern_units = tuple(int(v) for v in version.split('.')[:2]) >= (3, 4)
+    self.template_items = min(template_items, items_per_host)
+    self.items_per_host = items_per_host
+    self.groups = [{'groupid': str(i + 1), 'name': 'Group {}'.format(i + 1)}
+                   for i in range(groups)]
+    self.templates = [{'hostid': str(_TEMPLATE_BASE + i),
+                       'templateid': str(_TEMPLATE_BASE + i),
+                       'host': 'Template {}'.format(i + 1),
+                       'name': 'Template {}'.format(i + 1),
+                       'status': '3'}
+                      for i in range(templates)]
+    self.hosts = []
+    for i in range(hosts):
+      hostid = _HOST_BASE + i + 1
+      self.hosts.append({'hostid': str(hostid),
+                         'host': 'host{:05d}'.format(i + 1),
+                         'name': 'Host {:05d}'.format(i + 1),
+                         'status': '0',
+                         'available': '1',
+                         'groupid': self.groups[i % groups]['groupid'],
+                         'templateid': (self.templates[i % templates]['hostid']
+                                        if templates else None),
+                         })
+      pass
+    self._by_id = dict((h['hostid'], h) for h in self.hosts + self.templates)
+    self.template_ids = set(t['hostid'] for t in self.templates)
+    self.created_items = {}
+    self.deleted_items = set()
+    self.maintenances = {}
+    self._ids = itertools.count(1)
+    self.lock = threading.Lock()
+    pass
+
+  def _time_unit(self, seconds, legacy_unit):
+    if self.modern_units:
+      for (suffix, unit) in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds % unit == 0:
+          return '{}{}'.format(seconds // unit, suffix)
+        pass
+      return '{}s'.format(seconds)
+    return str(seconds // legacy_unit)
+
+  def _item(self, owner, index, templated_from=None):
+    delay = (30, 60, 60, 300, 3600)[index % 5]
+    itemid = int(owner['hostid']) * _ITEM_SPACE + index
+    template_itemid = '0'
+    if templated_from is not None:
+      template_itemid = str(int(templated_from) * _ITEM_SPACE + index)
+      pass
+    return {'itemid': str(itemid),
+            'hostid': owner['hostid'],
+            'name': 'Item {}'.format(index),
+            'key_': 'mock.key[{}]'.format(index),
+            'type': '0',
+            'value_type': str(_value_types[index % len(_value_types)]),
+            'delay': (self._time_unit(delay, 1) if self.modern_units
+                      else str(delay)),
+            'history': self._time_unit(7*86400, 86400),
+            'trends': self._time_unit(365*86400, 86400),
+            'status': '0',
+            'templateid': template_itemid,
+            'interfaceid': '0' if owner.get('status') == '3'
+                           else owner['hostid'],
+            }
+
+  def items_of(self, owner):
+    if owner.get('status') == '3':
+      items = [self._item(owner, j) for j in range(self.template_items)]
+    else:
+      items = []
+      for j in range(self.items_per_host):
+        templated_from = None
+        if j < self.template_items and owner['templateid']:
+          templated_from = owner['templateid']
+          pass
+        items.append(self._item(owner, j, templated_from))
+        pass
+      pass
+    items.extend(self.created_items.get(owner['hostid'], []))
+    return [i for i in items if i['itemid'] not in self.deleted_items]
+
+  def item(self, itemid):
+    owner = self._by_id.get(str(int(itemid) // _ITEM_SPACE))
+    if owner is None:
+      return None
+    for item in self.items_of(owner):
+      if item['itemid'] == str(itemid):
+        return item
+      pass
+    return None
+
+  def owners(self, params):
+    '''Hosts/templates selected by hostids, groupids and filter.host.'''
+    owners = self.hosts + self.templates
+    hostids = _as_list(params.get('hostids'))
+    if hostids is not None:
+      owners = [self._by_id[h] for h in hostids if h in self._by_id]
+      pass
+    groupids = _as_list(params.get('groupids'))
+    if groupids is not None:
+      owners = [o for o in owners if o.get('groupid') in groupids]
+      pass
+    hosts = _as_list((params.get('filter') or {}).get('host'))
+    if hosts is not None:
+      owners = [o for o in owners if o['host'] in hosts]
+      pass
+    return owners
+
+  @staticmethod
+  def seconds(value, legacy_unit=1):
+    value = str(value)
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value[-1:] in units:
+      return int(value[:-1]) * units[value[-1]]
+    return int(value) * legacy_unit
+
+  def clocks(self, item, time_from, time_till):
+    delay = self.seconds(item['delay'])
+    start = time_from + (-time_from) % delay
+    return range(start, time_till + 1, delay)
+
+  @staticmethod
+  def value(itemid, clock):
+    phase = int(itemid) % 97
+    return 50 + 40 * math.sin((clock / 3600.0 + phase) / 4.0)
+  pass
+
+
+class MockZabbix(object):
+  def __init__(self, fleet, latency=0.0, jitter=0.0, workers=0,
+               error_rate=0.0, slow_rate=0.0, slow=0.0):
+    self.fleet = fleet
+    self.latency = latency
+    self.jitter = jitter
+    # A flaky link: some calls get HTTP 503, some take slow seconds more.
+    self.error_rate = error_rate
+    self.slow_rate = slow_rate
+    self.slow = slow
+    # Like a PHP-FPM pool: calls beyond workers wait for a free one.
+    self.workers = threading.Semaphore(workers) if workers else None
+    self.tokens = set()
+    self.stats = {}
+    self.stats_lock = threading.Lock()
+    pass
+
+  def record(self, method, received, sent):
+    with self.stats_lock:
+      entry = self.stats.setdefault(method, {'calls': 0, 'received': 0,
+                                             'sent': 0})
+      entry['calls'] += 1
+      entry['received'] += received
+      entry['sent'] += sent
+      pass
+    pass
+
+  def handle(self, request):
+    method = request.get('method', '')
+    params = request.get('params')
+    if params is None:
+      params = {}
+      pass
+    if method not in ('user.login', 'apiinfo.version', 'mock.stats',
+                      'mock.reset'):
+      if request.get('auth') not in self.tokens:
+        raise APIError(-32602, 'Invalid params.',
+                       'Session terminated, re-login, please.')
+      pass
+    handler = getattr(self, 'api_' + method.replace('.', '_'), None)
+    if handler is None:
+      raise APIError(-32602, 'Invalid params.',
+                     'Method "{}" is not supported.'.format(method))
+    if self.workers is None or method.startswith('mock.'):
+      return self._run(handler, params)
+    with self.workers:
+      return self._run(handler, params)
+
+  def _run(self, handler, params):
+    if self.latency or self.jitter:
+      time.sleep(self.latency + random.random() * self.jitter)
+      pass
+    if self.slow_rate and random.random() < self.slow_rate:
+      time.sleep(self.slow)
+      pass
+    return handler(params)
+
+  def fails(self, method):
+    '''Whether this call of method is answered with HTTP 503.'''
+    return (self.error_rate > 0 and not method.startswith('mock.')
+            and random.random() < self.error_rate)
+
+  def api_user_login(self, params):
+    token = '{:032x}'.format(random.getrandbits(128))
+    self.tokens.add(token)
+    return token
+
+  def api_apiinfo_version(self, params):
+    return self.fleet.version
+
+  def api_mock_stats(self, params):
+    with self.stats_lock:
+      return json.loads(json.dumps(self.stats))
+
+  def api_mock_reset(self, params):
+    with self.stats_lock:
+      self.stats = {}
+      pass
+    return True
+
+  def api_host_get(self, params):
+    hosts = [h for h in self.fleet.owners(params) if h.get('status') != '3']
+    hosts = [h for h in hosts if _matches(h, params)]
+    result = _project(hosts, params)
+    if not isinstance(result, list):
+      return result
+    result = [dict(r) for r in result]
+    for (h, r) in zip(hosts, result):
+      if params.get('selectParentTemplates'):
+        r['parentTemplates'] = _project(
+          [self.fleet._by_id[h['templateid']]] if h['templateid'] else [],
+          {'output': params['selectParentTemplates']})
+        pass
+      if params.get('selectGroups'):
+        r['groups'] = _project(
+          [g for g in self.fleet.groups if g['groupid'] == h['groupid']],
+          {'output': params['selectGroups']})
+        pass
+      if params.get('selectInterfaces'):
+        r['interfaces'] = self.api_hostinterface_get(
+          {'hostids': [h['hostid']], 'output': params['selectInterfaces']})
+        pass
+      pass
+    return result
+
+  def api_hostgroup_get(self, params):
+    groups = [g for g in self.fleet.groups if _matches(g, params)]
+    result = _project(groups, params)
+    if params.get('selectHosts') and isinstance(result, list):
+      fields = params['selectHosts']
+      for (g, r) in zip(groups, result):
+        members = [h for h in self.fleet.hosts
+                   if h['groupid'] == g['groupid']]
+        r['hosts'] = _project(members, {'output': fields})
+        pass
+      pass
+    return result
+
+  def api_hostinterface_get(self, params):
+    interfaces = [{'interfaceid': h['hostid'], 'hostid': h['hostid'],
+                   'main': '1', 'type': '1', 'ip': '127.0.0.1',
+                   'dns': '', 'port': '10050', 'useip': '1'}
+                  for h in self.fleet.owners(params)
+                  if h.get('status') != '3']
+    return _project(interfaces, params)
+
+  def api_item_get(self, params):
+    itemids = _as_list(params.get('itemids'))
+    if itemids is not None:
+      items = [i for i in (self.fleet.item(x) for x in itemids) if i]
+    else:
+      items = []
+      for owner in self.fleet.owners(params):
+        items.extend(self.fleet.items_of(owner))
+        pass
+      pass
+    templated = params.get('templated')
+    if templated is not None:
+      items = [i for i in items
+               if (i['hostid'] in self.fleet.template_ids) == bool(templated)]
+      pass
+    inherited = params.get('inherited')
+    if inherited is not None:
+      items = [i for i in items
+               if (i['templateid'] != '0') == bool(inherited)]
+      pass
+    items = [i for i in items if _matches(i, params)]
+    result = _project(items, params)
+    if params.get('selectHosts') and isinstance(result, list):
+      for (i, r) in zip(items, result):
+        owner = self.fleet._by_id[i['hostid']]
+        r['hosts'] = _project([owner], {'output': params['selectHosts']})
+        pass
+      pass
+    return result
+
+  def api_item_create(self, params):
+    if isinstance(params, dict):
+      params = [params]
+      pass
+    itemids = []
+    with self.fleet.lock:
+      for p in params:
+        owner = self.fleet._by_id[str(p['hostid'])]
+        created = self.fleet.created_items.setdefault(owner['hostid'], [])
+        index = self.fleet.items_per_host + 1000 + len(created)
+        item = self.fleet._item(owner, index)
+        item.update(dict((k, str(v)) for (k, v) in p.items()))
+        created.append(item)
+        itemids.append(item['itemid'])
+        pass
+      pass
+    return {'itemids': itemids}
+
+  def api_item_delete(self, params):
+    itemids = _as_list(params.get('itemids') if isinstance(params, dict)
+                       else params)
+    with self.fleet.lock:
+      self.fleet.deleted_items.update(itemids)
+      pass
+    return {'itemids': itemids}
+
+  def api_usermacro_get(self, params):
+    if params.get('globalmacro'):
+      macros = [{'globalmacroid': '1', 'macro': '{$HISTORY}',
+                 'value': '7d' if self.fleet.modern_units else '7'}]
+    else:
+      macros = [{'hostmacroid': h['hostid'], 'hostid': h['hostid'],
+                 'macro': '{$INTERVAL}', 'value': '1m'}
+                for h in self.fleet.owners(params)]
+      pass
+    return _project(macros, params)
+
+  def _history_items(self, params):
+    itemids = _as_list(params.get('itemids'))
+    if itemids is not None:
+      return [i for i in (self.fleet.item(x) for x in itemids) if i]
+    items = []
+    for owner in self.fleet.owners(params):
+      items.extend(self.fleet.items_of(owner))
+      pass
+    return items
+
+  def api_history_get(self, params):
+    value_type = str(params.get('history', 3))
+    time_till = int(params.get('time_till', time.time()))
+    time_from = int(params.get('time_from', time_till - 3600))
+    items = [i for i in self._history_items(params)
+             if i['value_type'] == value_type
+             and i['hostid'] not in self.fleet.template_ids]
+    if params.get('countOutput'):
+      return str(sum(len(self.fleet.clocks(i, time_from, time_till))
+                     for i in items))
+    rows = []
+    limit = int(params.get('limit') or 0)
+    for item in items:
+      for clock in self.fleet.clocks(item, time_from, time_till):
+        value = Fleet.value(item['itemid'], clock)
+        if value_type == '3':
+          value = int(value)
+          pass
+        rows.append({'itemid': item['itemid'], 'clock': str(clock),
+                     'value': str(value), 'ns': '0'})
+        if limit and len(rows) >= limit:
+          break
+        pass
+      pass
+    if params.get('sortfield') == 'clock':
+      rows.sort(key=lambda r: int(r['clock']),
+                reverse=params.get('sortorder') == 'DESC')
+      pass
+    return _project(rows, dict(params, limit=limit))
+
+  def api_trend_get(self, params):
+    time_till = int(params.get('time_till', time.time()))
+    time_from = int(params.get('time_from', time_till - 86400))
+    rows = []
+    for item in self._history_items(params):
+      start = time_from + (-time_from) % 3600
+      for clock in range(start, time_till + 1, 3600):
+        values = [Fleet.value(item['itemid'], c)
+                  for c in self.fleet.clocks(item, clock, clock + 3599)]
+        if not values:
+          continue
+        rows.append({'itemid': item['itemid'], 'clock': str(clock),
+                     'num': str(len(values)),
+                     'value_min': str(min(values)),
+                     'value_avg': str(sum(values) / len(values)),
+                     'value_max': str(max(values))})
+        pass
+      pass
+    return _project(rows, params)
+
+  def api_event_get(self, params):
+    time_till = int(params.get('time_till', time.time()))
+    time_from = int(params.get('time_from', time_till - 3600))
+    hours = max(0, time_till - time_from) // 3600
+    count = sum((int(h['hostid']) % 7) * hours
+                for h in self.fleet.owners(params))
+    if params.get('countOutput'):
+      return str(count)
+    return []
+
+  def api_maintenance_get(self, params):
+    maintenances = list(self.fleet.maintenances.values())
+    ids = _as_list(params.get('maintenanceids'))
+    if ids is not None:
+      maintenances = [m for m in maintenances if m['maintenanceid'] in ids]
+      pass
+    maintenances = [m for m in maintenances if _matches(m, params)]
+    return _project(maintenances, params)
+
+  def _maintenance(self, params):
+    result = dict(params)
+    for key in ('hostids', 'groupids'):
+      if key in result:
+        result[key] = _as_list(result[key])
+        pass
+      pass
+    return result
+
+  def api_maintenance_create(self, params):
+    if isinstance(params, dict):
+      params = [params]
+      pass
+    ids = []
+    with self.fleet.lock:
+      for p in params:
+        for m in self.fleet.maintenances.values():
+          if m['name'] == p['name']:
+            raise APIError(-32602, 'Invalid params.',
+                           'Maintenance "{}" already exists.'
+                           .format(p['name']))
+          pass
+        maintenanceid = str(next(self.fleet._ids))
+        self.fleet.maintenances[maintenanceid] = dict(
+          self._maintenance(p), maintenanceid=maintenanceid)
+        ids.append(maintenanceid)
+        pass
+      pass
+    return {'maintenanceids': ids}
+
+  def api_maintenance_update(self, params):
+    if isinstance(params, dict):
+      params = [params]
+      pass
+    ids = []
+    with self.fleet.lock:
+      for p in params:
+        maintenanceid = str(p['maintenanceid'])
+        self.fleet.maintenances[maintenanceid].update(self._maintenance(p))
+        ids.append(maintenanceid)
+        pass
+      pass
+    return {'maintenanceids': ids}
+
+  def api_maintenance_delete(self, params):
+    ids = _as_list(params)
+    with self.fleet.lock:
+      for maintenanceid in ids:
+        self.fleet.maintenances.pop(maintenanceid, None)
+        pass
+      pass
+    return {'maintenanceids': ids}
+  pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately; without this every
+  # keep-alive response waits for a delayed ACK.
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    mock = self.server.mock
+    request = {}
+    try:
+      request = json.loads(body.decode('utf-8'))
+      if mock.fails(request.get('method', '')):
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      response = {'jsonrpc': '2.0', 'result': mock.handle(request),
+                  'id': request.get('id')}
+    except APIError as e:
+      response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                  'error': {'code': e.code, 'message': e.message,
+                            'data': e.data}}
+    except (ValueError, KeyError, TypeError) as e:
+      response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                  'error': {'code': -32602, 'message': 'Invalid params.',
+                            'data': str(e)}}
+      pass
+    data = json.dumps(response).encode('utf-8')
+    if request.get('method') not in ('mock.stats', 'mock.reset'):
+      mock.record(request.get('method', ''), len(body), len(data))
+      pass
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+    pass
+  pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, mock):
+    HTTPServer.__init__(self, address, _Handler)
+    self.mock = mock
+    pass
+
+  def handle_error(self, request, client_address):
+    # Clients stopping early in a streamed response reset the connection.
+    if not isinstance(sys.exc_info()[1], socket.error):
+      HTTPServer.handle_error(self, request, client_address)
+      pass
+    pass
+  pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Stand-in Zabbix API server')
+  parser.add_argument('--bind', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--hosts', type=int, default=1000)
+  parser.add_argument('--items-per-host', type=int, default=100)
+  parser.add_argument('--templates', type=int, default=10)
+  parser.add_argument('--template-items', type=int, default=80,
+                      help='How many items of each host come from its template')
+  parser.add_argument('--groups', type=int, default=10)
+  parser.add_argument('--version', default='4.0.0',
+                      help='Version returned by apiinfo.version')
+  parser.add_argument('--latency-ms', type=float, default=0,
+                      help='Delay added to every call')
+  parser.add_argument('--jitter-ms', type=float, default=0,
+                      help='Random delay of up to this much on top')
+  parser.add_argument('--workers', type=int, default=0,
+                      help=('Calls served at once; others queue, like on'
+                            ' a frontend with that many PHP workers'
+                            ' (0: no limit)'))
+  parser.add_argument('--error-rate', type=float, default=0,
+                      help='Fraction of calls answered with HTTP 503')
+  parser.add_argument('--slow-rate', type=float, default=0,
+                      help='Fraction of calls delayed by --slow-ms')
+  parser.add_argument('--slow-ms', type=float, default=1000)
+  args = parser.parse_args()
+
+  fleet = Fleet(args.hosts, args.items_per_host, args.templates,
+                args.template_items, args.groups, args.version)
+  mock = MockZabbix(fleet, args.latency_ms / 1000.0, args.jitter_ms / 1000.0,
+                    args.workers, args.error_rate, args.slow_rate,
+                    args.slow_ms / 1000.0)
+  server = MockServer((args.bind, args.port), mock)
+  print('Serving {} hosts / {} items at http://{}:{}/zabbix'
+        .format(args.hosts, args.hosts * args.items_per_host,
+                args.bind, server.server_address[1]))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#
+#   Copyright 2013 Daisuke Miyakawa (d.miyakawa@gmail.com)
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+'''
+Runs the scripts of this repository against mock_zabbix_server.py and
+records wall time, API calls, bytes sent/received by the server and
+peak RSS of each run.
+
+E.g.
+> ./run_benchmarks.py --hosts 10000 --items-per-host 100 --latency-ms 5
+> ./run_benchmarks.py --only estimate --repeat 3
+
+Every result is appended as one JSON line to bench_output.txt (see
+--output) together with "git describe", so runs of different versions
+can be compared later.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from lib import client
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+# (name, command line). {url} is the mock server, {tmp} a scratch
+# directory of the run.
+_scenarios = [
+  ('api_version', ['get_api_version.py', '{url}']),
+  ('host_info', ['get_host_info.py', '{url}',
+                 '-u', 'Admin', '-p', 'zabbix']),
+  ('estimate', ['estimate_database_size.py', '--url', '{url}',
+                '-p', 'zabbix']),
+  ('estimate_jobs', ['estimate_database_size.py', '--url', '{url}',
+                     '-p', 'zabbix', '--jobs', '8']),
+  ('estimate_aio', ['estimate_database_size.py', '--url', '{url}',
+                    '-p', 'zabbix', '--aio', '--jobs', '32']),
+  ('estimate_adaptive', ['estimate_database_size.py', '--url', '{url}',
+                         '-p', 'zabbix', '--adaptive']),
+  ('estimate_template', ['estimate_database_size.py', '--url', '{url}',
+                         '-p', 'zabbix', '--template']),
+  ('estimate_observe', ['estimate_database_size.py', '--url', '{url}',
+                        '-p', 'zabbix', '--observe', '1']),
+  ('maintenance_groups', ['start_maintenance.py', '{url}',
+                          '--password', 'zabbix', '-d',
+                          '--groups', 'Group 1', 'Group 2']),
+  ('maintenance_targets', ['start_maintenance.py', '{url}',
+                           '--password', 'zabbix', '-d',
+                           '--targets', 'host0000*', 're:^host001[0-9]+$']),
+  ('add_items', ['add_item_to_host.py', '{url}', '-u', 'Admin',
+                 '-p', 'zabbix', '-r', '--manifest', '{tmp}/manifest.csv']),
+  ('history_batch', ['show_item_history_with_gnuplot.py', '{url}',
+                     '-u', 'Admin', '-p', 'zabbix', '--group', 'Group 1',
+                     '--key', 'mock.key[1]', '--from=-7d',
+                     '-o', '{tmp}']),
+]
+
+
+def _free_port():
+  s = socket.socket()
+  s.bind(('127.0.0.1', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+
+def start_mock(args):
+  port = _free_port()
+  command = [sys.executable, os.path.join(_here, 'mock_zabbix_server.py'),
+             '--port', str(port),
+             '--hosts', str(args.hosts),
+             '--items-per-host', str(args.items_per_host),
+             '--templates', str(args.templates),
+             '--groups', str(args.groups),
+             '--version', args.api_version,
+             '--latency-ms', str(args.latency_ms),
+             '--jitter-ms', str(args.jitter_ms),
+             '--workers', str(args.workers)]
+  process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+  deadline = time.time() + 60
+  while time.time() < deadline:
+    try:
+      socket.create_connection(('127.0.0.1', port), 1).close()
+      return (process, 'http://127.0.0.1:{}/zabbix'.format(port))
+    except (IOError, OSError):
+      time.sleep(0.1)
+      pass
+    pass
+  process.kill()
+  raise RuntimeError('Mock server did not start')
+
+
+def write_manifest(path, hosts, count):
+  with open(path, 'w') as f:
+    f.write('host,key,name,delay\n')
+    for i in range(count):
+      f.write('host{:05d},bench.key[{}],Bench item {},60\n'
+              .format(i % hosts + 1, i, i))
+      pass
+    pass
+  pass
+
+
+def run_scenario(name, command, mock, url, tmp):
+  '''Runs command once and returns its measurements as a dict.'''
+  command = [c.format(url=url, tmp=tmp) for c in command]
+  command = [sys.executable, os.path.join(_here, command[0])] + command[1:]
+  mock.call('mock.reset')
+  env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, 'cache'))
+  start = time.time()
+  process = subprocess.Popen(command, cwd=_here, env=env,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+  stderr = process.stderr.read()
+  (_, status, usage) = os.wait4(process.pid, 0)
+  wall = time.time() - start
+  stats = mock.call('mock.stats')
+  return {'scenario': name,
+          'status': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+          'wall_seconds': round(wall, 3),
+          'api_calls': sum(s['calls'] for s in stats.values()),
+          'bytes_received': sum(s['received'] for s in stats.values()),
+          'bytes_sent': sum(s['sent'] for s in stats.values()),
+          # kilobytes on Linux
+          'max_rss_kb': usage.ru_maxrss,
+          'calls_by_method': dict((m, s['calls'])
+                                  for (m, s) in stats.items()),
+          'error': (stderr.decode('utf-8', 'replace').strip()
+                    .splitlines() or [''])[-1] if status else '',
+          }
+
+
+def _git_version():
+  try:
+    return subprocess.check_output(
+      ['git', 'describe', '--always', '--dirty'], cwd=_here,
+      stderr=subprocess.DEVNULL).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+  pass
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Benchmark the scripts against mock_zabbix_server.py')
+  parser.add_argument('--only', nargs='*',
+                      help=('Run scenarios whose name starts with one of'
+                            ' these. Available: {}'
+                            .format(', '.join(n for (n, _) in _scenarios))))
+  parser.add_argument('--repeat', type=int, default=1)
+  parser.add_argument('--output', default=os.path.join(_here,
+                                                       'bench_output.txt'),
+                      help='File results are appended to as JSON lines')
+  parser.add_argument('--hosts', type=int, default=1000)
+  parser.add_argument('--items-per-host', type=int, default=100)
+  parser.add_argument('--templates', type=int, default=10)
+  parser.add_argument('--groups', type=int, default=10)
+  parser.add_argument('--manifest-items', type=int, default=1000)
+  parser.add_argument('--api-version', default='4.0.0')
+  parser.add_argument('--latency-ms', type=float, default=0)
+  parser.add_argument('--jitter-ms', type=float, default=0)
+  parser.add_argument('--workers', type=int, default=0,
+                      help='Calls the mock server serves at once (0: any)')
+  args = parser.parse_args()
+
+  scenarios = [(n, c) for (n, c) in _scenarios
+               if not args.only or any(n.startswith(o) for o in args.only)]
+  version = _git_version()
+  fleet = {'hosts': args.hosts, 'items_per_host': args.items_per_host,
+           'templates': args.templates, 'groups': args.groups,
+           'api_version': args.api_version, 'latency_ms': args.latency_ms,
+           'jitter_ms': args.jitter_ms, 'workers': args.workers}
+
+  (process, url) = start_mock(args)
+  tmp = tempfile.mkdtemp(prefix='zabbix_bench_')
+  try:
+    mock = client.ZabbixClient(url)
+    write_manifest(os.path.join(tmp, 'manifest.csv'), args.hosts,
+                   args.manifest_items)
+    print('{:<22} {:>6} {:>9} {:>7} {:>11} {:>11} {:>9}'
+          .format('scenario', 'status', 'wall(s)', 'calls', 'recv(B)',
+                  'sent(B)', 'rss(MB)'))
+    with open(args.output, 'a') as output:
+      for (name, command) in scenarios:
+        for _ in range(args.repeat):
+          result = run_scenario(name, command, mock, url, tmp)
+          result.update(version=version, time=int(time.time()), fleet=fleet)
+          output.write(json.dumps(result, sort_keys=True) + '\n')
+          print('{:<22} {:>6} {:>9.3f} {:>7} {:>11} {:>11} {:>9.1f}'
+                .format(name, result['status'], result['wall_seconds'],
+                        result['api_calls'], result['bytes_received'],
+                        result['bytes_sent'],
+                        result['max_rss_kb'] / 1024.0))
+          if result['status']:
+            print('  {}'.format(result['error']))
+            pass
+          pass
+        pass
+      pass
+  finally:
+    process.terminate()
+    process.wait()
+    shutil.rmtree(tmp, ignore_errors=True)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.7
+#!/usr/bin/python3
 # -*- encoding: utf-8 -*-
 #
 #   Copyright 2013 Daisuke Miyakawa (d.miyakawa@gmail.com)
@@ -25,26 +25,92 @@ You need to install gnuplot and its python interface.
 E.g.
 > ./get_item_stat.py (zabbix) (target host) system.cpu.util[,system,avg1]
 
-By default data in last 6 hours will be shown. There's no option to
-enlarge (shorten) it.
+By default data in last 6 hours will be shown. Use --from/--till
+(e.g. "--from -30d", "--from 2013-06-01 --till 2013-06-02") for other
+ranges. Long ranges are fetched in time shards (--shard-hours), several
+at a time (--max-workers).
+
+When raw history over the range would be too large (--max-raw-points)
+or is already gone, hourly trends (min/avg/max) are plotted instead.
+Either way the series is reduced to --points points with LTTB before
+it is handed to gnuplot (--points 0 writes every point as it arrives).
+
+With --cache, raw history of numeric items is kept on disk and later
+runs only download what is newer than the cached data.
+
+Batch mode renders many graphs to files without any interaction:
+
+> ./show_item_history_with_gnuplot.py (zabbix) --batch pairs.txt -o graphs
+> ./show_item_history_with_gnuplot.py (zabbix) --group 'Linux servers' \
+    --key 'system.cpu.util*' -o graphs --format svg
+
+pairs.txt has one "host key" pair per line. Series are fetched
+concurrently, binned onto one shared time grid and rendered by gnuplot
+processes in parallel (only the gnuplot binary is needed for this).
 
 '''
 
-from extlib.zabbix_api import ZabbixAPI
+from lib import client
 from lib import config
+from lib import history
+from lib import history_cache
+from lib import render
+from lib import resolution
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pprint
 import os
+import re
 import sys
 import tempfile
 import time
 
-import Gnuplot
 
-def get_item_stat(server, username, password, log_level, host, key):
-  zapi = ZabbixAPI(server=server, log_level=log_level)
-  zapi.login(username, password)
+def _write_columns(f, columns):
+  for row in zip(*columns):
+    f.write('{:.0f} {}\n'.format(row[0],
+                                 ' '.join('{:.10g}'.format(v)
+                                          for v in row[1:])))
+    pass
+  pass
+
+
+def _make_fetcher(zapi, item, plan, shard_hours, max_workers):
+  # A single history.get over a long range may make your Zabbix server
+  # unresponsive, so the range is split into shards of shard_hours.
+  #
+  # See: https://www.zabbix.com/documentation/1.8/api/history/get
+  return history.ShardedHistoryFetcher(
+    zapi.clone,
+    item['itemid'], value_type=item.get('value_type', 0),
+    shard_seconds=int(shard_hours*60*60), max_workers=max_workers,
+    method=plan.method, output=plan.output)
+
+
+def _fetch_columns(fetcher, item, plan, time_from, time_till, cache, now):
+  '''
+  Returns [clock, value, ...] arrays of item, through cache when given
+  and the plan uses raw numeric history.
+  '''
+  if (cache is not None and plan.method == 'history'
+      and int(item.get('value_type', 0)) in (0, 3)):
+    return list(cache.get(
+      item['itemid'],
+      lambda a, b: resolution.rows_to_columns(fetcher.iter_shards(a, b),
+                                              plan.output),
+      time_from, time_till, now=now))
+  return resolution.rows_to_columns(fetcher.iter_shards(time_from, time_till),
+                                    plan.output)
+
+
+def get_item_stat(server, username, password, log_level, host, key,
+                  time_from=None, time_till=None, shard_hours=6,
+                  max_workers=4, points=2000, max_raw_points=50000,
+                  cache=None):
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
+  version = zapi.api_version()
 
   item = zapi.item.get({ 'filter': {'host': host, 'key_': key},
                            'output': 'extend' })
@@ -54,71 +120,274 @@ def get_item_stat(server, username, password, log_level, host, key):
   pprint.pprint(item)
   print('itemid: {}'.format(itemid))
 
-  # If this is set too long, your Zabbix server may not respond well.
-  now = time.time()
-  time_from = int(now - 6*60*60)
-  time_till = int(now)
+  now = int(time.time())
+  if time_from is None:
+    time_from = now - 6*60*60
+    pass
+  if time_till is None:
+    time_till = now
+    pass
 
-  # See: https://www.zabbix.com/documentation/1.8/api/history/get
-  #
-  # All parameters are optional except "history".
-  # If parameter is set in query, this option is considered
-  # as being ON, except if parameter is equal to NULL.
-  results = zapi.history.get({'history': 0, # Numeric (float)
-                              'itemids': [itemid], 
-                              'output': 'extend',
-                              'time_from': time_from,
-                              'time_till': time_till,
-                              # 'limit': 300,
-                              })
-
-  if len(results) == 0:
-    print('Empty result. Exitting')
-    sys.exit(1)
-    return
+  plan = resolution.plan(item[0], version, time_from, time_till,
+                         max_raw_points=max_raw_points, now=now)
+  print('Using {}'.format(plan))
+  fetcher = _make_fetcher(zapi, item[0], plan, shard_hours, max_workers)
 
   (fd, filename) = tempfile.mkstemp(text=1)
   f = os.fdopen(fd, 'w')
   try:
-    min_clock = -1
-    max_clock = -1
-    for result in results:
-      clock = int(result['clock'])
-      value = result['value']
-      if min_clock < 0:
-        min_clock = clock
-      else:
-        min_clock = min(clock, min_clock)
+    if cache is not None or points > 0:
+      columns = _fetch_columns(fetcher, item[0], plan, time_from, time_till,
+                               cache, now)
+      count = len(columns[0])
+      if points > 0:
+        columns = resolution.downsample(columns, points)
         pass
-      if max_clock < 0:
-        max_clock = clock
-      else:
-        max_clock = max(clock, max_clock)
+      _write_columns(f, columns)
+      if count > 0:
+        min_clock = int(columns[0].min())
+        max_clock = int(columns[0].max())
         pass
-      f.write('{} {}\n'.format(clock, value))
       pass
+    else:
+      min_clock = -1
+      max_clock = -1
+      count = 0
+      for rows in fetcher.iter_shards(time_from, time_till):
+        for result in rows:
+          clock = int(result['clock'])
+          if min_clock < 0:
+            min_clock = clock
+          else:
+            min_clock = min(clock, min_clock)
+            pass
+          if max_clock < 0:
+            max_clock = clock
+          else:
+            max_clock = max(clock, max_clock)
+            pass
+          f.write('{} {}\n'.format(
+              clock, ' '.join(result[k] for k in plan.output[1:])))
+          count += 1
+          pass
+        pass
+      pass
+
+    if count == 0:
+      print('Empty result. Exitting')
+      sys.exit(1)
+      return
+
     min_t = time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(min_clock))
     max_t = time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(max_clock))
-    print ('{} ({})-{} ({}) '.format(min_clock, min_t, max_clock, max_t))
+    print('{} ({})-{} ({}), {} points'.format(min_clock, min_t,
+                                               max_clock, max_t, count))
     f.close()
+    # Imported here so that batch mode works without the python interface.
+    import Gnuplot
     g = Gnuplot.Gnuplot()
     # g.set_range('yrange', (0,1))
-    g.plot(Gnuplot.File(filename, using=(1,2), with_='lines'))
-    raw_input('Press return to finish\n')
+    if plan.method == 'trend':
+      g.plot(Gnuplot.File(filename, using=(1,2), with_='lines', title='avg'),
+             Gnuplot.File(filename, using=(1,3), with_='lines', title='min'),
+             Gnuplot.File(filename, using=(1,4), with_='lines', title='max'))
+    else:
+      g.plot(Gnuplot.File(filename, using=(1,2), with_='lines'))
+      pass
+    input('Press return to finish\n')
   finally:
     os.unlink(filename)
     pass
   pass
 
 
+def _read_pairs(filename):
+  pairs = []
+  with open(filename) as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      (host, key) = line.split(None, 1)
+      pairs.append((host, key.strip()))
+      pass
+    pass
+  return pairs
+
+
+_ITEM_OUTPUT = ['itemid', 'key_', 'value_type', 'delay', 'history']
+
+
+def _find_items(zapi, pairs=None, group=None, key_pattern=None):
+  '''
+  Returns items (with a "host" field) for (host, key) pairs or for a
+  host group and a key pattern ("*" is a wildcard), in few item.get calls.
+  '''
+  params = {'output': _ITEM_OUTPUT, 'selectHosts': ['host']}
+  if pairs:
+    params['filter'] = {'host': sorted(set(p[0] for p in pairs)),
+                        'key_': sorted(set(p[1] for p in pairs))}
+  else:
+    groups = zapi.hostgroup.get({'filter': {'name': [group]},
+                                 'output': ['groupid']})
+    if not groups:
+      print('No host group "{}"'.format(group))
+      sys.exit(1)
+      return
+    params['groupids'] = [g['groupid'] for g in groups]
+    params['search'] = {'key_': key_pattern}
+    params['searchWildcardsEnabled'] = True
+    # Only numeric float and unsigned items can be plotted.
+    params['filter'] = {'value_type': ['0', '3']}
+    pass
+  items = []
+  for item in zapi.item.get(params):
+    item['host'] = item['hosts'][0]['host']
+    items.append(item)
+    pass
+  if pairs:
+    # The filter above matches every host with every key.
+    order = dict((pair, i) for (i, pair) in enumerate(pairs))
+    items = [i for i in items if (i['host'], i['key_']) in order]
+    items.sort(key=lambda i: order[(i['host'], i['key_'])])
+  else:
+    items.sort(key=lambda i: (i['host'], i['key_']))
+    pass
+  for item in items:
+    if str(item['value_type']) not in ('0', '3'):
+      print('Skipping "{}" on {}: not a numeric item'.format(item['key_'],
+                                                          item['host']))
+      pass
+    pass
+  return [i for i in items if str(i['value_type']) in ('0', '3')]
+
+
+def render_batch(server, username, password, log_level, output_dir,
+                 pairs=None, group=None, key_pattern=None,
+                 time_from=None, time_till=None, shard_hours=6,
+                 max_workers=4, points=2000, max_raw_points=50000,
+                 cache=None, fmt='png', render_workers=None):
+  zapi = client.get_client(server, username, password, flavor='extlib',
+                           log_level=log_level)
+  version = zapi.api_version()
+
+  now = int(time.time())
+  if time_from is None:
+    time_from = now - 6*60*60
+    pass
+  if time_till is None:
+    time_till = now
+    pass
+
+  items = _find_items(zapi, pairs, group, key_pattern)
+  print('{} graphs to render'.format(len(items)))
+  # With --points 0 every graph keeps its own raw timestamps.
+  grid = (resolution.make_grid(time_from, time_till, points)
+          if points > 0 else None)
+
+  def fetch(item):
+    start = time.time()
+    plan = resolution.plan(item, version, time_from, time_till,
+                           max_raw_points=max_raw_points, now=now)
+    # Concurrency comes from fetching many items at once here.
+    fetcher = _make_fetcher(zapi, item, plan, shard_hours, 1)
+    columns = _fetch_columns(fetcher, item, plan, time_from, time_till,
+                             cache, now)
+    if grid is None:
+      return ((columns[0], columns[1]), time.time() - start)
+    values = resolution.to_grid(grid, columns[0], columns[1])
+    return ((grid, values), time.time() - start)
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    fetched = list(executor.map(fetch, items))
+    pass
+
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+    pass
+  jobs = []
+  for (item, ((clocks, values), _)) in zip(items, fetched):
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_',
+                  '{}_{}'.format(item['host'], item['key_']))
+    jobs.append((os.path.join(output_dir, '{}.{}'.format(name, fmt)),
+                 '{}: {}'.format(item['host'], item['key_']),
+                 clocks, values, fmt))
+    pass
+  render_times = render.render_all(jobs, render_workers)
+
+  for (job, (_, fetch_time), render_time) in zip(jobs, fetched,
+                                                 render_times):
+    print('{}: fetch {:.2f}s, render {:.2f}s'.format(job[0], fetch_time,
+                                                     render_time))
+    pass
+  pass
+
+
 if __name__ == '__main__':
   parser = config.add_argparse_configs(argparse.ArgumentParser())
-  parser.add_argument('host', help='hostname')
-  parser.add_argument('key', help='item key')
-  
+  parser.add_argument('host', nargs='?', help='hostname')
+  parser.add_argument('key', nargs='?', help='item key')
+  parser.add_argument('--from', dest='time_from', type=history.parse_time,
+                      help=('Start of the range. "now", unix time, '
+                            '"-30d" or "2013-06-06 12:00". '
+                            'Default: 6 hours ago'))
+  parser.add_argument('--till', dest='time_till', type=history.parse_time,
+                      help='End of the range. Default: now')
+  parser.add_argument('--shard-hours', type=float, default=6,
+                      help='Length of the range fetched by one history.get')
+  parser.add_argument('--max-workers', type=int, default=4,
+                      help='Number of history.get calls run at once')
+  parser.add_argument('--points', type=int, default=2000,
+                      help='Number of points plotted (0: all of them)')
+  parser.add_argument('--max-raw-points', type=int, default=50000,
+                      help='Switch to trends above this many history rows')
+  parser.add_argument('--cache', action='store_true',
+                      help='Keep raw history on disk and only fetch new data')
+  parser.add_argument('--cache-dir', default=None,
+                      help=('Where to keep the cache. Default: {}'
+                            .format(history_cache.default_cache_dir())))
+  parser.add_argument('--cache-max-mb', type=int, default=512,
+                      help='Size of the cache before old items are evicted')
+  parser.add_argument('--batch', metavar='FILE',
+                      help='Render graphs of "host key" pairs listed in FILE')
+  parser.add_argument('--group', help='Render graphs of hosts in this group')
+  parser.add_argument('--key', dest='key_pattern',
+                      help='Item key pattern used with --group, e.g. "vfs.*"')
+  parser.add_argument('--output-dir', '-o', default='.',
+                      help='Where batch mode writes its graphs')
+  parser.add_argument('--format', choices=['png', 'svg'], default='png')
+  parser.add_argument('--render-workers', type=int, default=None,
+                      help='Number of gnuplot processes. Default: CPU count')
+
   args = parser.parse_args()
-  server = config.get_server_uri(args.server)
+  servers = config.get_server_uris(args.server, args.all_servers)
+  if len(servers) != 1:
+    parser.error('this script works on one server at a time')
+    pass
+  server = servers[0][1]
 
-  get_item_stat(server, args.username, args.password, args.log_level,
-                args.host, args.key)
+  cache = None
+  if args.cache:
+    cache = history_cache.HistoryCache(server, args.cache_dir,
+                                       args.cache_max_mb*1024*1024)
+    pass
+
+  if args.batch or args.group:
+    if args.group and not args.key_pattern:
+      parser.error('--group needs --key')
+      pass
+    pairs = _read_pairs(args.batch) if args.batch else None
+    render_batch(server, args.username, args.password, args.log_level,
+                 args.output_dir, pairs, args.group, args.key_pattern,
+                 args.time_from, args.time_till, args.shard_hours,
+                 args.max_workers, args.points, args.max_raw_points, cache,
+                 args.format, args.render_workers)
+  elif args.host and args.key:
+    get_item_stat(server, args.username, args.password, args.log_level,
+                  args.host, args.key, args.time_from, args.time_till,
+                  args.shard_hours, args.max_workers, args.points,
+                  args.max_raw_points, cache)
+  else:
+    parser.error('host and key are required unless --batch/--group is used')
+    pass
   pass
@@ -1,25 +1,494 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
-
 import argparse
 import getpass
 from logging import getLogger, StreamHandler
 from logging import DEBUG
 
 from datetime import datetime
+import fnmatch
+import hashlib
+import json
+import os
 import re
+import sys
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+import threading
 import time
-import pyzabbix
+
+from lib import client
+from lib import config
+from lib import fleet
+from lib import history
+from lib import metadata
+from lib import profiling
+from lib import records
+from lib import retry
 
 # 10h, 10hour, 10hours, 20m, 20min, 20mins, 30s, 30sec, 30secs
 r_period = re.compile(r'(\d+)((?:h(?:ours?)?)|(?:m(?:mins?)?)|(?:s(?:ecs?)?))')
 
+_HOST_FIELDS = ['hostid', 'name', 'host']
+_Host = records.record_type('Host', _HOST_FIELDS)
+
+# How long host group members are trusted before asking the server again.
+_GROUP_CACHE_TTL = 10 * 60
+
+
+def _group_cache_path(server):
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    digest = hashlib.sha1(server.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(base, 'zabbix_api_examples',
+                        'groups-{}.json'.format(digest))
+
+
+def _group_members(zapi, server, groups, logger, ttl=_GROUP_CACHE_TTL):
+    '''
+    Returns {group name: [host dict]} for those of groups which exist.
+    Members of each group are cached on disk for ttl seconds, so that
+    repeated runs do not resolve the same groups again.
+    '''
+    path = _group_cache_path(server)
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    now = time.time()
+    missing = sorted(set(g for g in groups
+                         if g not in cache or now - cache[g]['time'] > ttl))
+    if missing:
+        found = zapi.hostgroup.get(filter={'name': missing},
+                                   output=['groupid', 'name'],
+                                   selectHosts=_HOST_FIELDS)
+        for group in found:
+            cache[group['name']] = {'time': now, 'hosts': group['hosts']}
+        for name in set(missing) - set(g['name'] for g in found):
+            logger.error('No host group "{}"'.format(name))
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = '{}.{}'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.debug('Failed to write group cache: {}'.format(e))
+    else:
+        logger.debug('Using cached members of {}'.format(groups))
+    return dict((g, cache[g]['hosts']) for g in groups if g in cache)
+
+
+def resolve_groups(zapi, server, groups, logger, ttl=_GROUP_CACHE_TTL):
+    '''Returns hosts (hostid, name, host) belonging to any of groups.'''
+    members = _group_members(zapi, server, groups, logger, ttl)
+    hosts = []
+    for group in groups:
+        hosts.extend(_Host.from_dict(h) for h in members.get(group, []))
+    return hosts
+
+
+def _literal_prefix(regex):
+    '''
+    Returns (text, anchored): the plain text every match of a regular
+    expression starts with, and whether it is anchored at the start of
+    the name. The text is empty when the expression begins with anything
+    but literal characters, e.g. a top-level "|", a group or a class.
+    '''
+    ops = list(sre_parse.parse(regex))
+    anchored = bool(ops) and ops[0] == (sre_parse.AT, sre_parse.AT_BEGINNING)
+    prefix = []
+    for (op, value) in ops[1:] if anchored else ops:
+        if op != sre_parse.LITERAL:
+            break
+        prefix.append(chr(value))
+    return (''.join(prefix), anchored)
+
+
+def _is_glob(target):
+    return any(c in target for c in '*?[')
+
+
+def _glob_prefix(pattern):
+    '''Returns the plain text a glob pattern has to start with.'''
+    return re.split(r'[*?[]', pattern, 1)[0]
+
+
+def resolve_targets(zapi, targets, logger):
+    '''
+    Returns hosts (hostid, name, host) matching targets, each of which
+    is a host name, a glob pattern ("web*") or a regular expression
+    written as "re:<pattern>". Names are matched against both the
+    technical and the visible host name, filtered on the server side.
+    '''
+    names = [t for t in targets if not t.startswith('re:') and not _is_glob(t)]
+    hosts = []
+    if names:
+        for field in ('host', 'name'):
+            hosts.extend(_Host.from_dict(h)
+                         for h in zapi.host.get(filter={field: names},
+                                                output=_HOST_FIELDS))
+    for target in targets:
+        if target.startswith('re:'):
+            regex = re.compile(target[3:])
+            # Only the literal prefix of the regex can be searched for.
+            (prefix, anchored) = _literal_prefix(target[3:])
+            params = {}
+            if prefix:
+                params['search'] = {'host': prefix}
+                params['startSearch'] = anchored
+            candidates = zapi.host.get(output=_HOST_FIELDS, **params)
+            matched = [_Host.from_dict(h) for h in candidates
+                       if regex.search(h['host'])]
+        elif _is_glob(target):
+            # The search only expands "*"; "?" and "[...]" are matched
+            # here, among hosts starting with the text before them.
+            prefix = _glob_prefix(target)
+            params = {}
+            if prefix:
+                params['search'] = {'host': prefix}
+                params['startSearch'] = True
+            candidates = zapi.host.get(output=_HOST_FIELDS, **params)
+            matched = [_Host.from_dict(h) for h in candidates
+                       if fnmatch.fnmatchcase(h['host'], target)]
+        else:
+            continue
+        if not matched:
+            logger.error('No host matches "{}"'.format(target))
+        hosts.extend(matched)
+    matched = set(h['host'] for h in hosts) | set(h['name'] for h in hosts)
+    for name in names:
+        if name not in matched:
+            logger.error('No host "{}"'.format(name))
+    return hosts
+
+
+def _match_hosts(candidates, targets, logger):
+    '''
+    Returns those of candidates (host dicts) matching targets, as
+    resolve_targets() would on the server.
+    '''
+    hosts = []
+    for target in targets or []:
+        if target.startswith('re:'):
+            regex = re.compile(target[3:])
+            matched = [h for h in candidates if regex.search(h['host'])]
+        elif _is_glob(target):
+            matched = [h for h in candidates
+                       if fnmatch.fnmatchcase(h['host'], target)]
+        else:
+            matched = [h for h in candidates
+                       if target in (h['host'], h['name'])]
+            if not matched:
+                logger.error('No host "{}"'.format(target))
+        if not matched and (target.startswith('re:') or _is_glob(target)):
+            logger.error('No host matches "{}"'.format(target))
+        hosts.extend(_Host.from_dict(h) for h in matched)
+    return hosts
+
+
+def resolve_from_cache(cache, targets, groups, logger):
+    '''
+    Same as resolve_targets() and resolve_groups() together, matching
+    against a metadata.MetadataCache instead of the server.
+    '''
+    hosts = _match_hosts(cache.hosts(), targets, logger)
+    if groups:
+        for name in set(groups) - set(g['name'] for g in cache.groups(groups)):
+            logger.error('No host group "{}"'.format(name))
+        hosts.extend(_Host.from_dict(h) for h in cache.hosts_in_groups(groups))
+    return hosts
+
+
+def _maintenance_params(name, hostids, start_time, period):
+    return {'name': name,
+            'active_since': start_time,
+            'active_till': start_time + period,
+            'hostids': hostids,
+            'timeperiods': [{'timeperiod_type': 0,
+                             'start_date': start_time,
+                             'period': period}]}
+
+
+def start_maintenance(server, args, password, period, logger):
+    '''
+    Creates the maintenance described by args on server and returns its
+    id, or None when it was not created (the reason is logged).
+    '''
+    logger.debug('Connecting to Zabbix host "{}" with user {}'
+                 .format(server, args.user))
+    zapi = client.get_client(server, args.user, password,
+                             flavor='pyzabbix')
+    logger.debug('Zabbix version: {}'.format(zapi.api_version()))
+
+    cache = None
+    if args.metadata_max_age is not None:
+        cache = metadata.MetadataCache(server,
+                                       max_age=args.metadata_max_age)
+        # Only the host list, groups and templates are needed here.
+        cache.refresh(zapi, hostids=[])
+
+    if cache is not None:
+        if args.targets or args.groups:
+            hosts = resolve_from_cache(cache, args.targets, args.groups,
+                                       logger)
+        else:
+            hosts = [_Host.from_dict(h) for h in cache.hosts()]
+        if not hosts:
+            logger.error('No host matched. Not creating maintenance.')
+            return
+    elif args.targets or args.groups:
+        hosts = []
+        if args.targets:
+            hosts.extend(resolve_targets(zapi, args.targets, logger))
+        if args.groups:
+            hosts.extend(resolve_groups(zapi, server, args.groups,
+                                        logger))
+        if not hosts:
+            logger.error('No host matched. Not creating maintenance.')
+            return
+    else:
+        hosts = [_Host.from_dict(h) for h in
+                 zapi.stream('host.get', {'output': ['hostid', 'name']})]
+    hostids = sorted(set(x[u'hostid'] for x in hosts))
+    if logger.isEnabledFor(DEBUG):
+        logger.debug('Creating maintenance for {}'
+                     .format(sorted(set(x[u'name'] for x in hosts))))
+
+    filtered = zapi.maintenance.get(filter={'name': args.name})
+    if filtered:
+        if args.delete_existing:
+            logger.debug('Maintenance already exists ({}). Deleting it.'
+                         .format(filtered))
+            # Duplicates left by earlier runs go in the same call.
+            zapi.maintenance.delete([m[u'maintenanceid'] for m in filtered])
+        else:
+            logger.error('Maintenance already exists ({}).'
+                         .format(filtered))
+            return
+
+    start_time = int(time.time())
+    end_time = start_time + period
+    start_readable = (datetime.fromtimestamp(start_time)
+                      .strftime('%Y-%m-%d %H:%M:%S'))
+    end_readable = (datetime.fromtimestamp(end_time)
+                    .strftime('%Y-%m-%d %H:%M:%S'))
+    logger.debug('Creating maintenance "{}", from "{}" till "{}"'
+                 .format(args.name, start_readable, end_readable))
+
+    result = zapi.maintenance.create(_maintenance_params(
+        args.name, hostids, start_time, period))
+    logger.debug('Result: {}'.format(result))
+    assert len(result[u'maintenanceids']) == 1
+
+    logger.info('Created maintenance id: {}'
+                .format(result[u'maintenanceids'][0]))
+    return result[u'maintenanceids'][0]
+
+
+class _CallCounter(object):
+    '''
+    A client hook (see client.add_hook) counting the API calls made by
+    the thread which created it, so that servers handled at the same
+    time by fleet.run() are counted apart.
+    '''
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.calls = 0
+
+    def __call__(self, method, *args):
+        if threading.current_thread() is self.thread:
+            self.calls += 1
+
+
+def parse_period(value):
+    '''Returns seconds of "3600", "2h", "30m", ..., or None.'''
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+    m_period = r_period.match(value)
+    if not m_period:
+        return None
+    mul = {'s': 1, 'm': 60, 'h': 60*60}[m_period.group(2)[0]]
+    return int(m_period.group(1)) * mul
+
+
+def read_spec(filename, default_period):
+    '''
+    Reads maintenances from a JSON list of objects with
+      "name"     (required)
+      "targets"  host names, glob patterns or "re:" expressions
+      "groups"   host group names
+      "period"   like --period (default: default_period seconds)
+      "start"    "now" (default), a unix time or "2013-06-06 12:00"
+      "delete"   true to delete the maintenance of that name instead
+    Neither targets nor groups means all hosts, as on the command line.
+    '''
+    with open(filename) as f:
+        specs = json.load(f)
+    names = set()
+    now = int(time.time())
+    for spec in specs:
+        if not spec.get('name'):
+            raise ValueError('"name" is missing in {}'.format(spec))
+        if spec['name'] in names:
+            raise ValueError('"{}" appears twice in {}'
+                             .format(spec['name'], filename))
+        names.add(spec['name'])
+        period = parse_period(spec.get('period', default_period))
+        if period is None:
+            raise ValueError('Failed to parse period of "{}": {}'
+                             .format(spec['name'], spec['period']))
+        spec['period'] = period
+        spec['start'] = history.parse_time(str(spec.get('start', 'now')),
+                                           now)
+    return specs
+
+
+def _resolve_specs(zapi, server, specs, cache, logger):
+    '''
+    Returns sorted hostids of every spec which is not a deletion, from
+    a few queries covering all of them rather than a few per spec.
+    '''
+    wanted = [s for s in specs if not s.get('delete')]
+    if cache is not None:
+        candidates = cache.hosts()
+    elif any(not (s.get('targets') or s.get('groups'))
+             or any(t.startswith('re:') or _is_glob(t)
+                    for t in s.get('targets') or [])
+             for s in wanted):
+        # Patterns are matched here, against one list of every host.
+        candidates = list(zapi.stream('host.get', {'output': _HOST_FIELDS}))
+    else:
+        names = sorted(set(t for s in wanted for t in s.get('targets') or []))
+        candidates = {}
+        if names:
+            for field in ('host', 'name'):
+                for h in zapi.host.get(filter={field: names},
+                                       output=_HOST_FIELDS):
+                    candidates[h['hostid']] = h
+        candidates = list(candidates.values())
+    groups = sorted(set(g for s in wanted for g in s.get('groups') or []))
+    members = {}
+    if cache is not None:
+        for name in set(groups) - set(g['name'] for g in cache.groups(groups)):
+            logger.error('No host group "{}"'.format(name))
+        for group in groups:
+            members[group] = cache.hosts_in_groups([group])
+    elif groups:
+        members = _group_members(zapi, server, groups, logger)
+    hostids = {}
+    for spec in wanted:
+        if spec.get('targets') or spec.get('groups'):
+            hosts = [h['hostid'] for h in
+                     _match_hosts(candidates, spec.get('targets'), logger)]
+            for group in spec.get('groups') or []:
+                hosts.extend(h['hostid'] for h in members.get(group, []))
+        else:
+            hosts = [h['hostid'] for h in candidates]
+        hostids[spec['name']] = sorted(set(hosts))
+    return hostids
+
+
+def apply_spec(server, args, password, specs, logger):
+    '''
+    Creates, updates or deletes every maintenance of specs (see
+    read_spec()) on server with one array-form maintenance.delete,
+    maintenance.update and maintenance.create, and returns counts of
+    what was done. A maintenance of the same name is updated in place;
+    its duplicates are deleted.
+    '''
+    counter = _CallCounter()
+    client.add_hook(counter)
+    phases = []
+
+    def phase(name, start, calls):
+        phases.append((name, time.time() - start, counter.calls - calls))
+        return (time.time(), counter.calls)
+
+    try:
+        mark = (time.time(), 0)
+        zapi = client.get_client(server, args.user, password,
+                                 flavor='pyzabbix')
+        zapi.api_version()
+        mark = phase('login', *mark)
+
+        cache = None
+        if args.metadata_max_age is not None:
+            cache = metadata.MetadataCache(server,
+                                           max_age=args.metadata_max_age)
+            cache.refresh(zapi, hostids=[])
+        hostids = _resolve_specs(zapi, server, specs, cache, logger)
+        mark = phase('resolve', *mark)
+
+        existing = {}
+        for m in zapi.maintenance.get(
+                filter={'name': [s['name'] for s in specs]},
+                output=['maintenanceid', 'name']):
+            existing.setdefault(m['name'], []).append(m['maintenanceid'])
+        mark = phase('lookup', *mark)
+
+        to_delete = []
+        to_update = []
+        to_create = []
+        skipped = []
+        for spec in specs:
+            ids = sorted(existing.get(spec['name'], []), key=int)
+            if spec.get('delete'):
+                to_delete.extend(ids)
+                continue
+            if not hostids[spec['name']]:
+                logger.error('No host matched for "{}". Skipping it.'
+                             .format(spec['name']))
+                skipped.append(spec['name'])
+                continue
+            params = _maintenance_params(spec['name'],
+                                         hostids[spec['name']],
+                                         spec['start'], spec['period'])
+            if ids:
+                if len(ids) > 1:
+                    logger.warning('{} maintenances are named "{}".'
+                                   ' Keeping {} only.'
+                                   .format(len(ids), spec['name'], ids[0]))
+                to_delete.extend(ids[1:])
+                params['maintenanceid'] = ids[0]
+                to_update.append(params)
+            else:
+                to_create.append(params)
+        if to_delete:
+            zapi.maintenance.delete(to_delete)
+        if to_update:
+            zapi.maintenance.update(to_update)
+        if to_create:
+            result = zapi.maintenance.create(to_create)
+            assert len(result[u'maintenanceids']) == len(to_create)
+        phase('apply', *mark)
+    finally:
+        client.remove_hook(counter)
+
+    logger.info('Created {}, updated {}, deleted {}, skipped {} with {} API'
+                ' calls ({})'.format(
+                    len(to_create), len(to_update), len(to_delete),
+                    len(skipped), counter.calls,
+                    ', '.join('{}: {:.2f}s/{} calls'.format(*p)
+                              for p in phases)))
+    return {'created': len(to_create), 'updated': len(to_update),
+            'deleted': len(to_delete), 'skipped': skipped,
+            'calls': counter.calls, 'phases': phases}
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=('Start maintenance right now'))
-    parser.add_argument('hostname', action='store')
+    parser.add_argument('hostname', action='store', nargs='?',
+                        help=('Zabbix server, a shortcut name of your'
+                              ' config file, or several of them separated'
+                              ' by commas'))
     parser.add_argument('-d', '--delete-existing', action='store_true',
                         help=('Remove an existing maintenance with same name.'))
     parser.add_argument('--user', action='store', default='admin')
@@ -33,12 +502,27 @@ def main():
                               'Seconds or something like "2h" / "30m".'
                               'No complicated values will be accepted :-)'))
     parser.add_argument('--targets', action='store', nargs='*',
-                        help='If empty all hosts will be under maintenance')
+                        help=('Host names, glob patterns (e.g. "web*") or'
+                              ' regular expressions ("re:^db[0-9]+$").'
+                              ' If neither --targets nor --groups is given'
+                              ' all hosts will be under maintenance'))
+    parser.add_argument('--groups', action='store', nargs='*',
+                        help='Host groups whose hosts will be under maintenance')
+    parser.add_argument('--spec', action='store', metavar='FILE',
+                        help=('Create, update or delete every maintenance'
+                              ' listed in this JSON file in a few batched'
+                              ' calls, instead of the one given by --name,'
+                              ' --targets and --groups'))
     parser.add_argument('--log', action='store', default='INFO',
                         help=('Set log level. e.g. DEBUG, INFO, WARN'))
     parser.add_argument('--log-pyzabbix', action='store_true',
-                        help=('Show PyZabbix\'s log. Useful if you want'
-                              ' to see JSON query that are sent/received.'))
+                        help=('Show the API client\'s log. Useful if you'
+                              ' want to see JSON query that are'
+                              ' sent/received.'))
+    fleet.add_argument(parser)
+    metadata.add_argument(parser)
+    profiling.add_argument(parser)
+    retry.add_argument(parser)
 
     args = parser.parse_args()
     logger = getLogger(__name__)
@@ -47,68 +531,57 @@ def main():
     handler.setLevel(args.log.upper())
     logger.addHandler(handler)
     if args.log_pyzabbix:
-        pyzabbix.logger.addHandler(handler)
-        pyzabbix.logger.setLevel(args.log.upper())
+        client.logger.addHandler(handler)
+        client.logger.setLevel(args.log.upper())
 
     if args.password:
         password = args.password
     else:
-        password = getpass.getpass('Password: ')
+        # Only asked for when there is no valid remembered session.
+        password = lambda: getpass.getpass('Password: ')
     
-    if args.period.isdigit():
-        period = int(args.period)
-    else:
-        m_period = r_period.match(args.period)
-        if m_period:
-            mul = {'s': 1, 'm': 60, 'h': 60*60}[m_period.group(2)[0]]
-            period = int(m_period.group(1)) * mul
-        else:
-            logger.error('Failed to parse {}'.format(args.period))
-            return
-
-    logger.debug('Connecting to Zabbix host "{}" with user {}'
-                 .format(args.hostname, args.user))
-    zapi = pyzabbix.ZabbixAPI(args.hostname)
-    zapi.login(args.user, password)
-    logger.debug('Zabbix version: {}'.format(zapi.api_version()))
-
-    filtered = zapi.maintenance.get(filter={'name': args.name})
-    if filtered:
-        assert len(filtered) == 1
-        if args.delete_existing:
-            logger.debug('Maintenance already exists ({}). Deleting it.'
-                         .format(filtered[0]))
-            zapi.maintenance.delete(filtered[0][u'maintenanceid'])
-        else:
-            logger.error('Maintenance already exists ({}).'
-                         .format(filtered[0]))
-            return
+    period = parse_period(args.period)
+    if period is None:
+        logger.error('Failed to parse {}'.format(args.period))
+        return
 
-    start_time = int(time.time())
-    end_time = start_time + period
-    start_readable = (datetime.fromtimestamp(start_time)
-                      .strftime('%Y-%m-%d %H:%M:%S'))
-    end_readable = (datetime.fromtimestamp(end_time)
-                    .strftime('%Y-%m-%d %H:%M:%S'))
-    logger.debug('Creating maintenance "{}", from "{}" till "{}"'
-                 .format(args.name, start_readable, end_readable))
+    if args.spec:
+        specs = read_spec(args.spec, period)
+        run = lambda server: apply_spec(server, args, password, specs,
+                                        logger)
+        describe = lambda value: (
+            'created {created}, updated {updated}, deleted {deleted},'
+            ' {calls} API calls'.format(**value))
+    else:
+        run = lambda server: start_maintenance(server, args, password,
+                                               period, logger)
+        describe = lambda value: 'maintenance id {}'.format(value)
 
-    hosts = zapi.host.get(output='extend')
-    logger.debug('Creating maintenance for {}'
-                 .format(map(lambda x: x[u'name'], hosts)))
-    hostids = map(lambda x: x[u'hostid'], hosts)
-    result = zapi.maintenance.create(name=args.name,
-                                     active_since=start_time,
-                                     active_till=end_time,
-                                     hostids=hostids,
-                                     timeperiods=[{'timeperiod_type': 0,
-                                                   'start_date': start_time,
-                                                   'period': period}])
-    logger.debug('Result: {}'.format(result))
-    assert len(result[u'maintenanceids']) == 1
+    servers = config.get_server_uris(args.hostname, args.all_servers)
+    if not servers:
+        parser.error('hostname or --all-servers is required')
+    if len(servers) == 1:
+        value = run(servers[0][1])
+        if args.spec and value['skipped']:
+            sys.exit(1)
+        return
 
-    logger.info('Created maintenance id: {}'
-                .format(result[u'maintenanceids'][0]))
+    if not args.password:
+        # Asked once here rather than by every server's thread.
+        password = getpass.getpass('Password: ')
+    results = fleet.run(run, servers, args.server_timeout)
+    for result in results:
+        if result.error is not None:
+            continue
+        if result.value is None:
+            result.error = 'maintenance not created'
+        elif args.spec and result.value['skipped']:
+            result.error = 'no host matched for {}'.format(
+                ', '.join(result.value['skipped']))
+    for line in fleet.format_report(results, describe):
+        print(line)
+    if fleet.failed(results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':